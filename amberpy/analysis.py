@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains a parallel map-reduce executor for analyses over the
+trajectories of one or more simulations.
+
+AnalysisExecutor
+    Splits the frames of every trajectory of the given simulations (taken
+    one after the other as one virtual range of frames) into chunks. The
+    main process reads each chunk into a shared memory buffer and worker
+    processes apply any transforms (e.g. imaging) to it and run a map
+    function on it, so coordinate arrays are never pickled. The partial
+    results are reduced in chunk order.
+
+A typical use would be:
+
+    import numpy as np
+    from amberpy.analysis import AnalysisExecutor
+
+    def centre(frames):
+        return frames.coordinates.mean(axis=1)
+
+    executor = AnalysisExecutor(processes=8)
+    centres = executor.run(replicas, centre, np.vstack)
+"""
+import os
+import time
+import queue
+import traceback
+import multiprocessing
+import logging
+
+import numpy as np
+
+from amberpy.trajectory import Frames, open_trajectory
+
+logger = logging.getLogger(__name__)
+
+class Chunk:
+    '''A range of frames of one trajectory.
+
+    Attributes
+    ----------
+    index : int
+        Position of the chunk in the virtual range of frames.
+
+    trajectory : str
+        Path of the trajectory.
+
+    start, stop : int
+        Range of frames of the trajectory.
+
+    offset : int
+        Index of the chunk's first frame in the virtual range of frames.
+    '''
+
+    def __init__(self, index, trajectory, start, stop, offset):
+        self.index = index
+        self.trajectory = trajectory
+        self.start = start
+        self.stop = stop
+        self.offset = offset
+
+class AnalysisExecutor:
+    '''Runs map functions over chunks of frames in parallel.
+
+    The map function is given a Frames object (see amberpy.trajectory) whose
+    coordinates and boxes are views of a shared buffer (unless a transform
+    copied them), which is reused once the map function returns, so it must
+    not keep references to them. Its indices attribute holds the index of
+    each frame in the virtual range of frames.
+
+    Attributes
+    ----------
+    processes : int, optional
+        Number of worker processes. Defaults to the number of cpus. With 1,
+        everything is run in this process.
+
+    chunk_size : int, default=100
+        Number of frames in each chunk.
+
+    stride : int, default=1
+        Only use every stride-th frame of each trajectory.
+
+    progress_interval : float, default=30
+        Seconds between progress reports in the log.
+
+    transforms : list, optional
+        Functions applied to the frames of every chunk by the worker
+        processes, before any atoms are selected (e.g. an
+        amberpy.imaging.AutoImager). They must be picklable unless
+        processes is 1.
+
+    timings : list
+        For each chunk of the last run, a dictionary of the 'chunk' index,
+        'trajectory', 'frames', 'read' and 'map' times in seconds.
+    '''
+
+    def __init__(self, processes=None, chunk_size=100, stride=1, progress_interval=30,
+                 transforms=None):
+        self.processes = processes or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.stride = stride
+        self.progress_interval = progress_interval
+        self.transforms = list(transforms or [])
+        self.timings = []
+
+    def trajectories(self, sources, stripped=False):
+        '''Returns the trajectory files of a list of simulations (their
+        completed trajectories) and/or trajectory paths.'''
+        if isinstance(sources, str) or hasattr(sources, 'trajectories'):
+            sources = [sources]
+        trajectories = []
+        for source in sources:
+            if isinstance(source, str):
+                trajectories.append(source)
+            else:
+                files = source.stripped_trajectories if stripped else source.trajectories
+                trajectories += [f for f in files if os.path.isfile(f)]
+        return trajectories
+
+    def chunks(self, trajectories):
+        '''Splits the frames of some trajectories into chunks.
+
+        Returns
+        -------
+        tuple
+            List of Chunk objects and the largest number of atoms in a
+            trajectory.
+        '''
+        chunks = []
+        offset = 0
+        n_atoms = 0
+        for trajectory in trajectories:
+            reader = open_trajectory(trajectory)
+            n_atoms = max(n_atoms, reader.n_atoms)
+            n_frames = len(range(0, reader.n_frames, self.stride))
+            for start in range(0, n_frames, self.chunk_size):
+                stop = min(start + self.chunk_size, n_frames)
+                chunks.append(Chunk(len(chunks), trajectory, start * self.stride,
+                                    (stop - 1) * self.stride + 1, offset + start))
+            offset += n_frames
+        return chunks, n_atoms
+
+    def read_frames(self, sources, indices, atoms=None, stripped=False):
+        '''Reads frames of the sources by their index in the virtual range of
+        frames (e.g. the indices given to a map function).
+
+        Returns
+        -------
+        Frames
+            The frames, in the order of the indices.
+        '''
+        indices = np.asarray(indices, dtype=int)
+        chunks, _ = self.chunks(self.trajectories(sources, stripped))
+        offsets = np.array([chunk.offset for chunk in chunks])
+        frames = []
+        for index in indices:
+            chunk = chunks[np.searchsorted(offsets, index, side='right') - 1]
+            frame = chunk.start + (index - chunk.offset) * self.stride
+            if index < 0 or frame >= chunk.stop:
+                raise Exception(f'There is no frame {index}')
+            frames.append(_transform(self._read(Chunk(chunk.index, chunk.trajectory, frame, frame + 1, index)),
+                                     self.transforms, atoms))
+        return Frames(np.concatenate([f.coordinates for f in frames]),
+                      np.concatenate([f.boxes for f in frames]),
+                      np.concatenate([f.times for f in frames]),
+                      indices)
+
+    def run(self, sources, map_function, reduce_function=None, initial=None, atoms=None,
+            stripped=False):
+        '''Runs an analysis over every frame of the sources.
+
+        Parameters
+        ----------
+        sources : Simulation, str or list
+            Simulations and/or trajectory paths. Their frames are taken one
+            after the other.
+
+        map_function : callable
+            Called with the Frames of each chunk and returns a partial
+            result. It (and the partial results) must be picklable unless
+            processes is 1.
+
+        reduce_function : callable, optional
+            Called with the list of partial results in chunk order, or, if
+            initial is given, called with (accumulated, partial) for each
+            chunk in order. By default the list of partial results is
+            returned.
+
+        initial : optional
+            Starting value of the accumulated result.
+
+        atoms : array_like, optional
+            Indices of the atoms passed to the map function (e.g. the
+            protein atoms). Defaults to every atom.
+
+        stripped : bool, default=False
+            Use the stripped trajectories of the simulations (see
+            amberpy.reduction).
+
+        Returns
+        -------
+        The reduced result.
+        '''
+        trajectories = self.trajectories(sources, stripped)
+        chunks, n_atoms = self.chunks(trajectories)
+        if atoms is not None:
+            atoms = np.asarray(atoms)
+
+            # Transforms need every atom, so the atoms are only selected
+            # before the frames are shared if there are none
+            if not self.transforms:
+                n_atoms = len(atoms)
+        self.timings = []
+        self._started = time.time()
+        self._reported = self._started
+        self._n_chunks = len(chunks)
+        self._n_frames = 0
+
+        accumulated = initial
+        partials = []
+        for chunk, partial in self._results(chunks, n_atoms, map_function, atoms):
+            self._progress()
+            if initial is not None:
+                accumulated = reduce_function(accumulated, partial)
+            else:
+                partials.append(partial)
+
+        elapsed = time.time() - self._started
+        logger.info(f'Analysed {self._n_frames} frames of {len(trajectories)} '
+                    f'trajectories in {len(chunks)} chunks in {elapsed:.1f} s '
+                    f'({self._n_frames / max(elapsed, 1e-9):.1f} frames/s)')
+
+        if initial is not None:
+            return accumulated
+        if reduce_function is not None:
+            return reduce_function(partials)
+        return partials
+
+    def _results(self, chunks, n_atoms, map_function, atoms):
+        '''Yields (chunk, partial result) in chunk order.'''
+        if self.processes == 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                t = time.time()
+                frames = self._read(chunk)
+                read = time.time() - t
+                t = time.time()
+                frames = _transform(frames, self.transforms, atoms)
+                partial = map_function(frames)
+                self._record(chunk, len(frames), read, time.time() - t)
+                yield chunk, partial
+            return
+
+        context = multiprocessing.get_context()
+        n_workers = min(self.processes, len(chunks))
+        n_slots = 2 * n_workers
+        slot_size = self.chunk_size * n_atoms
+        coordinates = context.RawArray('f', n_slots * slot_size * 3)
+        boxes = context.RawArray('d', n_slots * self.chunk_size * 6)
+
+        # Without transforms, the parent selects the atoms so that less is
+        # copied into the buffer
+        if self.transforms:
+            worker_atoms, atoms = atoms, None
+        else:
+            worker_atoms = None
+
+        tasks = context.Queue()
+        results = context.Queue()
+        workers = [context.Process(target=_worker,
+                                   args=(map_function, self.transforms, worker_atoms, coordinates,
+                                         boxes, slot_size, self.chunk_size, tasks, results),
+                                   daemon=True)
+                   for _ in range(n_workers)]
+        for worker in workers:
+            worker.start()
+
+        coordinates = np.frombuffer(coordinates, dtype=np.float32).reshape(n_slots, slot_size * 3)
+        boxes = np.frombuffer(boxes, dtype=np.float64).reshape(n_slots, self.chunk_size * 6)
+
+        try:
+            free = list(range(n_slots))
+            pending = {}
+            reads = {}
+            next_chunk = 0
+            next_result = 0
+            while next_result < len(chunks):
+
+                # Keep every free buffer filled with the next chunk
+                while free and next_chunk < len(chunks):
+                    chunk = chunks[next_chunk]
+                    slot = free.pop()
+                    t = time.time()
+                    frames = _transform(self._read(chunk), [], atoms)
+                    reads[chunk.index] = time.time() - t
+                    n = len(frames)
+                    size = n * frames.coordinates.shape[1] * 3
+                    coordinates[slot, :size] = frames.coordinates.reshape(-1)
+                    boxes[slot, :n * 6] = frames.boxes.reshape(-1)
+                    tasks.put((slot, chunk.index, frames.coordinates.shape[1],
+                               frames.times, frames.indices))
+                    next_chunk += 1
+
+                slot, index, partial, map_time, error = self._get(results, workers)
+                free.append(slot)
+                if error is not None:
+                    raise Exception(f'The analysis of chunk {index} '
+                                    f'({chunks[index].trajectory}) failed:\n{error}')
+                pending[index] = (partial, map_time)
+
+                while next_result in pending:
+                    partial, map_time = pending.pop(next_result)
+                    chunk = chunks[next_result]
+                    self._record(chunk, chunk_frames(chunk, self.stride), reads.pop(next_result), map_time)
+                    yield chunk, partial
+                    next_result += 1
+        finally:
+            for _ in workers:
+                tasks.put(None)
+            for worker in workers:
+                worker.join(timeout=10)
+                if worker.is_alive():
+                    worker.terminate()
+
+    def _get(self, results, workers):
+        '''Waits for the next result, checking that the workers are still
+        running.'''
+        while True:
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in workers):
+                    raise Exception('An analysis worker process died')
+
+    def _read(self, chunk):
+        '''Reads the frames of a chunk (without applying the transforms).'''
+        reader = open_trajectory(chunk.trajectory)
+        frames = reader.read(chunk.start, chunk.stop, self.stride)
+        frames.indices = chunk.offset + np.arange(len(frames))
+        return frames
+
+    def _record(self, chunk, n_frames, read, map_time):
+        self.timings.append({'chunk': chunk.index,
+                             'trajectory': chunk.trajectory,
+                             'frames': n_frames,
+                             'read': read,
+                             'map': map_time})
+        self._n_frames += n_frames
+
+    def _progress(self):
+        now = time.time()
+        if now - self._reported < self.progress_interval:
+            return
+        self._reported = now
+        done = len(self.timings)
+        elapsed = now - self._started
+        remaining = elapsed / done * (self._n_chunks - done)
+        mean_map = sum(t['map'] for t in self.timings) / done
+        logger.info(f'Analysed {done}/{self._n_chunks} chunks ({self._n_frames} frames, '
+                    f'{mean_map:.2f} s per chunk), about {remaining:.0f} s left')
+
+def chunk_frames(chunk, stride):
+    '''Returns the number of frames in a chunk.'''
+    return len(range(chunk.start, chunk.stop, stride))
+
+def _transform(frames, transforms, atoms):
+    '''Applies transforms to some frames and then selects atoms.'''
+    indices = frames.indices
+    for transform in transforms:
+        frames = transform(frames)
+    frames.indices = indices
+    if atoms is not None:
+        frames.coordinates = frames.coordinates[:, atoms]
+    return frames
+
+def _worker(map_function, transforms, atoms, coordinates, boxes, slot_size, chunk_size, tasks, results):
+    '''Applies the transforms to the chunks put in the tasks queue and runs
+    the map function on them.'''
+    coordinates = np.frombuffer(coordinates, dtype=np.float32).reshape(-1, slot_size * 3)
+    boxes = np.frombuffer(boxes, dtype=np.float64).reshape(-1, chunk_size * 6)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        slot, index, n_atoms, times, indices = task
+        n = len(indices)
+        try:
+            t = time.time()
+            frames = Frames(coordinates[slot, :n * n_atoms * 3].reshape(n, n_atoms, 3),
+                            boxes[slot, :n * 6].reshape(n, 6),
+                            times,
+                            indices)
+            partial = map_function(_transform(frames, transforms, atoms))
+            results.put((slot, index, partial, time.time() - t, None))
+        except Exception:
+            results.put((slot, index, None, 0.0, traceback.format_exc()))
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains a lossy compressed archive format for the trajectories
+of finished simulations.
+
+Coordinates are quantised to a fixed precision (like XTC), each frame is
+delta coded along the atoms (neighbouring atoms are close in space, so the
+differences are small integers), the bytes are split into planes and each
+chunk of frames is compressed with zlib or lzma. An index of the chunks at
+the end of the file gives random access to any frame.
+
+ArchiveWriter
+    Writes frames to an archive file.
+
+ArchiveFile
+    Reads frames (and boxes and times) from an archive file.
+
+archive_trajectory(trajectory, output=None, precision=1000, ...)
+    Converts a NetCDF trajectory into an archive file and reports the
+    compression ratio and the largest coordinate error.
+
+A typical use would be:
+
+    from amberpy.archive import archive_trajectory
+
+    report = archive_trajectory('step-3.0-production.nc', precision=100)
+    print(report['ratio'], report['max_error'])
+"""
+import os
+import json
+import lzma
+import struct
+import zlib
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'AMBERPYZ'
+VERSION = 1
+EXTENSION = '.ncz'
+
+_CODECS = {'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+           'lzma': (lambda data: lzma.compress(data, preset=6), lzma.decompress)}
+
+def _encode(coordinates, precision):
+    '''Quantises a (frames, atoms, 3) array and returns the delta coded,
+    zigzagged and byte-plane shuffled bytes.'''
+    q = np.round(coordinates.astype(np.float64) * precision).astype(np.int64)
+    delta = np.diff(q, axis=1, prepend=0)
+    zigzag = ((delta << 1) ^ (delta >> 63)).astype(np.uint32)
+    return np.ascontiguousarray(zigzag.view(np.uint8).reshape(-1, 4).T).tobytes()
+
+def _decode(data, shape, precision):
+    '''Inverts _encode.'''
+    planes = np.frombuffer(data, dtype=np.uint8).reshape(4, -1)
+    zigzag = np.ascontiguousarray(planes.T).view(np.uint32).reshape(shape).astype(np.int64)
+    delta = (zigzag >> 1) ^ -(zigzag & 1)
+    return (np.cumsum(delta, axis=1) / precision).astype(np.float32)
+
+class ArchiveWriter:
+    '''Writes frames to an archive file.
+
+    Attributes
+    ----------
+    fname : str
+        Path of the archive file.
+
+    n_atoms : int
+        Number of atoms in each frame.
+
+    precision : float, default=1000
+        Coordinates are stored as integer multiples of 1/precision Angstroms,
+        so the largest error is 0.5/precision Angstroms.
+
+    chunk_frames : int, default=100
+        Number of frames compressed together.
+
+    codec : str, default='zlib'
+        'zlib' or 'lzma' (smaller but slower).
+
+    attributes : dict
+        Extra information saved in the header (e.g. the source trajectory).
+
+    max_error : float
+        Largest difference between a written and a stored coordinate.
+    '''
+
+    def __init__(self, fname, n_atoms, precision=1000, chunk_frames=100, codec='zlib',
+                 attributes=None):
+        if codec not in _CODECS:
+            raise Exception(f'codec must be one of {list(_CODECS)}, not {codec}')
+        self.fname = fname
+        self.n_atoms = n_atoms
+        self.precision = precision
+        self.chunk_frames = chunk_frames
+        self.codec = codec
+        self.attributes = attributes or {}
+        self.max_error = 0.0
+        self.n_frames = 0
+
+        self._compress = _CODECS[codec][0]
+        self._chunks = []
+        self._buffer = []
+        self._file = open(fname, 'wb')
+        self._file.write(MAGIC + struct.pack('<I', VERSION))
+
+    def write(self, coordinates, boxes=None, times=None):
+        '''Adds frames.
+
+        Parameters
+        ----------
+        coordinates : np.ndarray
+            (frames, atoms, 3) coordinates in Angstroms.
+
+        boxes : np.ndarray, optional
+            (frames, 6) box lengths and angles.
+
+        times : np.ndarray, optional
+            Time of each frame in ps.
+        '''
+        coordinates = np.asarray(coordinates, dtype=np.float32)
+        n = len(coordinates)
+        boxes = np.full((n, 6), np.nan) if boxes is None else np.asarray(boxes, dtype=np.float64)
+        times = np.full(n, np.nan) if times is None else np.asarray(times, dtype=np.float64)
+        for i in range(n):
+            self._buffer.append((coordinates[i], boxes[i], times[i]))
+            if len(self._buffer) == self.chunk_frames:
+                self._flush()
+
+    def close(self):
+        '''Writes the last chunk and the index.'''
+        if self._file.closed:
+            return
+        self._flush()
+        header = json.dumps({'n_atoms': self.n_atoms,
+                             'n_frames': self.n_frames,
+                             'precision': self.precision,
+                             'chunk_frames': self.chunk_frames,
+                             'codec': self.codec,
+                             'max_error': self.max_error,
+                             'attributes': self.attributes,
+                             'chunks': self._chunks}).encode()
+        offset = self._file.tell()
+        self._file.write(header)
+        self._file.write(struct.pack('<QQ', offset, len(header)) + MAGIC)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        coordinates = np.stack([frame[0] for frame in self._buffer])
+        boxes = np.stack([frame[1] for frame in self._buffer])
+        times = np.array([frame[2] for frame in self._buffer])
+        self._buffer = []
+
+        encoded = _encode(coordinates, self.precision)
+        error = np.abs(_decode(encoded, coordinates.shape, self.precision) - coordinates).max()
+        self.max_error = max(self.max_error, float(error))
+
+        data = self._compress(encoded + boxes.tobytes() + times.tobytes())
+        self._chunks.append([self._file.tell(), len(data), self.n_frames, len(coordinates)])
+        self._file.write(data)
+        self.n_frames += len(coordinates)
+
+class ArchiveFile:
+    '''Reads an archive file.
+
+    Attributes
+    ----------
+    fname : str
+        Path of the archive file.
+
+    header : dict
+        The archive's header: n_atoms, n_frames, precision, chunk_frames,
+        codec, max_error, attributes and the chunk index.
+    '''
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise Exception(f'{fname} is not an amberpy archive')
+            f.seek(-16 - len(MAGIC), os.SEEK_END)
+            offset, length = struct.unpack('<QQ', f.read(16))
+            if f.read(len(MAGIC)) != MAGIC:
+                raise Exception(f'{fname} is incomplete (it has no index)')
+            f.seek(offset)
+            self.header = json.loads(f.read(length))
+        self._decompress = _CODECS[self.header['codec']][1]
+        self._cache = (None, None)
+
+    @property
+    def n_frames(self):
+        '''int : Number of frames.'''
+        return self.header['n_frames']
+
+    @property
+    def n_atoms(self):
+        '''int : Number of atoms in each frame.'''
+        return self.header['n_atoms']
+
+    def read(self, start=0, stop=None, step=1):
+        '''Returns the coordinates, boxes and times of a range of frames.
+
+        Returns
+        -------
+        tuple
+            (frames, atoms, 3) coordinates, (frames, 6) boxes (NaN if there
+            was no box) and the time of each frame (NaN if unknown).
+        '''
+        frames = range(*slice(start, stop, step).indices(self.n_frames))
+        coordinates = np.empty((len(frames), self.n_atoms, 3), dtype=np.float32)
+        boxes = np.empty((len(frames), 6))
+        times = np.empty(len(frames))
+
+        chunk_frames = self.header['chunk_frames']
+        i = 0
+        while i < len(frames):
+            chunk = frames[i] // chunk_frames
+            first = chunk * chunk_frames
+            c, b, t = self._chunk(chunk)
+
+            # The frames of the range that are in this chunk
+            n = len(range(frames[i], min(first + len(c), frames[-1] + 1), frames.step))
+            index = slice(frames[i] - first, frames[i] - first + n * frames.step, frames.step)
+            coordinates[i:i+n] = c[index]
+            boxes[i:i+n] = b[index]
+            times[i:i+n] = t[index]
+            i += n
+
+        return coordinates, boxes, times
+
+    def _chunk(self, chunk):
+        '''Returns the decompressed coordinates, boxes and times of a
+        chunk, keeping the last one read.'''
+        if self._cache[0] == chunk:
+            return self._cache[1]
+        offset, length, first, n = self.header['chunks'][chunk]
+        with open(self.fname, 'rb') as f:
+            f.seek(offset)
+            data = self._decompress(f.read(length))
+        size = n * self.n_atoms * 3 * 4
+        coordinates = _decode(data[:size], (n, self.n_atoms, 3), self.header['precision'])
+        boxes = np.frombuffer(data[size:size + n * 48], dtype=np.float64).reshape(n, 6)
+        times = np.frombuffer(data[size + n * 48:], dtype=np.float64)
+        self._cache = (chunk, (coordinates, boxes, times))
+        return self._cache[1]
+
+def archive_trajectory(trajectory, output=None, precision=1000, chunk_frames=100,
+                       codec='zlib', remove=False):
+    '''Converts a trajectory into an archive file.
+
+    Parameters
+    ----------
+    trajectory : str
+        Path of the NetCDF trajectory.
+
+    output : str, optional
+        Path of the archive. Defaults to the trajectory's path with the
+        extension replaced by .ncz.
+
+    precision : float, default=1000
+        Coordinates are kept to 1/precision Angstroms.
+
+    chunk_frames : int, default=100
+        Number of frames compressed together.
+
+    codec : str, default='zlib'
+        'zlib' or 'lzma'.
+
+    remove : bool, default=False
+        Delete the trajectory once it has been archived.
+
+    Returns
+    -------
+    dict
+        The 'output' path, 'n_frames', 'input_size' and 'output_size' in
+        bytes, compression 'ratio' and 'max_error' in Angstroms.
+    '''
+    from amberpy.trajectory import open_trajectory
+
+    if output is None:
+        output = os.path.splitext(trajectory)[0] + EXTENSION
+
+    source = open_trajectory(trajectory)
+    attributes = {'source': os.path.basename(trajectory)}
+    with ArchiveWriter(output, source.n_atoms, precision, chunk_frames, codec, attributes) as writer:
+        for start in range(0, source.n_frames, chunk_frames):
+            frames = source.read(start, start + chunk_frames)
+            writer.write(frames.coordinates, frames.boxes, frames.times)
+
+    report = {'output': output,
+              'n_frames': writer.n_frames,
+              'input_size': os.path.getsize(trajectory),
+              'output_size': os.path.getsize(output),
+              'max_error': writer.max_error}
+    report['ratio'] = report['input_size'] / report['output_size']
+    logger.info(f"Archived {trajectory}: {report['n_frames']} frames, "
+                f"{report['ratio']:.1f}x smaller, largest error {report['max_error']:.4f} A")
+
+    if remove:
+        os.remove(trajectory)
+    return report
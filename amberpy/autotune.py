@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains a throughput autotuner for the MD run parameters.
+
+BenchmarkDatabase
+    A local JSON database of benchmark results (ns/day for each system size,
+    set of parameters and resource).
+
+Autotuner
+    Runs short benchmark jobs of a system over a grid of performance related
+    settings (cutoff, output frequencies and cpu vs gpu) and returns the
+    fastest ProductionInput within the given accuracy bounds.
+
+A typical use would be:
+
+    from amberpy.autotune import Autotuner
+    from amberpy.schedulers import SGEScheduler
+
+    tuner = Autotuner(experiment.parm7, experiment.rst7, SGEScheduler(host='arc4'))
+    md_input = tuner.tune(min_cutoff=9.0)
+    experiment.add_production_step(md_input=md_input)
+
+or from the command line:
+
+    python -m amberpy.autotune system.parm7 system.rst7 --scheduler sge --host arc4
+"""
+import os
+import json
+import time
+import shutil
+import itertools
+import argparse
+import logging
+
+from amberpy.simulation import ProductionInput
+from amberpy.crossbow import pmemd_arguments
+from amberpy.schedulers import Job, COMPLETED, get_scheduler
+from amberpy.topology import Topology
+from amberpy.mdout import read_ns_per_day
+from amberpy.utilities import file_hash
+
+logger = logging.getLogger(__name__)
+
+class BenchmarkDatabase:
+    '''Benchmark results saved in a JSON file.
+
+    Each record contains the 'system' (hash of the parm7 file), 'n_atoms',
+    'settings' (the mdin parameters), 'resource' (e.g. 'gpu' or 'cpu32'),
+    'executable', 'ns_per_day' and the 'time' it was measured.
+
+    Attributes
+    ----------
+    path : str
+        Path of the JSON file.
+
+    records : list
+        The benchmark records.
+    '''
+
+    def __init__(self, path='~/.amberpy/benchmarks.json'):
+        self.path = os.path.expanduser(path)
+        self.records = []
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                self.records = json.load(f)
+
+    def add(self, record):
+        '''Adds a record (replacing any record for the same system,
+        settings and resource) and saves the database.'''
+        self.records = [r for r in self.records if _key(r) != _key(record)]
+        self.records.append(record)
+        self.save()
+
+    def save(self):
+        '''Writes the database to its JSON file.'''
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.records, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def find(self, system, settings, resource, executable):
+        '''Returns the record of a benchmark, or None if it hasn't been
+        run.'''
+        key = _key({'system': system, 'settings': settings,
+                    'resource': resource, 'executable': executable})
+        for record in self.records:
+            if _key(record) == key:
+                return record
+        return None
+
+    def estimate(self, n_atoms, settings=None, resource='gpu'):
+        '''Estimates the speed of a system from the benchmark of the system
+        closest in size, assuming the cost of a step is proportional to the
+        number of atoms.
+
+        Parameters
+        ----------
+        n_atoms : int
+            Number of atoms in the system.
+
+        settings : dict, optional
+            Only use benchmarks with these settings.
+
+        resource : str, default='gpu'
+            Only use benchmarks run on this resource.
+
+        Returns
+        -------
+        float or None
+            Estimated ns/day, or None if there are no matching benchmarks.
+        '''
+        records = [r for r in self.records if r['resource'] == resource and
+                   (settings is None or all(r['settings'].get(k) == v for k, v in settings.items()))]
+        if not records:
+            return None
+        closest = min(records, key=lambda r: abs(r['n_atoms'] - n_atoms))
+        return closest['ns_per_day'] * closest['n_atoms'] / n_atoms
+
+def _key(record):
+    return (record['system'], json.dumps(record['settings'], sort_keys=True),
+            record['resource'], record['executable'])
+
+class Autotuner:
+    '''Finds the fastest production parameters for a system.
+
+    Attributes
+    ----------
+    parm7 : str
+        Path of the system's parm7 file.
+
+    rst7 : str
+        Path of the coordinates (with velocities, e.g. the restart file of an
+        equilibration) that the benchmarks start from.
+
+    scheduler : Scheduler
+        Scheduler the benchmarks are run on (a LocalScheduler runs them on
+        this machine).
+
+    directory : str
+        Directory the benchmarks are run in.
+
+    benchmark_steps : int, default=10000
+        Number of MD steps in each benchmark.
+
+    cores : int, default=32
+        Number of cores used by cpu benchmarks.
+
+    database : BenchmarkDatabase
+        Database the results are saved to. Settings that have already been
+        benchmarked for the system are not run again.
+
+    results : list
+        Benchmark records of the last tune.
+    '''
+
+    def __init__(self,
+                 parm7,
+                 rst7,
+                 scheduler,
+                 directory=None,
+                 benchmark_steps=10000,
+                 cores=32,
+                 database=None):
+
+        self.parm7 = os.path.abspath(parm7)
+        self.rst7 = os.path.abspath(rst7)
+        self.scheduler = scheduler
+        if directory is None:
+            directory = os.path.join(os.path.dirname(self.parm7), 'autotune')
+        self.directory = os.path.abspath(directory)
+        self.benchmark_steps = benchmark_steps
+        self.cores = cores
+        self.database = database if database is not None else BenchmarkDatabase()
+        self.results = []
+
+        self.n_atoms = Topology(self.parm7).n_atoms
+        self.system = file_hash(self.parm7)
+
+    def grid(self,
+             cutoffs=(8.0, 9.0, 10.0),
+             ntpr=(1000, 5000),
+             ntwx=(25000, 50000),
+             dt=(0.004,),
+             resources=('gpu', 'cpu')):
+        '''Returns a list of (settings, resource) pairs for every combination
+        of the given values.'''
+        settings = [{'cut': c, 'ntpr': p, 'ntwx': x, 'dt': t}
+                    for c, p, x, t in itertools.product(cutoffs, ntpr, ntwx, dt)]
+        return [(s, r) for s in settings for r in resources]
+
+    def tune(self,
+             grid=None,
+             min_cutoff=8.0,
+             max_dt=0.004,
+             max_ntpr=None,
+             max_ntwx=None):
+        '''Benchmarks the settings in the grid that are within the accuracy
+        bounds and returns the fastest as a ProductionInput.
+
+        Parameters
+        ----------
+        grid : list, optional
+            (settings, resource) pairs to benchmark. Defaults to self.grid().
+
+        min_cutoff : float, default=8.0
+            Smallest non-bonded cutoff allowed (Angstroms).
+
+        max_dt : float, default=0.004
+            Largest time step allowed (ps).
+
+        max_ntpr, max_ntwx : int, optional
+            Largest energy/frame output intervals allowed (i.e. the least
+            often energies and frames can be written).
+
+        Returns
+        -------
+        ProductionInput
+            The fastest settings. The benchmark it came from, including the
+            resource it was run on, is in the best attribute.
+        '''
+        if grid is None:
+            grid = self.grid()
+
+        grid = [(s, r) for s, r in grid
+                if s.get('cut', 8.0) >= min_cutoff and s.get('dt', 0.004) <= max_dt and
+                (max_ntpr is None or s.get('ntpr', 1000) <= max_ntpr) and
+                (max_ntwx is None or s.get('ntwx', 25000) <= max_ntwx)]
+        if not grid:
+            raise Exception('None of the settings are within the accuracy bounds')
+
+        self.results = self.benchmark(grid)
+        measured = [r for r in self.results if r['ns_per_day'] is not None]
+        if not measured:
+            raise Exception('None of the benchmarks finished')
+
+        self.best = max(measured, key=lambda r: r['ns_per_day'])
+        logger.info(f"Fastest settings for {os.path.basename(self.parm7)}: "
+                    f"{self.best['settings']} on {self.best['resource']} "
+                    f"({self.best['ns_per_day']:.1f} ns/day)")
+        return ProductionInput(**self.best['settings'])
+
+    def benchmark(self, grid):
+        '''Runs (or looks up) a benchmark of each (settings, resource) pair
+        and returns their records.'''
+        os.makedirs(self.directory, exist_ok=True)
+        for fname in (self.parm7, self.rst7):
+            target = os.path.join(self.directory, os.path.basename(fname))
+            if not os.path.exists(target):
+                shutil.copy(fname, target)
+
+        records = []
+        jobs = {}
+        for i, (settings, resource) in enumerate(grid):
+            gpus, cores = (1, 1) if resource == 'gpu' else (0, self.cores)
+            executable = self.scheduler.pmemd_executable(gpus, cores)
+            resource_name = 'gpu' if gpus else f'cpu{cores}'
+
+            record = self.database.find(self.system, settings, resource_name, executable)
+            if record is not None:
+                records.append(record)
+                continue
+
+            job_id = self.scheduler.submit(self._benchmark_job(i, settings, executable, gpus, cores))
+            jobs[job_id] = (i, settings, resource_name, executable)
+
+        states = self.scheduler.wait(list(jobs))
+        for job_id, (i, settings, resource_name, executable) in jobs.items():
+            prefix = os.path.join(self.directory, f'benchmark-{i}')
+            ns_per_day = None
+            if states[job_id] == COMPLETED:
+                ns_per_day = read_ns_per_day(prefix + '.mdinfo') or read_ns_per_day(prefix + '.mdout')
+
+            record = {'system': self.system,
+                      'parm7': os.path.basename(self.parm7),
+                      'n_atoms': self.n_atoms,
+                      'settings': settings,
+                      'resource': resource_name,
+                      'executable': executable,
+                      'ns_per_day': ns_per_day,
+                      'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+            if ns_per_day is not None:
+                self.database.add(record)
+            else:
+                logger.warning(f'Benchmark of {settings} on {resource_name} '
+                               f'(job {job_id}) did not finish')
+            records.append(record)
+
+        return records
+
+    def _benchmark_job(self, i, settings, executable, gpus, cores):
+        '''Writes the mdin file of a benchmark and returns its job.'''
+        md_input = ProductionInput(**settings,
+                                   nstlim=self.benchmark_steps,
+                                   ntwr=self.benchmark_steps)
+        fname = f'benchmark-{i}.mdin'
+        md_input.write(self.directory, fname)
+        args = pmemd_arguments(fname,
+                               os.path.basename(self.parm7),
+                               os.path.basename(self.rst7),
+                               os.path.basename(self.rst7))
+        return Job(f'benchmark.{i}',
+                   [f'{executable} {args}'],
+                   workdir=self.directory,
+                   cores=cores,
+                   gpus=gpus,
+                   walltime='01:00:00')
+
+def main():
+
+    parser = argparse.ArgumentParser(description=('Benchmark a system over a '
+                                     'grid of MD settings and print the fastest.'))
+
+    parser.add_argument('parm7', help='Topology of the system.')
+    parser.add_argument('rst7', help='Coordinates (with velocities) to start the benchmarks from.')
+    parser.add_argument('-s', '--scheduler', default='local',
+                        help='Scheduler to run the benchmarks on (local, sge or slurm). Default is local.')
+    parser.add_argument('--host', default=None, help='Host to submit the benchmarks on via ssh.')
+    parser.add_argument('-d', '--directory', default=None, help='Directory to run the benchmarks in.')
+    parser.add_argument('--steps', default=10000, type=int, help='MD steps per benchmark. Default is 10000.')
+    parser.add_argument('--cores', default=32, type=int, help='Cores used by cpu benchmarks. Default is 32.')
+    parser.add_argument('--cutoffs', default=[8.0, 9.0, 10.0], type=float, nargs='+')
+    parser.add_argument('--ntpr', default=[1000, 5000], type=int, nargs='+')
+    parser.add_argument('--ntwx', default=[25000, 50000], type=int, nargs='+')
+    parser.add_argument('--resources', default=['gpu', 'cpu'], nargs='+', choices=['gpu', 'cpu'])
+    parser.add_argument('--min-cutoff', default=8.0, type=float, help='Smallest cutoff allowed.')
+    parser.add_argument('--max-ntwx', default=None, type=int, help='Largest frame interval allowed.')
+    parser.add_argument('--max-ntpr', default=None, type=int, help='Largest energy output interval allowed.')
+    parser.add_argument('--database', default='~/.amberpy/benchmarks.json',
+                        help='Benchmark database. Default is ~/.amberpy/benchmarks.json.')
+
+    args = parser.parse_args()
+
+    scheduler_kwargs = {} if args.scheduler == 'local' else {'host': args.host}
+    tuner = Autotuner(args.parm7,
+                      args.rst7,
+                      get_scheduler(args.scheduler, **scheduler_kwargs),
+                      directory=args.directory,
+                      benchmark_steps=args.steps,
+                      cores=args.cores,
+                      database=BenchmarkDatabase(args.database))
+
+    grid = tuner.grid(cutoffs=args.cutoffs, ntpr=args.ntpr, ntwx=args.ntwx,
+                      resources=args.resources)
+    tuner.tune(grid, min_cutoff=args.min_cutoff, max_ntpr=args.max_ntpr,
+               max_ntwx=args.max_ntwx)
+
+    for record in sorted(tuner.results, key=lambda r: -(r['ns_per_day'] or 0)):
+        print(f"{record['resource']:>6} {json.dumps(record['settings'])} "
+              f"{record['ns_per_day'] or 'failed'}")
+    print(f"Fastest: {json.dumps(tuner.best['settings'])} on {tuner.best['resource']}")
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains a streaming clustering of the conformations of a
+protein in long trajectories.
+
+FrameClustering
+    Clusters frames with scikit-learn's MiniBatchKMeans, fitted one chunk at
+    a time (partial_fit), on either the coordinates of the protein
+    superimposed onto a reference or the RMSDs of each frame to a set of
+    landmark frames. A second pass assigns every frame to a cluster and finds
+    the frame closest to the centre of each cluster, which is written as the
+    cluster's representative structure. Memory is bounded by the chunk size,
+    apart from one label per frame.
+
+A typical use would be:
+
+    from amberpy.clustering import FrameClustering
+
+    clustering = FrameClustering.from_experiment(replicas[0], n_clusters=10)
+    result = clustering.run(replicas)
+    print(result['populations'])
+    clustering.write_representatives(replicas, result, 'clusters')
+"""
+import os
+import logging
+
+import numpy as np
+
+from amberpy.analysis import AnalysisExecutor, chunk_frames
+from amberpy.rmsd import RMSDAnalysis, kabsch
+from amberpy.tools import write_pdb
+
+logger = logging.getLogger(__name__)
+
+class FrameClustering:
+    '''Clusters the frames of trajectories by conformation.
+
+    Attributes
+    ----------
+    selection : RMSDAnalysis
+        The protein atoms, fit atoms and reference structure (see
+        amberpy.rmsd). The fit atoms are clustered.
+
+    n_clusters : int
+        Number of clusters.
+
+    features : str
+        'coordinates' (superimposed coordinates of the fit atoms) or
+        'landmarks' (RMSD to each of n_landmarks frames spread evenly through
+        the trajectories).
+
+    n_landmarks : int
+        Number of landmark frames.
+
+    batch_size : int
+        Smallest number of frames passed to each partial_fit.
+
+    random_state : int
+        Seed, so the clustering is reproducible.
+    '''
+
+    def __init__(self, selection, n_clusters=10, features='coordinates', n_landmarks=50,
+                 batch_size=1024, random_state=0):
+        '''
+        Parameters
+        ----------
+        selection : RMSDAnalysis
+            The protein atoms, fit atoms and reference structure.
+
+        n_clusters : int, default=10
+            Number of clusters.
+
+        features : str, default='coordinates'
+            'coordinates' or 'landmarks'.
+
+        n_landmarks : int, default=50
+            Number of landmark frames.
+
+        batch_size : int, default=1024
+            Smallest number of frames passed to each partial_fit.
+
+        random_state : int, default=0
+            Seed of the k-means initialisation.
+        '''
+        if features not in ('coordinates', 'landmarks'):
+            raise Exception(f"features must be 'coordinates' or 'landmarks', not {features}")
+        self.selection = selection
+        self.n_clusters = n_clusters
+        self.features = features
+        self.n_landmarks = n_landmarks
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.model = None
+        self.landmarks = None
+
+    @classmethod
+    def from_experiment(cls, experiment, fit=('CA',), **kwargs):
+        '''Returns the clustering of an experiment's protein (see
+        RMSDAnalysis.from_experiment).'''
+        return cls(RMSDAnalysis.from_experiment(experiment, fit=fit), **kwargs)
+
+    def transform(self, frames):
+        '''Returns the features of a chunk of frames (of the protein
+        atoms).'''
+        selection = self.selection
+        coordinates = frames.coordinates[:, selection.fit]
+        if self.features == 'landmarks':
+            return np.column_stack([kabsch(coordinates, landmark, selection.weights)[0]
+                                    for landmark in self.landmarks])
+        reference = selection.reference[selection.fit]
+        _, rotations, centres, reference_centre = kabsch(coordinates, reference, selection.weights)
+        aligned = np.einsum('fni,fij->fnj', coordinates - centres[:, None, :], rotations)
+        return (aligned + reference_centre).reshape(len(frames), -1)
+
+    def _fit(self, accumulated, features):
+        '''Fits the model to the features of a chunk, once enough frames
+        have been collected.'''
+        buffer = np.concatenate([accumulated['buffer'], features]) if len(accumulated['buffer']) else features
+        if len(buffer) >= max(self.batch_size, self.n_clusters):
+            self.model.partial_fit(buffer)
+            buffer = buffer[:0]
+        return {'buffer': buffer, 'n_frames': accumulated['n_frames'] + len(features)}
+
+    def _assign(self, frames):
+        '''Returns the cluster of each frame of a chunk and its distance to
+        the centre.'''
+        features = self.transform(frames)
+        distances = self.model.transform(features)
+        labels = distances.argmin(axis=1)
+        return {'indices': frames.indices,
+                'labels': labels,
+                'distances': distances[np.arange(len(labels)), labels]}
+
+    def _collect(self, accumulated, partial):
+        '''Keeps the labels and the frame closest to each centre.'''
+        closest = accumulated['closest']
+        best = accumulated['best']
+        for cluster in np.unique(partial['labels']):
+            members = np.nonzero(partial['labels'] == cluster)[0]
+            member = members[partial['distances'][members].argmin()]
+            if partial['distances'][member] < best[cluster]:
+                best[cluster] = partial['distances'][member]
+                closest[cluster] = partial['indices'][member]
+        accumulated['labels'].append(partial['labels'].astype(np.int32))
+        return accumulated
+
+    def run(self, sources, executor=None, stripped=False):
+        '''Clusters the frames.
+
+        Parameters
+        ----------
+        sources : Simulation, str or list
+            Simulations (e.g. the replicas of an experiment) and/or
+            trajectory paths, whose frames are taken one after the other.
+
+        executor : AnalysisExecutor, optional
+            Executor used to read the frames and compute the features.
+            Defaults to one using every cpu.
+
+        stripped : bool, default=False
+            Use the stripped trajectories of the simulations.
+
+        Returns
+        -------
+        dict
+            The cluster of each frame ('labels', in the order of the frames
+            of the sources), the 'populations' and 'fractions' of the
+            clusters, the index of the frame closest to the centre of each
+            cluster ('representatives') and the cluster 'centres' (in feature
+            space), with the clusters sorted by population.
+        '''
+        from sklearn.cluster import MiniBatchKMeans
+
+        executor = executor or AnalysisExecutor()
+        atoms = self.selection.atoms
+
+        if self.features == 'landmarks':
+            chunks, _ = executor.chunks(executor.trajectories(sources, stripped))
+            if not chunks:
+                raise Exception('No frames to cluster')
+            n_frames = chunks[-1].offset + chunk_frames(chunks[-1], executor.stride)
+            indices = np.unique(np.linspace(0, n_frames - 1, self.n_landmarks).astype(int))
+            frames = executor.read_frames(sources, indices, atoms, stripped)
+            self.landmarks = frames.coordinates[:, self.selection.fit].astype(np.float64)
+
+        # Fit the model one batch at a time
+        self.model = MiniBatchKMeans(n_clusters=self.n_clusters, random_state=self.random_state,
+                                     batch_size=self.batch_size)
+        fitted = executor.run(sources, self.transform, self._fit,
+                              {'buffer': np.empty((0, 0)), 'n_frames': 0}, atoms, stripped)
+        if fitted['n_frames'] < self.n_clusters:
+            raise Exception(f"{fitted['n_frames']} frames can't be put into {self.n_clusters} clusters")
+        if len(fitted['buffer']):
+            if not hasattr(self.model, 'cluster_centers_') and len(fitted['buffer']) < self.n_clusters:
+                raise Exception('Not enough frames to initialise the clusters')
+            self.model.partial_fit(fitted['buffer'])
+
+        # Assign every frame to its closest centre
+        initial = {'labels': [],
+                   'closest': np.full(self.n_clusters, -1),
+                   'best': np.full(self.n_clusters, np.inf)}
+        assigned = executor.run(sources, self._assign, self._collect, initial, atoms, stripped)
+        labels = np.concatenate(assigned['labels'])
+
+        # Number the clusters from the most populated
+        populations = np.bincount(labels, minlength=self.n_clusters)
+        order = np.argsort(-populations, kind='stable')
+        rank = np.empty_like(order)
+        rank[order] = np.arange(self.n_clusters)
+        logger.info(f'Clustered {len(labels)} frames into {self.n_clusters} clusters')
+        return {'labels': rank[labels],
+                'populations': populations[order],
+                'fractions': populations[order] / len(labels),
+                'representatives': assigned['closest'][order],
+                'centres': self.model.cluster_centers_[order]}
+
+    def write_representatives(self, sources, result, directory='.', prefix='cluster',
+                              executor=None, stripped=False):
+        '''Writes the representative frame of each cluster (the protein
+        atoms, superimposed onto the reference) to PDB files, named like
+        cluster-1.pdb for the most populated cluster.
+
+        Returns
+        -------
+        list
+            Paths of the PDB files.
+        '''
+        executor = executor or AnalysisExecutor()
+        selection = self.selection
+        clusters = [cluster for cluster, index in enumerate(result['representatives'], start=1)
+                    if index >= 0]
+        indices = [result['representatives'][cluster - 1] for cluster in clusters]
+        frames = executor.read_frames(sources, indices, selection.atoms, stripped)
+        _, rotations, centres, reference_centre = kabsch(frames.coordinates[:, selection.fit],
+                                                         selection.reference[selection.fit],
+                                                         selection.weights)
+        aligned = np.einsum('fni,fij->fnj', frames.coordinates - centres[:, None, :], rotations)
+        aligned += reference_centre
+
+        os.makedirs(directory, exist_ok=True)
+        fnames = []
+        for cluster, coordinates in zip(clusters, aligned):
+            fname = os.path.join(directory, f'{prefix}-{cluster}.pdb')
+            write_pdb(fname, selection.topology, coordinates, selection.atoms)
+            fnames.append(fname)
+        return fnames
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains a contact analysis between the residues of a protein
+and cosolvent molecules.
+
+neighbour_pairs(a, b, cutoff, box=None)
+    Finds the pairs of atoms of two sets within a cutoff of each other with a
+    periodic cell list, in O(N).
+
+cosolvent_types(topology, cosolvents, exclude=None)
+    Returns the cosolvent type of each molecule of a topology.
+
+ContactAnalysis
+    Counts, over every frame of some trajectories, the cosolvent molecules of
+    each type in contact with each protein residue, and the fraction of
+    frames in which they are in contact. The frames are analysed in parallel
+    with AnalysisExecutor (see amberpy.analysis).
+
+A typical use would be:
+
+    from amberpy.contacts import ContactAnalysis
+
+    contacts = ContactAnalysis.from_experiment(replicas[0])
+    result = contacts.run(replicas)
+    print(result['frequency'])
+"""
+import logging
+
+import numpy as np
+
+from amberpy.analysis import AnalysisExecutor
+from amberpy.topology import Topology
+from amberpy.trajectory import box_vectors
+
+logger = logging.getLogger(__name__)
+
+def neighbour_pairs(a, b, cutoff, box=None):
+    '''Returns the pairs of atoms of a and b closer than a cutoff.
+
+    The atoms of b are sorted into a grid of cells at least the cutoff wide
+    (in fractional coordinates, so triclinic boxes such as truncated octahedra
+    are handled), and only the atoms in the 27 cells around each atom of a are
+    compared, using the minimum image.
+
+    Parameters
+    ----------
+    a, b : np.ndarray
+        (atoms, 3) coordinates.
+
+    cutoff : float
+        Distance cutoff in Angstroms.
+
+    box : np.ndarray, optional
+        Box lengths and angles [a, b, c, alpha, beta, gamma]. Without a box
+        (or if it is NaN) the atoms aren't periodic.
+
+    Returns
+    -------
+    tuple
+        Indices into a and b of each pair.
+    '''
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    if len(a) == 0 or len(b) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+    if box is None or np.isnan(box).any():
+
+        # A box large enough that no atoms meet through its walls
+        origin = np.minimum(a.min(axis=0), b.min(axis=0))
+        lengths = np.maximum(a.max(axis=0), b.max(axis=0)) - origin + 2 * cutoff
+        a, b = a - origin, b - origin
+        vectors = np.diag(lengths)
+    else:
+        vectors = box_vectors(box)
+
+    inverse = np.linalg.inv(vectors)
+    fa = (a @ inverse) % 1.0
+    fb = (b @ inverse) % 1.0
+
+    # Cells are at least the cutoff wide between opposite faces
+    volume = abs(np.linalg.det(vectors))
+    widths = volume / np.linalg.norm(np.cross(vectors[[1, 2, 0]], vectors[[2, 0, 1]]), axis=1)
+    n_cells = np.maximum((widths // cutoff).astype(int), 1)
+
+    cells_a = np.minimum((fa * n_cells).astype(int), n_cells - 1)
+    cells_b = np.minimum((fb * n_cells).astype(int), n_cells - 1)
+    ids_b = np.ravel_multi_index(cells_b.T, tuple(n_cells))
+    order = np.argsort(ids_b, kind='stable')
+    counts = np.bincount(ids_b, minlength=int(np.prod(n_cells)))
+    starts = np.cumsum(counts) - counts
+
+    # With fewer than 3 cells along an axis, the neighbouring cells repeat
+    shifts = [np.unique(np.arange(-1, 2) % n) for n in n_cells]
+    pairs_a = []
+    pairs_b = []
+    for dx in shifts[0]:
+        for dy in shifts[1]:
+            for dz in shifts[2]:
+                neighbours = (cells_a + (dx, dy, dz)) % n_cells
+                ids = np.ravel_multi_index(neighbours.T, tuple(n_cells))
+                n = counts[ids]
+                total = n.sum()
+                if total == 0:
+                    continue
+                i = np.repeat(np.arange(len(a)), n)
+                position = np.arange(total) - np.repeat(np.cumsum(n) - n, n)
+                pairs_a.append(i)
+                pairs_b.append(order[np.repeat(starts[ids], n) + position])
+
+    if not pairs_a:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    i = np.concatenate(pairs_a)
+    j = np.concatenate(pairs_b)
+    delta = fb[j] - fa[i]
+    delta -= np.round(delta)
+    distances = ((delta @ vectors) ** 2).sum(axis=1)
+    close = distances < cutoff ** 2
+    return i[close], j[close]
+
+def cosolvent_types(topology, cosolvents, exclude=None):
+    '''Returns the type of each molecule of a topology: the index of the
+    first cosolvent name among its residue names, or -1.
+
+    Parameters
+    ----------
+    topology : Topology
+        Topology of the system.
+
+    cosolvents : list
+        Cosolvent names.
+
+    exclude : np.ndarray, optional
+        Boolean mask of atoms which aren't cosolvent (e.g. the protein,
+        whose residue names can match amino acid cosolvents).
+    '''
+    molecules = topology.atom_molecules
+    residue_names = np.array(topology.residue_names)[topology.atom_residues]
+    if exclude is None:
+        exclude = np.zeros(topology.n_atoms, dtype=bool)
+    types = np.full(molecules.max() + 1, -1)
+    for t, name in reversed(list(enumerate(cosolvents))):
+        types[np.unique(molecules[(residue_names == name) & ~exclude])] = t
+    return types
+
+class ContactAnalysis:
+    '''Contacts between protein residues and cosolvent molecules.
+
+    A residue and a molecule are in contact in a frame if any of their atoms
+    (heavy atoms by default) are within the cutoff.
+
+    Attributes
+    ----------
+    topology : Topology
+        Topology of the trajectories.
+
+    cutoff : float
+        Contact distance in Angstroms.
+
+    residues : np.ndarray
+        Numbers (from 1) of the protein residues.
+
+    types : list
+        Cosolvent names (residue names that identify each type of molecule).
+
+    protein_atoms, cosolvent_atoms : np.ndarray
+        Indices of the atoms compared.
+    '''
+
+    def __init__(self, parm7, protein_residues, cosolvents, cutoff=4.0, heavy_atoms=True):
+        '''
+        Parameters
+        ----------
+        parm7 : str
+            Path of the topology of the trajectories.
+
+        protein_residues : list
+            (first, last) ranges of protein residue numbers (from 1, as given
+            by Experiment.protein_termini).
+
+        cosolvents : list
+            Cosolvent names. A molecule (outside the protein) containing a
+            residue of this name is a cosolvent molecule of this type.
+
+        cutoff : float, default=4.0
+            Contact distance in Angstroms.
+
+        heavy_atoms : bool, default=True
+            Only use the heavy atoms.
+        '''
+        self.topology = Topology(parm7)
+        self.cutoff = cutoff
+        self.types = list(cosolvents)
+
+        residue_numbers = self.topology.atom_residues + 1
+        protein = np.zeros(self.topology.n_atoms, dtype=bool)
+        for first, last in protein_residues:
+            protein |= (residue_numbers >= first) & (residue_numbers <= last)
+
+        molecules = self.topology.atom_molecules
+        molecule_types = cosolvent_types(self.topology, self.types, protein)
+        cosolvent = (molecule_types[molecules] >= 0) & ~protein
+
+        if heavy_atoms:
+            heavy = np.zeros(self.topology.n_atoms, dtype=bool)
+            heavy[self.topology.heavy_atoms] = True
+            protein &= heavy
+            cosolvent &= heavy
+
+        self.protein_atoms = np.nonzero(protein)[0]
+        self.cosolvent_atoms = np.nonzero(cosolvent)[0]
+        if len(self.protein_atoms) == 0:
+            raise Exception(f'No atoms of {parm7} are in residues {protein_residues}')
+        if len(self.cosolvent_atoms) == 0:
+            raise Exception(f'No molecules of {parm7} are cosolvents {self.types}')
+
+        self.residues, self._atom_residue = np.unique(self.topology.atom_residues[self.protein_atoms],
+                                                      return_inverse=True)
+        self.residues = self.residues + 1
+        cosolvent_molecules, self._atom_molecule = np.unique(molecules[self.cosolvent_atoms],
+                                                             return_inverse=True)
+        self._molecule_type = molecule_types[cosolvent_molecules]
+
+    @classmethod
+    def from_experiment(cls, experiment, stripped=False, **kwargs):
+        '''Returns the analysis of a ProteinCosolventExperiment. If stripped,
+        the stripped topology (see amberpy.reduction) is used.'''
+        parm7 = experiment.parm7
+        if stripped:
+            parm7 = experiment.reduction.stripped_parm7(experiment)
+        return cls(parm7, experiment.protein_termini, experiment.cosolvents, **kwargs)
+
+    @property
+    def atoms(self):
+        '''np.ndarray : Indices of the atoms read from the trajectories.'''
+        return np.concatenate([self.protein_atoms, self.cosolvent_atoms])
+
+    def map(self, frames):
+        '''Returns the residue x cosolvent type contact counts of a chunk of
+        frames (of the protein then cosolvent atoms).'''
+        n_protein = len(self.protein_atoms)
+        n_residues = len(self.residues)
+        n_types = len(self.types)
+        n_molecules = len(self._molecule_type)
+        counts = np.zeros(n_residues * n_types, dtype=np.int64)
+        frames_in_contact = np.zeros(n_residues * n_types, dtype=np.int64)
+
+        for coordinates, box in zip(frames.coordinates, frames.boxes):
+            i, j = neighbour_pairs(coordinates[:n_protein], coordinates[n_protein:], self.cutoff, box)
+
+            # Each residue-molecule pair is one contact
+            pairs = np.unique(self._atom_residue[i] * n_molecules + self._atom_molecule[j])
+            contacts = (pairs // n_molecules) * n_types + self._molecule_type[pairs % n_molecules]
+            counts += np.bincount(contacts, minlength=len(counts))
+            frames_in_contact[np.unique(contacts)] += 1
+
+        return {'counts': counts.reshape(n_residues, n_types),
+                'frames': frames_in_contact.reshape(n_residues, n_types),
+                'n_frames': len(frames)}
+
+    @staticmethod
+    def reduce(accumulated, partial):
+        '''Adds the counts of two chunks.'''
+        return {key: accumulated[key] + partial[key] for key in accumulated}
+
+    def run(self, sources, executor=None, stripped=False):
+        '''Runs the analysis.
+
+        Parameters
+        ----------
+        sources : Simulation, str or list
+            Simulations (e.g. the replicas of an experiment) and/or
+            trajectory paths.
+
+        executor : AnalysisExecutor, optional
+            Executor used to run the analysis. Defaults to one using every
+            cpu.
+
+        stripped : bool, default=False
+            Use the stripped trajectories of the simulations (the topology
+            must be the stripped one).
+
+        Returns
+        -------
+        dict
+            The protein 'residues' (numbers from 1), 'residue_names',
+            cosolvent 'types', the number of frames analysed ('n_frames') and
+            (residues, types) arrays of the total number of contacts
+            ('counts'), the mean number of molecules in contact per frame
+            ('mean_contacts') and the fraction of frames in which any molecule
+            is in contact ('frequency').
+        '''
+        executor = executor or AnalysisExecutor()
+        shape = (len(self.residues), len(self.types))
+        initial = {'counts': np.zeros(shape, dtype=np.int64),
+                   'frames': np.zeros(shape, dtype=np.int64),
+                   'n_frames': 0}
+        result = executor.run(sources, self.map, self.reduce, initial, self.atoms, stripped)
+        n_frames = result['n_frames']
+        if n_frames == 0:
+            raise Exception('No frames to analyse')
+        return {'residues': self.residues,
+                'residue_names': [self.topology.residue_names[r - 1] for r in self.residues],
+                'types': self.types,
+                'n_frames': n_frames,
+                'counts': result['counts'],
+                'mean_contacts': result['counts'] / n_frames,
+                'frequency': result['frames'] / n_frames}
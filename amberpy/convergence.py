@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains functions for deciding whether the observables of a
+simulation have converged, and a controller which uses them to stop
+production early.
+
+statistical_inefficiency
+    Estimates how many correlated samples of a time series are equivalent to
+    one independent sample.
+
+detect_equilibration
+    Finds the start of the equilibrated part of a time series, by maximising
+    the number of effectively independent samples after it.
+
+ConvergenceController
+    Checks the energies of a simulation between production segments and
+    decides whether the remaining segments can be cancelled.
+
+A typical use would be:
+
+    from amberpy.convergence import ConvergenceController
+
+    for i in range(10):
+        experiment.add_production_step(simulation_time=100)
+
+    controller = ConvergenceController(tolerances={'Etot': 1.0, 'Density': 0.0005})
+    experiment.run(scheduler=scheduler, convergence=controller)
+"""
+import json
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+def statistical_inefficiency(x, mintime=3):
+    '''Returns the statistical inefficiency, g, of a time series, i.e. the
+    number of samples per effectively independent sample. It is computed
+    from the autocorrelation function (using an FFT), which is integrated
+    until it first drops below zero after mintime samples.
+
+    Parameters
+    ----------
+    x : array_like
+        The time series.
+
+    mintime : int, default=3
+        Minimum number of lags to integrate the autocorrelation function
+        over.
+
+    Returns
+    -------
+    float
+        The statistical inefficiency (at least 1).
+    '''
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if n < 2:
+        return 1.0
+
+    dx = x - x.mean()
+    variance = dx.var()
+    if variance == 0:
+        return 1.0
+
+    # Autocorrelation function for lags 0 to n-1 (zero padded so that it
+    # isn't circular)
+    f = np.fft.rfft(dx, 2 * n)
+    acf = np.fft.irfft(f * np.conj(f))[:n] / (variance * np.arange(n, 0, -1))
+
+    t = np.arange(1, n)
+    stop = np.nonzero((acf[1:] <= 0) & (t > mintime))[0]
+    stop = stop[0] if len(stop) else n - 1
+
+    g = 1.0 + 2.0 * np.sum(acf[1:stop+1] * (1.0 - t[:stop] / n))
+    return max(float(g), 1.0)
+
+def detect_equilibration(x, n_points=50):
+    '''Finds the start of the equilibrated region of a time series.
+
+    The start, t0, is chosen to maximise the number of effectively
+    independent samples after it, (N - t0) / g.
+
+    Parameters
+    ----------
+    x : array_like
+        The time series.
+
+    n_points : int, default=50
+        Number of possible start points to try (evenly spaced over the
+        first half of the time series).
+
+    Returns
+    -------
+    tuple
+        (t0, g, n_effective): index of the start of the equilibrated region,
+        its statistical inefficiency and its number of effectively
+        independent samples.
+    '''
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if n < 2:
+        return 0, 1.0, float(n)
+
+    best = None
+    for t0 in np.unique(np.linspace(0, n // 2, n_points).astype(int)):
+        g = statistical_inefficiency(x[t0:])
+        n_effective = (n - t0) / g
+        if best is None or n_effective > best[2]:
+            best = (int(t0), g, n_effective)
+    return best
+
+class ConvergenceController:
+    '''Decides whether a simulation's production segments can stop.
+
+    After each production segment the energies of the production segments
+    run so far are read from the mdout files. For each observable, the
+    equilibrated region is detected and the standard error of its mean is
+    estimated from the number of effectively independent samples. The
+    simulation has converged when, for every observable:
+
+        - the equilibrated region starts in the first
+          max_equilibration_fraction of the data,
+        - there are at least min_effective_samples independent samples, and
+        - the standard error of the mean is below the observable's
+          tolerance.
+
+    Attributes
+    ----------
+    tolerances : dict
+        Maximum standard error of the mean of each observable, keyed by the
+        mdout label (e.g. 'Etot', 'Density', 'VOLUME').
+
+    min_effective_samples : float, default=50
+        Minimum number of effectively independent samples.
+
+    max_equilibration_fraction : float, default=0.5
+        Maximum fraction of the data that can be discarded as
+        equilibration.
+
+    min_segments : int, default=1
+        Minimum number of production segments run before stopping.
+
+    trajectory_observable : callable, optional
+        A cheap observable computed from the trajectory (e.g. the radius of
+        gyration). Called with (simulation, step_number), it should return a
+        1D array covering the production segments run so far.
+
+    trajectory_tolerance : float, optional
+        Tolerance of the trajectory observable.
+    '''
+
+    def __init__(self,
+                 tolerances=None,
+                 min_effective_samples=50,
+                 max_equilibration_fraction=0.5,
+                 min_segments=1,
+                 trajectory_observable=None,
+                 trajectory_tolerance=None):
+
+        if tolerances is None:
+            tolerances = {'Etot': 1.0, 'Density': 0.0005}
+
+        if trajectory_observable is not None and trajectory_tolerance is None:
+            raise Exception('A trajectory_tolerance must be given with a trajectory_observable')
+
+        self.tolerances = tolerances
+        self.min_effective_samples = min_effective_samples
+        self.max_equilibration_fraction = max_equilibration_fraction
+        self.min_segments = min_segments
+        self.trajectory_observable = trajectory_observable
+        self.trajectory_tolerance = trajectory_tolerance
+
+    def check(self, simulation, step_number):
+        '''Decides whether a simulation has converged after a production
+        step.
+
+        Parameters
+        ----------
+        simulation : Simulation
+            The simulation.
+
+        step_number : int
+            The production step that has just finished.
+
+        Returns
+        -------
+        tuple
+            (converged, evidence): whether the simulation has converged and
+            a dictionary of the metrics the decision was based on.
+        '''
+        production = [n for n, md_step in enumerate(simulation.md_steps[:step_number], start=1)
+                      if str(md_step) == 'production']
+        evidence = {'step': step_number,
+                    'segments': len(production),
+                    'observables': {}}
+
+        energies = simulation.read_energies()
+        mask = np.isin(energies.get('STEP', np.empty(0)), production)
+
+        series = {}
+        for observable in self.tolerances:
+            series[observable] = (energies[observable][mask] if observable in energies
+                                  else np.empty(0), self.tolerances[observable])
+        if self.trajectory_observable is not None:
+            series['trajectory'] = (np.asarray(self.trajectory_observable(simulation, step_number)),
+                                    self.trajectory_tolerance)
+
+        converged = len(production) >= self.min_segments
+        for observable, (x, tolerance) in series.items():
+            x = x[~np.isnan(x)]
+            metrics = self.metrics(x)
+            metrics['tolerance'] = tolerance
+            metrics['converged'] = bool(
+                len(x) > 1 and
+                metrics['t0'] <= self.max_equilibration_fraction * len(x) and
+                metrics['n_effective'] >= self.min_effective_samples and
+                metrics['sem'] <= tolerance)
+            evidence['observables'][observable] = metrics
+            converged = converged and metrics['converged']
+
+        evidence['converged'] = converged
+        logger.info(f"Convergence of '{simulation.name}' after step "
+                    f'{step_number}: {json.dumps(evidence)}')
+        return converged, evidence
+
+    @staticmethod
+    def metrics(x):
+        '''Returns the equilibration and sampling metrics of a time series
+        as a dictionary.
+        '''
+        if len(x) < 2:
+            return {'samples': len(x), 't0': 0, 'g': None, 'n_effective': float(len(x)),
+                    'mean': float(x[0]) if len(x) else None, 'sem': float('inf')}
+
+        t0, g, n_effective = detect_equilibration(x)
+        equilibrated = x[t0:]
+        sem = float(equilibrated.std(ddof=1) / np.sqrt(n_effective)) if len(equilibrated) > 1 else float('inf')
+        return {'samples': len(x),
+                't0': t0,
+                'g': g,
+                'n_effective': n_effective,
+                'mean': float(equilibrated.mean()),
+                'sem': sem}
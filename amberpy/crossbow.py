@@ -7,10 +7,12 @@ Created on Thu May 20 12:02:00 2021
 """
 import os
 import glob
+from types import MappingProxyType
 from longbow.entrypoints import longbow
 
 
-# Setup parameter dictionary 
+# Default parameters of every job. These are copied (not changed) for each
+# job, see CrossbowClient
 parameters = {'disconnect': False, 
               'job': '', 
               'hosts': os.path.expanduser('~/.amberpy/hosts.conf'),
@@ -19,6 +21,196 @@ parameters = {'disconnect': False,
               'resource': '',
               'sge-peflag': 'ib',}
 
+def pmemd_arguments(mdin, parm7, rst7, ref_rst7, minimisation=False):
+    '''Returns the pmemd command line arguments for an mdin file. The output
+    file names are generated from the name of the mdin file.
+    '''
+    mdout = mdin.replace('mdin', 'mdout')
+    mdinfo = mdin.replace('mdin', 'mdinfo')
+    out_rst7 = mdin.replace('mdin', 'rst7')
+    nc = mdin.replace('mdin', 'nc')
+
+    args = f'-O -i {mdin} -p {parm7} -c {rst7} -o {mdout} -r {out_rst7} -inf {mdinfo} -ref {ref_rst7}'
+
+    # If minimisation is set to true don't save the trajectory
+    if not minimisation:
+        args += f' -x {nc}'
+
+    return args
+
+class CrossbowClient:
+    '''Submits pmemd and cpptraj jobs to arc through longbow.
+
+    The client's settings are fixed when it is created and every job gets
+    its own copy of them, so nothing set for one job leaks into another and
+    a client can be shared between threads (e.g. a thread pool or an asyncio
+    executor) to run many jobs in parallel:
+
+        client = CrossbowClient()
+        with ThreadPoolExecutor() as executor:
+            futures = [executor.submit(client.run_pmemd, name, mdin, parm7, rst7, rst7,
+                                       localworkdir=directory) for ...]
+
+    Longbow saves the scheduler of a host to the hosts file the first time
+    the host is used, so the first job on a new host should be run on its
+    own.
+
+    Attributes
+    ----------
+    defaults : mappingproxy
+        Read-only longbow parameters shared by every job (the module's
+        parameters dictionary, updated with any given to the client).
+    '''
+
+    def __init__(self, **kwargs):
+        '''
+        Parameters
+        ----------
+        **kwargs
+            Longbow parameters to use instead of those in the module's
+            parameters dictionary, e.g. maxtime='24:00'.
+        '''
+        defaults = dict(parameters)
+        defaults.update(kwargs)
+        self.defaults = MappingProxyType(defaults)
+
+    def job_parameters(self, **kwargs):
+        '''Returns the read-only longbow parameters of a job: the client's
+        defaults updated with the given parameters.'''
+        job = dict(self.defaults)
+        job.update(kwargs)
+        return MappingProxyType(job)
+
+    def submit(self, job):
+        '''Runs a job (a mapping of longbow parameters) with longbow and
+        waits for it to finish.'''
+        # Longbow is given a private copy as it adds to the parameters
+        longbow({}, dict(job))
+
+    def run_pmemd(self,
+                  name, 
+                  mdin, 
+                  parm7, 
+                  rst7,
+                  ref_rst7,
+                  gpu=True,
+                  cores=None, 
+                  hold_jid='',
+                  arc=3,
+                  localworkdir='',
+                  minimisation=False,
+                  pollingfrequency=60,
+                  stagingfrequency=60,
+                  maxtime=None):
+        '''Runs pmemd on arc and waits for it to finish.
+
+        Returns
+        -------
+        int
+            0 if the job finished, 1 if it stopped because the periodic box
+            changed too much and 2 if it couldn't find a gpu.
+
+        The maxtime (walltime) of the job defaults to the client's.
+        '''
+        # Get the output file names from the inputs
+        mdout = mdin.replace('mdin', 'mdout')
+        mdinfo = mdin.replace('mdin', 'mdinfo')
+        out_rst7 = mdin.replace('mdin', 'rst7')
+        nc = mdin.replace('mdin', 'nc')
+
+        name = _job_name(name)
+        _remove_job_output(name, localworkdir)
+
+        # Ensure that only gpu OR cores have been specified
+        if gpu == True and cores is not None:
+            gpu = False
+        elif gpu == False and cores is None:
+            raise Exception("Please specify either gpu or cores")
+
+        job = self.job_parameters(
+            cores=str(cores) if cores is not None else str(0),
+            resource=_resource(arc, gpu=cores is None),
+            executableargs=pmemd_arguments(mdin, parm7, rst7, ref_rst7, minimisation),
+            log=os.path.join(localworkdir, f'{name}.log'),
+            hold_jid=hold_jid,
+            jobname=name,
+            maxtime=maxtime or self.defaults['maxtime'],
+            localworkdir=localworkdir,
+            **{'upload-include': ', '.join([mdin, parm7, rst7, ref_rst7]),
+               'upload-exclude': '*',
+               'download-include': ', '.join([mdout, mdinfo, out_rst7, nc, name+'.o*', name+'.e*']),
+               'download-exclude': '*',
+               'polling-frequency': pollingfrequency,
+               'staging-frequency': stagingfrequency})
+
+        self.submit(job)
+
+        if box_change_error(name, localworkdir):
+            return 1
+        elif cuda_error(name, localworkdir):
+            return 2
+        else:
+            return 0
+
+    def run_cpptraj(self,
+                    name, 
+                    cpptraj,
+                    nc, 
+                    parm7, 
+                    rst7,
+                    ref_parm7='',
+                    ref_rst7='',
+                    cores=1,
+                    hold_jid='',
+                    arc=3,
+                    localworkdir='',
+                    pollingfrequency=60,
+                    stagingfrequency=60):
+        '''Runs a cpptraj input file on arc and waits for it to finish.'''
+        name = _job_name(name)
+        _remove_job_output(name, localworkdir)
+
+        inputs = [f for f in (nc, parm7, ref_parm7, rst7, ref_rst7) if f]
+        job = self.job_parameters(
+            cores=str(cores),
+            resource=_resource(arc, gpu=False),
+            executableargs=f'cpptraj < {cpptraj}',
+            log=os.path.join(localworkdir, f'{name}.log'),
+            hold_jid=hold_jid,
+            jobname=name,
+            localworkdir=localworkdir,
+            **{'upload-include': ', '.join(inputs + [cpptraj]),
+               'upload-exclude': '*',
+               'download-include': '*',
+               'download-exclude': ', '.join(inputs),
+               'polling-frequency': pollingfrequency,
+               'staging-frequency': stagingfrequency})
+
+        self.submit(job)
+
+    def job_output(self, name, localworkdir=''):
+        '''Returns the contents of the downloaded job output/error files of
+        the last job with a name.'''
+        if name[0].isdigit():
+            name = 'a'+name
+        return job_output(name, localworkdir)
+
+def _job_name(name):
+    '''Job names on arc cannot start with a digit, so if name does, place an
+    'a' at the start.'''
+    if name[0].isdigit():
+        name = 'a'+name
+        print(f"Arc job name can't start with digit, changing to {name}")
+    return name
+
+def _remove_job_output(name, localworkdir):
+    '''Removes any job output/error files left by a previous job.'''
+    for f in glob.glob(os.path.join(localworkdir, f'{name}.[oe]*')):
+        os.remove(f)
+
+def _resource(arc, gpu):
+    return f"arc{arc}-{'gpu' if gpu else 'cpu'}"
+
 def run_cpptraj(name, 
           cpptraj,
           nc, 
@@ -26,56 +218,16 @@ def run_cpptraj(name,
           rst7,
           ref_parm7='',
           ref_rst7='',
+          cores=1,
+          hold_jid='',
           arc=3,
           localworkdir='',
           pollingfrequency=60,
           stagingfrequency=60):
-    
-    # Job names on arc cannot start with a digit, so if name does, place an 'a'
-    # at the start 
-    if name[0].isdigit():
-        name = 'a'+name
-        print(f"Arc job name can't start with digit, changing to {name}")
-
-    # Remove any job output/error files 
-    try:
-        for f in glob.glob(os.path.join(localworkdir, f'{name}.o*')):
-            os.remove(f)
-    except IndexError:
-        pass
-    try:
-        for f in glob.glob(os.path.join(localworkdir, f'{name}.e*')):
-            os.remove(f)
-    except IndexError:
-        pass   
-
-    parameters['cores'] = str(cores)
-    if arc == 3:
-        parameters['resource'] = 'arc3-cpu'
-    elif arc == 4:
-        parameters['resource'] = 'arc4-cpu'
-
-    
-    # Set exectutable arguments from inputs/outputs
-    parameters['executableargs'] = f'cpptraj < {cpptraj}'
-
-    # Add some extra parameters
-    parameters['log'] = os.path.join(localworkdir, f'{name}.log')
-    parameters['hold_jid'] = hold_jid
-    parameters['jobname'] = name
-    parameters['upload-include'] = ', '.join([nc, parm7, ref_parm7, rst7, ref_rst7])
-    parameters['upload-exclude'] = '*'
-    parameters['download-include'] = '*'
-    parameters['download-exclude'] = ', '.join([nc, parm7, ref_parm7, rst7, ref_rst7])
-    parameters['localworkdir'] = localworkdir
-    parameters['polling-frequency'] = pollingfrequency
-    parameters['staging-frequency'] = stagingfrequency
-    
-    # Run longbow with empty jobs list and parameters
-    jobs = {}
-    
-    longbow(jobs, parameters)
-
+    '''Runs cpptraj with a CrossbowClient using the module's parameters.'''
+    CrossbowClient().run_cpptraj(name, cpptraj, nc, parm7, rst7, ref_parm7, 
+                                 ref_rst7, cores, hold_jid, arc, localworkdir,
+                                 pollingfrequency, stagingfrequency)
 
 def run_pmemd(name, 
           mdin, 
@@ -89,107 +241,27 @@ def run_pmemd(name,
           localworkdir='',
           minimisation=False,
           pollingfrequency=60,
-          stagingfrequency=60):
-    
-    # Get the output file names from the inputs
-    mdout = mdin.replace('mdin', 'mdout')
-    mdinfo = mdin.replace('mdin', 'mdinfo')
-    out_rst7 = mdin.replace('mdin', 'rst7')
-    nc = mdin.replace('mdin', 'nc')
-    
-    # Job names on arc cannot start with a digit, so if name does, place an 'a'
-    # at the start 
-    if name[0].isdigit():
-        name = 'a'+name
-        print(f"Arc job name can't start with digit, changing to {name}")
-    
-
-    # Remove any job output/error files 
-    try:
-        for f in glob.glob(os.path.join(localworkdir, f'{name}.o*')):
-            os.remove(f)
-    except IndexError:
-        pass
-    try:
-        for f in glob.glob(os.path.join(localworkdir, f'{name}.e*')):
-            os.remove(f)
-    except IndexError:
-        pass   
-
-    
-        
-    # Ensure that only gpu OR cores have been specified
-    if gpu == True and cores is not None:
-        gpu = False
-    elif gpu == False and cores is None:
-        raise Exception("Please specify either gpu or cores")
-        
-    if cores is not None:
-        parameters['cores'] = str(cores)
-        if arc == 3:
-            parameters['resource'] = 'arc3-cpu'
-        elif arc == 4:
-            parameters['resource'] = 'arc4-cpu'
-            
-    # Set gpu/cpu parameters
-    elif gpu == True:
-        parameters['cores'] = str(0)
-        if arc == 3:
-            parameters['resource'] = 'arc3-gpu'
-        elif arc == 4:
-            parameters['resource'] = 'arc4-gpu'
-
-    
-    # Set exectutable arguments from inputs/outputs
-    parameters['executableargs'] = f'-O -i {mdin} -p {parm7} -c {rst7} -o {mdout} -r {out_rst7} -inf {mdinfo} -ref {ref_rst7} -x {nc}'
-    
-    # If minimisation is set to true don't save the trajectory 
-    if minimisation == True:
-        parameters['executableargs'] = f'-O -i {mdin} -p {parm7} -c {rst7} -o {mdout} -r {out_rst7} -inf {mdinfo} -ref {ref_rst7}'
-
-    # Add some extra parameters
-    parameters['log'] = os.path.join(localworkdir, f'{name}.log')
-    parameters['hold_jid'] = hold_jid
-    parameters['jobname'] = name
-    parameters['upload-include'] = ', '.join([mdin, parm7, rst7, ref_rst7])
-    parameters['upload-exclude'] = '*'
-    parameters['download-include'] = ', '.join([mdout, mdinfo, out_rst7, nc, name+'.o*', name+'.e*'])
-    parameters['download-exclude'] = '*'
-    parameters['localworkdir'] = localworkdir
-    parameters['polling-frequency'] = pollingfrequency
-    parameters['staging-frequency'] = stagingfrequency
-
-    # Run longbow with empty jobs list and parameters
-    jobs = {}
-    
-    longbow(jobs, parameters)
-    
-    if box_change_error(name, localworkdir):
-        return 1
-    elif not cuda_error:
-        return 2
-    else:
-        return 0
-    
-def box_change_error(name, localworkdir):
+          stagingfrequency=60,
+          maxtime=None):
+    '''Runs pmemd with a CrossbowClient using the module's parameters (see
+    CrossbowClient.run_pmemd).'''
+    return CrossbowClient().run_pmemd(name, mdin, parm7, rst7, ref_rst7, gpu,
+                                      cores, hold_jid, arc, localworkdir, 
+                                      minimisation, pollingfrequency,
+                                      stagingfrequency, maxtime)
 
-    for fname in glob.glob(os.path.join(localworkdir, f'{name}.o*')):
-    
+def job_output(name, localworkdir):
+    '''Returns the contents of the job output/error files of a job.'''
+    output = ''
+    for fname in sorted(glob.glob(os.path.join(localworkdir, f'{name}.[oe]*'))):
         with open(fname, 'r') as f:
-            if 'Periodic box dimensions have changed' in f.read():
-                return True
-            else:
-                return False
+            output += f.read()
+    return output
+
+def box_change_error(name, localworkdir):
+
+    return 'Periodic box dimensions have changed' in job_output(name, localworkdir)
 
 def cuda_error(name, localworkdir):
 
-    for fname in glob.glob(os.path.join(localworkdir, f'{name}.o*')):
-    
-        with open(fname, 'r') as f:
-            if 'cudaGetDeviceCount failed no CUDA-capable device is detected' in f.read():
-                return True
-            else:
-                pass
-        
-    return False
-    
\ No newline at end of file
+    return 'cudaGetDeviceCount failed no CUDA-capable device is detected' in job_output(name, localworkdir)
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains 3D grids and the cosolvent occupancy analysis which
+fills them.
+
+Grid
+    Values on a regular grid, which can be written to and read from OpenDX
+    (.dx) files (read by VMD, PyMOL and Chimera).
+
+OccupancyAnalysis
+    Superimposes every frame onto a reference structure of the protein and
+    counts the cosolvent atoms of each type in each grid cell, giving the
+    density of each cosolvent around the protein. The frames are analysed in
+    parallel with AnalysisExecutor (see amberpy.analysis).
+
+A typical use would be:
+
+    from amberpy.grids import OccupancyAnalysis
+
+    occupancy = OccupancyAnalysis.from_experiment(replicas[0], spacing=0.5)
+    result = occupancy.run(replicas)
+    for name, grid in result['grids'].items():
+        grid.write_dx(f'{name}.dx')
+"""
+import os
+import logging
+
+import numpy as np
+
+from amberpy.analysis import AnalysisExecutor
+from amberpy.contacts import cosolvent_types
+from amberpy.imaging import minimum_image
+from amberpy.rmsd import kabsch
+from amberpy.topology import Topology
+from amberpy.trajectory import read_restart, box_vectors
+
+logger = logging.getLogger(__name__)
+
+class Grid:
+    '''Values on a regular, rectangular grid.
+
+    Attributes
+    ----------
+    origin : np.ndarray
+        Coordinates of the centre of the first cell.
+
+    spacing : float
+        Width of the cells in Angstroms.
+
+    data : np.ndarray
+        (nx, ny, nz) values.
+    '''
+
+    def __init__(self, origin, spacing, data):
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.spacing = float(spacing)
+        self.data = np.asarray(data)
+
+    @classmethod
+    def around(cls, coordinates, spacing=0.5, padding=8.0):
+        '''Returns an empty grid covering some coordinates plus padding.'''
+        coordinates = np.asarray(coordinates)
+        low = coordinates.min(axis=0) - padding
+        high = coordinates.max(axis=0) + padding
+        shape = np.ceil((high - low) / spacing).astype(int) + 1
+        return cls(low, spacing, np.zeros(shape))
+
+    @property
+    def shape(self):
+        '''tuple : Number of cells along each axis.'''
+        return self.data.shape
+
+    @property
+    def volume(self):
+        '''float : Volume of a cell in cubic Angstroms.'''
+        return self.spacing ** 3
+
+    def points(self, indices=None):
+        '''Returns the coordinates of the centres of cells.
+
+        Parameters
+        ----------
+        indices : np.ndarray, optional
+            Flat indices of the cells. Defaults to every cell.
+        '''
+        if indices is None:
+            indices = np.arange(self.data.size)
+        return np.column_stack(np.unravel_index(indices, self.shape)) * self.spacing + self.origin
+
+    def cells(self, coordinates):
+        '''Returns the flat index of the cell each of some coordinates is
+        in (-1 if it is outside the grid).'''
+        ijk = np.floor((np.asarray(coordinates) - self.origin) / self.spacing + 0.5).astype(np.int64)
+        inside = ((ijk >= 0) & (ijk < self.shape)).all(axis=1)
+        cells = np.full(len(ijk), -1, dtype=np.int64)
+        cells[inside] = np.ravel_multi_index(ijk[inside].T, self.shape)
+        return cells
+
+    def write_dx(self, fname):
+        '''Writes the grid to an OpenDX file.'''
+        nx, ny, nz = self.shape
+        values = self.data.ravel().astype(np.float64)
+        with open(fname, 'w') as f:
+            f.write(f'object 1 class gridpositions counts {nx} {ny} {nz}\n')
+            f.write('origin {:.6f} {:.6f} {:.6f}\n'.format(*self.origin))
+            for axis in range(3):
+                delta = [0.0, 0.0, 0.0]
+                delta[axis] = self.spacing
+                f.write('delta {:.6f} {:.6f} {:.6f}\n'.format(*delta))
+            f.write(f'object 2 class gridconnections counts {nx} {ny} {nz}\n')
+            f.write(f'object 3 class array type double rank 0 items {values.size} data follows\n')
+            full = values.size - values.size % 3
+            np.savetxt(f, values[:full].reshape(-1, 3), fmt='%.6e')
+            if full < values.size:
+                np.savetxt(f, values[full:].reshape(1, -1), fmt='%.6e')
+            f.write('attribute "dep" string "positions"\n')
+            f.write('object "density" class field\n')
+            f.write('component "positions" value 1\n')
+            f.write('component "connections" value 2\n')
+            f.write('component "data" value 3\n')
+
+    @classmethod
+    def read_dx(cls, fname):
+        '''Reads a grid from an OpenDX file (with cells spaced equally along
+        the x, y and z axes).'''
+        shape = origin = None
+        deltas = []
+        values = []
+        with open(fname, 'r') as f:
+            for line in f:
+                words = line.split()
+                if not words or line.startswith('#'):
+                    continue
+                if 'gridpositions' in words:
+                    shape = tuple(int(n) for n in words[-3:])
+                elif words[0] == 'origin':
+                    origin = [float(x) for x in words[1:4]]
+                elif words[0] == 'delta':
+                    deltas.append([float(x) for x in words[1:4]])
+                elif words[0][0].isdigit() or words[0][0] in '-+.':
+                    values += [float(x) for x in words]
+        if shape is None or origin is None or len(deltas) != 3:
+            raise Exception(f'{fname} is not an OpenDX grid')
+        deltas = np.array(deltas)
+        if not np.allclose(deltas, np.diag(np.diag(deltas))) or not np.allclose(np.diag(deltas), deltas[0, 0]):
+            raise Exception(f'{fname} does not have equally spaced, axis aligned cells')
+        return cls(origin, deltas[0, 0], np.array(values).reshape(shape))
+
+class OccupancyAnalysis:
+    '''Density of each cosolvent type around a protein.
+
+    Each frame is superimposed onto the reference structure using the fit
+    atoms of the protein, after the cosolvent atoms have been moved to their
+    periodic images closest to the centre of the protein (see
+    amberpy.imaging.minimum_image). Heavy atoms are
+    counted.
+
+    Attributes
+    ----------
+    topology : Topology
+        Topology of the trajectories.
+
+    reference : np.ndarray
+        Reference coordinates of every atom.
+
+    grid : Grid
+        The (empty) grid the atoms are counted on.
+
+    types : list
+        Cosolvent names.
+
+    protein_atoms : np.ndarray
+        Indices of the protein (heavy) atoms.
+    '''
+
+    def __init__(self, parm7, reference, protein_residues, cosolvents, spacing=0.5, padding=8.0,
+                 fit=('CA',)):
+        '''
+        Parameters
+        ----------
+        parm7 : str
+            Path of the topology of the trajectories.
+
+        reference : str
+            Path of the reference structure (an rst7 file).
+
+        protein_residues : list
+            (first, last) ranges of protein residue numbers (from 1).
+
+        cosolvents : list
+            Cosolvent names (see amberpy.contacts.cosolvent_types).
+
+        spacing : float, default=0.5
+            Width of the grid cells in Angstroms.
+
+        padding : float, default=8.0
+            Distance the grid extends beyond the protein in Angstroms.
+
+        fit : list, default=('CA',)
+            Names of the protein atoms used for the superposition.
+        '''
+        self.topology = Topology(parm7)
+        self.types = list(cosolvents)
+
+        residue_numbers = self.topology.atom_residues + 1
+        protein = np.zeros(self.topology.n_atoms, dtype=bool)
+        for first, last in protein_residues:
+            protein |= (residue_numbers >= first) & (residue_numbers <= last)
+        heavy = np.isin(np.arange(self.topology.n_atoms), self.topology.heavy_atoms)
+
+        molecules = self.topology.atom_molecules
+        molecule_types = cosolvent_types(self.topology, self.types, protein)
+        cosolvent_atoms = np.nonzero((molecule_types[molecules] >= 0) & ~protein & heavy)[0]
+        if len(cosolvent_atoms) == 0:
+            raise Exception(f'No molecules of {parm7} are cosolvents {self.types}')
+        self._atom_type = molecule_types[molecules[cosolvent_atoms]]
+
+        self.protein_atoms = np.nonzero(protein & heavy)[0]
+        names = np.array(self.topology.atom_names)[self.protein_atoms]
+        self._fit = np.nonzero(np.isin(names, list(fit)))[0]
+        if len(self._fit) < 3:
+            raise Exception(f'Fewer than 3 protein atoms named {list(fit)} to superimpose')
+
+        self.reference, _ = read_restart(reference)
+        if len(self.reference) != self.topology.n_atoms:
+            raise Exception(f'{reference} has {len(self.reference)} atoms but {parm7} '
+                            f'has {self.topology.n_atoms}')
+        self.grid = Grid.around(self.reference[self.protein_atoms], spacing, padding)
+        self.atoms = np.concatenate([self.protein_atoms, cosolvent_atoms])
+
+    @classmethod
+    def from_experiment(cls, experiment, stripped=False, **kwargs):
+        '''Returns the analysis of a ProteinCosolventExperiment, using the
+        structure from its last finished minimisation step (or else the
+        structure made by tleap) as the reference.'''
+        reference = experiment.rst7
+        for step_number, md_step in enumerate(experiment.md_steps, start=1):
+            rst7 = os.path.join(experiment.simulation_directory,
+                                experiment._step_prefix(step_number) + '.rst7')
+            if str(md_step) == 'minimisation' and os.path.isfile(rst7) and os.path.getsize(rst7):
+                reference = rst7
+        parm7 = experiment.parm7
+        if stripped:
+            parm7 = experiment.reduction.stripped_parm7(experiment)
+        return cls(parm7, reference, experiment.protein_termini, experiment.cosolvents, **kwargs)
+
+    def map(self, frames):
+        '''Returns the number of cosolvent atoms of each type in each cell,
+        summed over a chunk of frames. Only the occupied cells are returned
+        (as flat indices into the (types, cells) counts), so partial results
+        stay small however large the grid is.'''
+        n_protein = len(self.protein_atoms)
+        reference = self.reference[self.protein_atoms][self._fit]
+        protein = frames.coordinates[:, :n_protein]
+        cosolvent = frames.coordinates[:, n_protein:].astype(np.float64)
+
+        # Move the cosolvent atoms to their images closest to the centre of
+        # the protein, which rounding alone doesn't find in triclinic boxes
+        volume = 0.0
+        periodic = ~np.isnan(frames.boxes).any(axis=1)
+        if periodic.any():
+            boxes = frames.boxes[periodic]
+            vectors = box_vectors(boxes)
+            volume = float(np.abs(np.linalg.det(vectors)).sum())
+            centre = protein[periodic].mean(axis=1, dtype=np.float64)[:, None, :]
+            triclinic = not np.allclose(boxes[:, 3:], 90.0)
+            cosolvent[periodic] = centre + minimum_image(cosolvent[periodic] - centre, vectors,
+                                                         search=triclinic)
+
+        _, rotations, centres, reference_centre = kabsch(protein[:, self._fit], reference)
+        aligned = np.einsum('fni,fij->fnj', cosolvent - centres[:, None, :], rotations) + reference_centre
+
+        n_cells = self.grid.data.size
+        cells = self.grid.cells(aligned.reshape(-1, 3))
+        types = np.tile(self._atom_type, len(frames))
+        inside = cells >= 0
+        occupied, counts = np.unique(types[inside] * n_cells + cells[inside], return_counts=True)
+        return {'cells': occupied,
+                'counts': counts,
+                'n_frames': len(frames),
+                'n_periodic': int(periodic.sum()),
+                'volume': volume}
+
+    @staticmethod
+    def reduce(accumulated, partial):
+        '''Adds the counts of a chunk to the (types, cells) counts.'''
+        accumulated['counts'].reshape(-1)[partial['cells']] += partial['counts']
+        accumulated['n_frames'] += partial['n_frames']
+        accumulated['n_periodic'] += partial['n_periodic']
+        accumulated['volume'] += partial['volume']
+        return accumulated
+
+    def run(self, sources, executor=None, stripped=False):
+        '''Runs the analysis.
+
+        Parameters
+        ----------
+        sources : Simulation, str or list
+            Simulations (e.g. the replicas of an experiment) and/or
+            trajectory paths.
+
+        executor : AnalysisExecutor, optional
+            Executor used to run the analysis. Defaults to one using every
+            cpu.
+
+        stripped : bool, default=False
+            Use the stripped trajectories of the simulations.
+
+        Returns
+        -------
+        dict
+            The density Grid (atoms per cubic Angstrom) of each cosolvent
+            type ('grids'), the 'bulk' density of each type (its number of
+            atoms over the mean volume of the box in the frames with a box,
+            NaN if there are none) and 'n_frames'.
+        '''
+        executor = executor or AnalysisExecutor()
+        initial = {'counts': np.zeros((len(self.types), self.grid.data.size), dtype=np.int64),
+                   'n_frames': 0,
+                   'n_periodic': 0,
+                   'volume': 0.0}
+        result = executor.run(sources, self.map, self.reduce, initial, self.atoms, stripped)
+        n_frames = result['n_frames']
+        if n_frames == 0:
+            raise Exception('No frames to analyse')
+
+        grids = {}
+        bulk = {}
+        mean_volume = result['volume'] / result['n_periodic'] if result['n_periodic'] else np.nan
+        for t, name in enumerate(self.types):
+            density = result['counts'][t].reshape(self.grid.shape) / (n_frames * self.grid.volume)
+            grids[name] = Grid(self.grid.origin, self.grid.spacing, density)
+            bulk[name] = np.count_nonzero(self._atom_type == t) / mean_volume
+        return {'grids': grids, 'bulk': bulk, 'n_frames': n_frames}
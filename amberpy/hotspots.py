@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the detection of cosolvent hotspots from occupancy
+grids.
+
+free_energy_grid(grid, bulk, temperature=300.0)
+    Converts a density grid into a grid of free energies relative to the
+    bulk density, -kT ln(density / bulk).
+
+Hotspot
+    A connected cluster of grid cells with a low free energy, with its score
+    (integrated free energy) and the protein residues next to it.
+
+find_hotspots(grid, bulk, ...)
+    Thresholds a free energy grid, labels its connected components in 3D and
+    returns the clusters as Hotspots ranked by score.
+
+A typical use would be:
+
+    from amberpy.grids import OccupancyAnalysis
+    from amberpy.hotspots import find_hotspots
+
+    occupancy = OccupancyAnalysis.from_experiment(replicas[0])
+    result = occupancy.run(replicas)
+    hotspots = find_hotspots(result['grids']['BEN'], result['bulk']['BEN'],
+                             protein=occupancy)
+    for hotspot in hotspots[:5]:
+        print(hotspot.score, hotspot.residues)
+"""
+import logging
+
+import numpy as np
+
+from amberpy.grids import Grid
+from amberpy.residence import GridSite
+
+logger = logging.getLogger(__name__)
+
+# Boltzmann constant in kcal/mol/K
+BOLTZMANN = 0.0019872041
+
+def free_energy_grid(grid, bulk, temperature=300.0):
+    '''Returns the free energy (kcal/mol) of each cell of a density grid
+    relative to the bulk density, -kT ln(density / bulk). Empty cells are
+    NaN.'''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        energy = -BOLTZMANN * temperature * np.log(grid.data / bulk)
+    energy[~np.isfinite(energy)] = np.nan
+    return Grid(grid.origin, grid.spacing, energy)
+
+class Hotspot:
+    '''A cluster of grid cells where a cosolvent is enriched.
+
+    Attributes
+    ----------
+    rank : int
+        Position when the hotspots are sorted by score (from 1).
+
+    cells : np.ndarray
+        Flat indices of the grid cells.
+
+    points : np.ndarray
+        (cells, 3) coordinates of the cell centres.
+
+    centre : np.ndarray
+        Density weighted centre.
+
+    volume : float
+        Volume in cubic Angstroms.
+
+    score : float
+        Integrated free energy: the sum of the free energies (kcal/mol) of
+        the cells. The more negative, the stronger the hotspot.
+
+    min_free_energy : float
+        Lowest free energy of a cell in kcal/mol.
+
+    residues : list
+        Numbers (from 1) of the protein residues within the cutoff of the
+        hotspot.
+
+    residue_names : list
+        Names of those residues.
+    '''
+
+    def __init__(self, rank, cells, points, centre, volume, score, min_free_energy,
+                 residues=None, residue_names=None):
+        self.rank = rank
+        self.cells = cells
+        self.points = points
+        self.centre = centre
+        self.volume = volume
+        self.score = score
+        self.min_free_energy = min_free_energy
+        self.residues = residues or []
+        self.residue_names = residue_names or []
+
+    def site(self, cutoff=1.5):
+        '''Returns the hotspot as a binding site for
+        amberpy.residence.ResidenceAnalysis.'''
+        return GridSite(self.points, name=f'hotspot-{self.rank}', cutoff=cutoff)
+
+    def __repr__(self):
+        return (f'Hotspot(rank={self.rank}, score={self.score:.2f}, '
+                f'volume={self.volume:.1f}, residues={self.residues})')
+
+def find_hotspots(grid, bulk, protein=None, temperature=300.0, threshold=-1.0, min_volume=1.0,
+                  cutoff=4.0, connectivity=1):
+    '''Finds the hotspots in a density grid.
+
+    Parameters
+    ----------
+    grid : Grid
+        Density of a cosolvent (see amberpy.grids.OccupancyAnalysis).
+
+    bulk : float
+        Bulk density of the cosolvent.
+
+    protein : OccupancyAnalysis or tuple, optional
+        The analysis the grid came from, or (coordinates, residue numbers,
+        residue names) of the protein atoms, in the frame of the grid. Used
+        to find the residues next to each hotspot.
+
+    temperature : float, default=300.0
+        Temperature in K.
+
+    threshold : float, default=-1.0
+        Highest free energy (kcal/mol) of a cell in a hotspot.
+
+    min_volume : float, default=1.0
+        Smallest volume of a hotspot in cubic Angstroms.
+
+    cutoff : float, default=4.0
+        Distance from a hotspot cell within which residues are next to it.
+
+    connectivity : int, default=1
+        Cells are connected through faces (1), edges (2) or corners (3).
+
+    Returns
+    -------
+    list
+        Hotspots, best (most negative score) first.
+    '''
+    from scipy import ndimage
+    from scipy.spatial import cKDTree
+
+    energy = free_energy_grid(grid, bulk, temperature).data
+    mask = np.nan_to_num(energy, nan=np.inf) <= threshold
+    structure = ndimage.generate_binary_structure(3, connectivity)
+    labels, n_labels = ndimage.label(mask, structure=structure)
+    if n_labels == 0:
+        return []
+
+    # Statistics of every cluster at once
+    labels = labels.ravel()
+    cells = np.nonzero(labels)[0]
+    cell_labels = labels[cells]
+    cell_energy = energy.ravel()[cells]
+    cell_density = grid.data.ravel()[cells]
+    n_cells = np.bincount(cell_labels, minlength=n_labels + 1)
+    scores = np.bincount(cell_labels, cell_energy, minlength=n_labels + 1)
+    minima = np.full(n_labels + 1, np.inf)
+    np.minimum.at(minima, cell_labels, cell_energy)
+    points = grid.points(cells)
+    weights = np.bincount(cell_labels, cell_density, minlength=n_labels + 1)
+    centres = np.column_stack([np.bincount(cell_labels, cell_density * points[:, axis], minlength=n_labels + 1)
+                               for axis in range(3)]) / np.maximum(weights, 1e-300)[:, None]
+
+    # Residues within the cutoff of each cluster's cells
+    residues = {}
+    if protein is not None:
+        if hasattr(protein, 'protein_atoms'):
+            atoms = protein.protein_atoms
+            coordinates = protein.reference[atoms]
+            numbers = protein.topology.atom_residues[atoms] + 1
+            names = np.array(protein.topology.residue_names)[numbers - 1]
+        else:
+            coordinates, numbers, names = protein
+            numbers = np.asarray(numbers)
+            names = np.asarray(names)
+        pairs = cKDTree(points).sparse_distance_matrix(cKDTree(coordinates), cutoff, output_type='ndarray')
+        near = np.unique(np.column_stack([cell_labels[pairs['i']], numbers[pairs['j']]]), axis=0)
+        for label, number in near:
+            residues.setdefault(label, []).append(number)
+        residue_names = {number: name for number, name in zip(numbers, names)}
+
+    order = np.argsort(cell_labels, kind='stable')
+    bounds = np.cumsum(n_cells)
+    hotspots = []
+    for label in range(1, n_labels + 1):
+        volume = n_cells[label] * grid.volume
+        if volume < min_volume:
+            continue
+        members = order[bounds[label - 1]:bounds[label]]
+        numbers = [int(n) for n in residues.get(label, [])]
+        hotspots.append(Hotspot(0, cells[members], points[members], centres[label], volume,
+                                float(scores[label]), float(minima[label]), numbers,
+                                [residue_names[n] for n in numbers] if numbers else []))
+
+    hotspots.sort(key=lambda hotspot: hotspot.score)
+    for rank, hotspot in enumerate(hotspots, start=1):
+        hotspot.rank = rank
+    logger.info(f'Found {len(hotspots)} hotspots below {threshold} kcal/mol')
+    return hotspots
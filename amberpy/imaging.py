@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains a vectorized equivalent of cpptraj's autoimage, applied
+to chunks of frames as they are read.
+
+AutoImager
+    Makes every molecule whole (following the bonds in the topology),
+    centres an anchor (e.g. the protein) in the box and moves every other
+    molecule to the periodic image whose centre is closest to the anchor.
+    Rectangular and truncated octahedral (or any triclinic) boxes are
+    supported, the latter being imaged into the familiar truncated
+    octahedron shape. It is used as a transform of the trajectory readers,
+    so trajectories written with iwrap=1 are imaged as they are analysed
+    rather than by rewriting them with cpptraj.
+
+A typical use would be:
+
+    from amberpy.analysis import AnalysisExecutor
+    from amberpy.imaging import AutoImager
+    from amberpy.contacts import ContactAnalysis
+
+    imager = AutoImager.from_experiment(replicas[0])
+    executor = AnalysisExecutor(transforms=[imager])
+    result = ContactAnalysis.from_experiment(replicas[0]).run(replicas, executor)
+"""
+import logging
+import itertools
+
+import numpy as np
+
+from amberpy.topology import Topology
+from amberpy.trajectory import Frames, box_vectors
+
+logger = logging.getLogger(__name__)
+
+# Lattice translations searched for the closest image in triclinic boxes
+_SHIFTS = np.array(list(itertools.product((-1, 0, 1), repeat=3)), dtype=np.float64)
+
+def minimum_image(delta, vectors, search=False):
+    '''Returns the periodic images of displacements closest to zero.
+
+    Parameters
+    ----------
+    delta : np.ndarray
+        (frames, n, 3) displacements.
+
+    vectors : np.ndarray
+        (frames, 3, 3) box vectors (as rows).
+
+    search : bool, default=False
+        Also try the neighbouring images. Without this, the image is found by
+        rounding fractional coordinates, which is exact for rectangular boxes
+        and for displacements shorter than half of the box's narrowest width
+        (e.g. bonds) in triclinic boxes.
+    '''
+    inverse = np.linalg.inv(vectors)
+    fractional = np.einsum('fni,fij->fnj', delta, inverse)
+    fractional -= np.round(fractional)
+    delta = np.einsum('fni,fij->fnj', fractional, vectors)
+    if search:
+
+        # One frame at a time to keep the 27 candidates of each small
+        for f in range(len(delta)):
+            candidates = delta[f, :, None, :] + (_SHIFTS @ vectors[f])[None]
+            closest = (candidates ** 2).sum(axis=2).argmin(axis=1)
+            delta[f] = candidates[np.arange(len(closest)), closest]
+    return delta
+
+class AutoImager:
+    '''Images chunks of frames around an anchor.
+
+    Attributes
+    ----------
+    topology : Topology
+        Topology of the trajectories.
+
+    anchor : np.ndarray
+        Indices of the atoms which are centred in the box.
+
+    make_whole : bool
+        Rejoin molecules split across the box by following their bonds.
+
+    centre : bool
+        Move the anchor to the centre of the box (the origin for triclinic
+        boxes, as for cpptraj's familiar truncated octahedron).
+    '''
+
+    def __init__(self, parm7, anchor=None, make_whole=True, centre=True):
+        '''
+        Parameters
+        ----------
+        parm7 : str or Topology
+            Topology of the trajectories.
+
+        anchor : list, optional
+            (first, last) ranges of residue numbers (from 1) of the anchor,
+            e.g. Experiment.protein_termini. Defaults to the first molecule.
+
+        make_whole : bool, default=True
+            Rejoin molecules split across the box.
+
+        centre : bool, default=True
+            Move the anchor to the centre of the box.
+        '''
+        self.topology = parm7 if isinstance(parm7, Topology) else Topology(parm7)
+        self.make_whole = make_whole
+        self.centre = centre
+        molecules = self.topology.atom_molecules
+
+        if anchor is None:
+            self.anchor = np.nonzero(molecules == 0)[0]
+        else:
+            residue_numbers = self.topology.atom_residues + 1
+            mask = np.zeros(self.topology.n_atoms, dtype=bool)
+            for first, last in anchor:
+                mask |= (residue_numbers >= first) & (residue_numbers <= last)
+            self.anchor = np.nonzero(mask)[0]
+        if len(self.anchor) == 0:
+            raise Exception(f'The anchor {anchor} has no atoms')
+
+        # The atoms are sorted by molecule to sum the molecule centres
+        self._order = np.argsort(molecules, kind='stable')
+        self._molecule_starts = np.searchsorted(molecules[self._order], np.arange(molecules.max() + 1))
+        self._molecule_sizes = np.bincount(molecules)
+        self._atom_molecule = molecules
+        self._anchor_molecules = np.unique(molecules[self.anchor])
+        self._levels = self._bond_levels() if make_whole else []
+
+    @classmethod
+    def from_experiment(cls, experiment, stripped=False, **kwargs):
+        '''Returns the imager of an experiment, anchored on its protein. If
+        stripped, the stripped topology (see amberpy.reduction) is used.'''
+        parm7 = experiment.parm7
+        if stripped:
+            parm7 = experiment.reduction.stripped_parm7(experiment)
+        return cls(parm7, experiment.protein_termini, **kwargs)
+
+    def _bond_levels(self):
+        '''Returns, for each distance along the bonds from the first atom of
+        a molecule, the atoms that far away and the atoms they are bonded to
+        one step closer. Moving each level next to the previous one in turn
+        makes the molecules whole.'''
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import breadth_first_order
+
+        n_atoms = self.topology.n_atoms
+        bonds = self.topology.bonds
+
+        # A virtual atom bonded to the first atom of every molecule makes
+        # one tree of all of the molecules
+        _, roots = np.unique(self._atom_molecule, return_index=True)
+        rows = np.concatenate([bonds[:, 0], np.full(len(roots), n_atoms)])
+        columns = np.concatenate([bonds[:, 1], roots])
+        graph = coo_matrix((np.ones(len(rows)), (rows, columns)), shape=(n_atoms + 1, n_atoms + 1))
+        order, parents = breadth_first_order(graph.tocsr(), n_atoms, directed=False,
+                                             return_predecessors=True)
+
+        depth = np.zeros(n_atoms + 1, dtype=int)
+        for atom in order[1:]:
+            depth[atom] = depth[parents[atom]] + 1
+        atoms = order[1:]
+        atoms = atoms[np.argsort(depth[atoms], kind='stable')]
+        levels = np.split(atoms, np.cumsum(np.bincount(depth[atoms]))[1:-1])
+        return [(members, parents[members]) for members in levels[1:]]
+
+    def __call__(self, frames):
+        '''Returns the imaged frames. Frames without a box are returned
+        unchanged.'''
+        periodic = ~np.isnan(frames.boxes).any(axis=1)
+        if not periodic.any():
+            return frames
+        coordinates = np.array(frames.coordinates, dtype=np.float64)
+        coordinates[periodic] = self.image(coordinates[periodic], frames.boxes[periodic])
+        return Frames(coordinates.astype(frames.coordinates.dtype, copy=False),
+                      frames.boxes, frames.times, frames.indices)
+
+    def image(self, coordinates, boxes):
+        '''Images (frames, atoms, 3) coordinates with (frames, 6) boxes.'''
+        if coordinates.shape[1] != self.topology.n_atoms:
+            raise Exception(f'The frames have {coordinates.shape[1]} atoms but the topology '
+                            f'has {self.topology.n_atoms}')
+        vectors = box_vectors(boxes)
+        triclinic = not np.allclose(boxes[:, 3:], 90.0)
+
+        for atoms, parents in self._levels:
+            delta = coordinates[:, atoms] - coordinates[:, parents]
+            coordinates[:, atoms] = coordinates[:, parents] + minimum_image(delta, vectors)
+
+        # Gather the anchor's molecules (e.g. protein chains) around its
+        # first molecule, then move every other molecule's centre to its
+        # image closest to the anchor
+        centres = self._centres(coordinates)
+        delta = centres[:, self._anchor_molecules] - centres[:, self._anchor_molecules[:1]]
+        shifts = np.zeros_like(centres)
+        shifts[:, self._anchor_molecules] = minimum_image(delta, vectors, search=triclinic) - delta
+        coordinates += shifts[:, self._atom_molecule]
+
+        anchor = coordinates[:, self.anchor].mean(axis=1)
+        delta = self._centres(coordinates) - anchor[:, None, :]
+        shifts = minimum_image(delta, vectors, search=triclinic) - delta
+        shifts[:, self._anchor_molecules] = 0.0
+        coordinates += shifts[:, self._atom_molecule]
+
+        if self.centre:
+            anchor = coordinates[:, self.anchor].mean(axis=1)
+            target = np.zeros_like(anchor) if triclinic else vectors.sum(axis=1) / 2
+            coordinates += (target - anchor)[:, None, :]
+        return coordinates
+
+    def _centres(self, coordinates):
+        '''Returns the (frames, molecules, 3) centres of the molecules.'''
+        sums = np.add.reduceat(coordinates[:, self._order], self._molecule_starts, axis=1)
+        return sums / self._molecule_sizes[None, :, None]
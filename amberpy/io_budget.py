@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains a planner for the output frequencies of a simulation
+(ntwx, ntwr, ntpr and ntwv) which keeps its output within a disk and transfer
+budget.
+
+IOBudget
+    Sets the output frequencies of each MD step from the frame, restart and
+    energy spacing (in ps) wanted for analysis, predicts the size of the
+    output from the number of atoms in the parm7 file and warns before
+    submission if the budget would be exceeded.
+
+A typical use would be:
+
+    from amberpy.io_budget import IOBudget
+
+    budget = IOBudget(disk='20G', transfer='10G', frame_spacing=100)
+    budget.plan(experiment)
+    experiment.run()
+"""
+import os
+import math
+import re
+import logging
+
+from amberpy.topology import Topology
+
+logger = logging.getLogger(__name__)
+
+# Approximate size of one energy record in an mdout file, and of the rest of
+# the file (header, averages and timings)
+MDOUT_RECORD_SIZE = 900
+MDOUT_OVERHEAD = 30000
+
+# Approximate size of a NetCDF header
+NETCDF_HEADER_SIZE = 4096
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+def parse_size(size):
+    '''Returns the number of bytes in a size given as a number or a string
+    like '500M' or '20G'.'''
+    if size is None or isinstance(size, (int, float)):
+        return size
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)B?\s*', size.upper())
+    if match is None:
+        raise Exception(f'Could not understand the size {size}')
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+def format_size(size):
+    '''Returns a number of bytes as a human readable string.'''
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}T'
+
+def frame_size(n_atoms, ioutfm=1, velocities=False):
+    '''Returns the number of bytes written to the trajectory for each frame.
+
+    NetCDF trajectories (ioutfm=1) store coordinates (and velocities) as 4
+    byte floats plus the box and time, ASCII trajectories use 8 characters
+    per coordinate with 10 to a line.
+    '''
+    if ioutfm == 1:
+        return 12 * n_atoms * (2 if velocities else 1) + 52
+    return (math.ceil(3 * n_atoms / 10) * 81 + 25) * (2 if velocities else 1)
+
+def restart_size(n_atoms, ntxo=2):
+    '''Returns the number of bytes in a restart file (coordinates and
+    velocities).
+
+    NetCDF restart files (ntxo=2) store 8 byte floats, ASCII restart files use
+    12 characters per value with 6 to a line.
+    '''
+    if ntxo == 2:
+        return 48 * n_atoms + 52 + NETCDF_HEADER_SIZE
+    return 2 * math.ceil(3 * n_atoms / 6) * 73 + 150
+
+class IOBudget:
+    '''Plans the output frequencies of a simulation to fit a disk and
+    transfer budget.
+
+    Attributes
+    ----------
+    disk : int or str, optional
+        Disk space the outputs of the simulation may use on the remote
+        filesystem, in bytes or as a string like '20G'.
+
+    transfer : int or str, optional
+        Amount of data that may be transferred (uploaded inputs and
+        downloaded outputs) for the simulation.
+
+    frame_spacing : float, default=100.0
+        Time between trajectory frames in ps (sets ntwx).
+
+    restart_spacing : float, default=100.0
+        Time between restart files in ps (sets ntwr). It is rounded to a
+        multiple of the frame spacing, so that a step continued from a
+        restart file doesn't repeat frames.
+
+    energy_spacing : float, default=4.0
+        Time between energy records in ps (sets ntpr).
+
+    velocities : bool, default=False
+        Write velocities to the trajectory (sets ntwv=-1).
+
+    fit : bool, default=False
+        If the outputs would exceed the disk or transfer budget, write frames
+        and energies less often until they fit, rather than only warning.
+    '''
+
+    def __init__(self,
+                 disk=None,
+                 transfer=None,
+                 frame_spacing=100.0,
+                 restart_spacing=100.0,
+                 energy_spacing=4.0,
+                 velocities=False,
+                 fit=False):
+
+        self.disk = parse_size(disk)
+        self.transfer = parse_size(transfer)
+        self.frame_spacing = frame_spacing
+        self.restart_spacing = restart_spacing
+        self.energy_spacing = energy_spacing
+        self.velocities = velocities
+        self.fit = fit
+
+    def plan(self, simulation):
+        '''Sets the output frequencies of each MD step of a simulation and
+        checks the predicted output size against the budget.
+
+        The budget is kept with the simulation, so it is checked again before
+        the simulation is submitted.
+
+        Parameters
+        ----------
+        simulation : Simulation
+            Simulation whose steps have been added.
+
+        Returns
+        -------
+        dict
+            Predicted output size in bytes (see estimate).
+        '''
+        for md_step in self._md_steps(simulation):
+            dt = md_step.arg_dict['dt']
+            ntwx = max(1, round(self.frame_spacing / dt))
+            self._set(md_step, 'ntwx', ntwx)
+            self._set(md_step, 'ntwr', self._restart_frequency(dt, ntwx))
+            self._set(md_step, 'ntpr', max(1, round(self.energy_spacing / dt)))
+            self._set(md_step, 'ntwv', -1 if self.velocities else 0)
+
+        estimate = self.estimate(simulation)
+        if self.fit and not self._fits(estimate):
+            self._fit(simulation, estimate)
+            estimate = self.estimate(simulation)
+
+        simulation.io_budget = self
+        self.check(simulation, estimate)
+        return estimate
+
+    def estimate(self, simulation):
+        '''Predicts the size of the outputs of a simulation.
+
+        Returns
+        -------
+        dict
+            Bytes written to 'trajectory', 'restart' and 'mdout' files, their
+            sum ('disk') and the bytes transferred ('transfer', the outputs
+            plus the uploaded inputs).
+        '''
+        n_atoms = Topology(simulation.parm7).n_atoms
+
+        sizes = {'trajectory': 0, 'restart': 0, 'mdout': 0}
+        for md_step in simulation.md_steps:
+            args = md_step.arg_dict
+            sizes['restart'] += restart_size(n_atoms, args.get('ntxo', 2))
+            sizes['mdout'] += MDOUT_OVERHEAD
+            if args.get('imin') == 1:
+                sizes['mdout'] += args.get('maxcyc', 0) // args['ntpr'] * MDOUT_RECORD_SIZE
+                continue
+
+            nstlim = args['nstlim']
+            sizes['mdout'] += nstlim // args['ntpr'] * MDOUT_RECORD_SIZE
+            if args.get('ntwx'):
+                velocities = args.get('ntwv') == -1
+                sizes['trajectory'] += (nstlim // args['ntwx'] *
+                                        frame_size(n_atoms, args.get('ioutfm', 1), velocities) +
+                                        NETCDF_HEADER_SIZE)
+
+        sizes['disk'] = sum(sizes.values())
+        sizes['transfer'] = sizes['disk'] + sum(os.path.getsize(f) for f in
+                                                {simulation.parm7, simulation.rst7, simulation.ref_rst7}
+                                                if os.path.isfile(f))
+        return sizes
+
+    def check(self, simulation, estimate=None):
+        '''Logs the predicted output size of a simulation and warns if it
+        exceeds the budget.
+
+        Returns
+        -------
+        bool
+            True if the outputs fit within the budget.
+        '''
+        if estimate is None:
+            estimate = self.estimate(simulation)
+
+        logger.info(f"Predicted output of '{simulation.name}': "
+                    f"{format_size(estimate['disk'])} on disk "
+                    f"(trajectory {format_size(estimate['trajectory'])}, "
+                    f"restart {format_size(estimate['restart'])}, "
+                    f"mdout {format_size(estimate['mdout'])}), "
+                    f"{format_size(estimate['transfer'])} transferred")
+
+        fits = True
+        for kind in ('disk', 'transfer'):
+            budget = getattr(self, kind)
+            if budget is not None and estimate[kind] > budget:
+                fits = False
+                logger.warning(f"The {kind} budget of '{simulation.name}' "
+                               f"({format_size(budget)}) would be exceeded: "
+                               f"{format_size(estimate[kind])} predicted. Write frames "
+                               f"less often, strip the trajectories or raise the budget")
+        return fits
+
+    def _fits(self, estimate):
+        return all(getattr(self, kind) is None or estimate[kind] <= getattr(self, kind)
+                   for kind in ('disk', 'transfer'))
+
+    def _fit(self, simulation, estimate):
+        '''Writes frames and energies less often so the outputs fit within
+        the budget.'''
+        # Bytes left for the frames and energy records of the MD steps once
+        # the restart files, file headers, minimisation outputs (and
+        # uploads) are accounted for
+        minimisation = sum(md_step.arg_dict.get('maxcyc', 0) // md_step.arg_dict['ntpr']
+                           for md_step in simulation.md_steps
+                           if md_step.arg_dict.get('imin') == 1) * MDOUT_RECORD_SIZE
+        scalable = (estimate['trajectory'] + estimate['mdout'] - minimisation -
+                    len(simulation.md_steps) * (MDOUT_OVERHEAD + NETCDF_HEADER_SIZE))
+        budget = min(getattr(self, kind) - (estimate[kind] - scalable)
+                     for kind in ('disk', 'transfer') if getattr(self, kind) is not None)
+        if budget <= 0:
+            logger.warning(f"The restart files of '{simulation.name}' don't fit the budget")
+            return
+
+        scale = scalable / budget
+        for md_step in self._md_steps(simulation):
+            dt = md_step.arg_dict['dt']
+            ntwx = math.ceil(md_step.arg_dict['ntwx'] * scale)
+            self._set(md_step, 'ntwx', ntwx)
+            self._set(md_step, 'ntwr', self._restart_frequency(dt, ntwx))
+            self._set(md_step, 'ntpr', math.ceil(md_step.arg_dict['ntpr'] * scale))
+        logger.info(f"Writing frames of '{simulation.name}' every "
+                    f"{self.frame_spacing * scale:.1f} ps and energies every "
+                    f"{self.energy_spacing * scale:.1f} ps to fit the budget")
+
+    def _restart_frequency(self, dt, ntwx):
+        ntwr = max(1, round(self.restart_spacing / dt))
+        return max(1, round(ntwr / ntwx)) * ntwx
+
+    @staticmethod
+    def _md_steps(simulation):
+        return [md_step for md_step in simulation.md_steps if md_step.arg_dict.get('imin') == 0]
+
+    @staticmethod
+    def _set(md_step, arg, value):
+        setattr(md_step, arg, value)
+        md_step.arg_dict[arg] = value
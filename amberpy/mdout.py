@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains functions for reading the mdout and mdinfo files written
+by pmemd.
+
+read_ns_per_day, parse_ns_per_day
+    Read the simulation speed (ns/day) reported in an mdinfo or mdout file.
+
+parse_record
+    Reads the values in an energy record of an mdout/mdinfo file.
+
+MdoutParser
+    Streams the energy records of an mdout file into columnar NumPy arrays,
+    carrying on from where it got to on the previous parse.
+
+read_mdout
+    Reads the energies in an mdout file, optionally using a cache so that
+    only new output is parsed.
+
+concatenate_columns
+    Joins the energies of several mdout files (e.g. the segments of a
+    simulation).
+"""
+import os
+import re
+import hashlib
+import numpy as np
+
+_NS_PER_DAY = re.compile(r'ns/day =\s*([0-9.]+)')
+
+def read_ns_per_day(fname):
+    '''Returns the speed of a simulation in ns/day from an mdinfo or mdout
+    file.
+
+    pmemd reports the average timings for the last few steps and for all of
+    the steps so far. The average for all steps is used when it is available.
+
+    Parameters
+    ----------
+    fname : str
+        Path to the mdinfo or mdout file.
+
+    Returns
+    -------
+    float or None
+        Speed in ns/day, or None if the file doesn't exist or doesn't contain
+        any timings yet.
+    '''
+    if not os.path.isfile(fname):
+        return None
+
+    with open(fname, 'r') as f:
+        return parse_ns_per_day(f.read())
+
+def parse_ns_per_day(text, recent=False):
+    '''Returns the speed in ns/day from the text of an mdinfo or mdout file,
+    or None if it doesn't contain any timings.
+
+    If recent is True, the average timing for the last few steps is used
+    rather than the average for all steps.
+    '''
+    if recent:
+        index = text.rfind('Average timings for last')
+    else:
+        index = text.rfind('Average timings for all steps')
+
+    if index != -1:
+        matches = _NS_PER_DAY.findall(text[index:])
+    else:
+        matches = _NS_PER_DAY.findall(text)
+
+    if not matches:
+        return None
+    return float(matches[0] if index != -1 else matches[-1])
+
+# Matches the 'LABEL = value' pairs in an energy record, e.g.
+# ' NSTEP =     1000   TIME(PS) =    2002.000  TEMP(K) =   309.99'
+_FIELD = re.compile(r'([A-Za-z0-9][A-Za-z0-9()\-. ]*?)\s*=\s*(-?[0-9]+\.?[0-9]*(?:[eE][-+]?[0-9]+)?)')
+
+def parse_record(lines):
+    '''Returns the values in an energy record (the lines from NSTEP to the
+    line of dashes at the end of the record) as a dictionary.
+
+    Parameters
+    ----------
+    lines : list
+        Lines of the record.
+
+    Returns
+    -------
+    dict
+        Values keyed by their label, e.g. {'NSTEP': 1000.0, 'Etot': -1.2e5}.
+    '''
+    record = {}
+    for line in lines:
+        for label, value in _FIELD.findall(line):
+            record[label.strip()] = float(value)
+    return record
+
+_FIELD_BYTES = re.compile(_FIELD.pattern.encode())
+
+# Records following these markers are averages/fluctuations rather than
+# values at a step
+_SUMMARY_MARKERS = (b'A V E R A G E S', b'F L U C T U A T I O N S')
+
+class MdoutParser:
+    '''Parses the energy records of an mdout file into columns.
+
+    The file is read in chunks, starting from the byte offset reached by the
+    previous parse, so calling parse again on a growing file only reads the
+    new output. Only complete records are parsed. Averages and fluctuations
+    are skipped.
+
+    Attributes
+    ----------
+    fname : str
+        Path of the mdout file.
+
+    offset : int
+        Byte offset up to which the file has been parsed.
+
+    columns : dict
+        NumPy arrays of the values in each record, keyed by the labels used
+        in the mdout file (e.g. 'NSTEP', 'TIME(PS)', 'TEMP(K)', 'PRESS',
+        'Etot', 'EPtot', 'VOLUME', 'Density'). Values missing from a record
+        are NaN.
+    '''
+
+    chunk_size = 1 << 22
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.offset = 0
+        self._n_records = 0
+        self._values = {}
+        self._skip = False
+
+    def __len__(self):
+        return self._n_records
+
+    @property
+    def columns(self):
+        return {label: np.array(values) for label, values in self._values.items()}
+
+    def parse(self):
+        '''Parses any records written since the last parse.
+
+        Returns
+        -------
+        dict
+            The columns of all of the records parsed so far.
+        '''
+        if not os.path.isfile(self.fname):
+            return self.columns
+
+        with open(self.fname, 'rb') as f:
+            f.seek(self.offset)
+            buffer = b''
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                buffer += chunk
+                consumed = self._parse_buffer(buffer)
+                buffer = buffer[consumed:]
+                self.offset += consumed
+
+        return self.columns
+
+    def _parse_buffer(self, buffer):
+        '''Parses the complete records in buffer and returns the number of
+        bytes that have been dealt with.
+        '''
+        position = 0
+        while True:
+            start = buffer.find(b'NSTEP =', position)
+            if start == -1:
+                # Keep any partial line, which could be the start of a record
+                consumed = buffer.rfind(b'\n', position) + 1 or position
+                if any(marker in buffer[position:consumed] for marker in _SUMMARY_MARKERS):
+                    self._skip = True
+                return max(consumed, position)
+
+            end = buffer.find(b'-----', start)
+            if end == -1:
+                return position
+
+            if any(marker in buffer[position:start] for marker in _SUMMARY_MARKERS):
+                self._skip = True
+
+            if not self._skip:
+                self._add_record(buffer[start:end])
+            self._skip = False
+
+            position = buffer.find(b'\n', end)
+            if position == -1:
+                return len(buffer)
+            position += 1
+
+    def _add_record(self, text):
+        '''Adds the values in the text of a record to the columns.'''
+        for label, value in _FIELD_BYTES.findall(text):
+            label = label.strip().decode()
+            values = self._values.get(label)
+            if values is None:
+                values = self._values[label] = [np.nan] * self._n_records
+            elif len(values) > self._n_records:
+                # Labels repeated within a record keep the first value
+                continue
+            values.append(float(value))
+
+        self._n_records += 1
+        for values in self._values.values():
+            if len(values) < self._n_records:
+                values.append(np.nan)
+
+    def _signature(self):
+        '''Returns a hash of the start of the file, which identifies the
+        run that wrote it.
+        '''
+        with open(self.fname, 'rb') as f:
+            return hashlib.sha1(f.read(4096)).hexdigest()
+
+    def save(self, cache):
+        '''Saves the parsed columns and offset to an npz file.'''
+        tmp = cache + '.tmp.npz'
+        np.savez(tmp,
+                 __offset__=self.offset,
+                 __signature__=self._signature(),
+                 **self.columns)
+        os.replace(tmp, cache)
+
+    def load(self, cache):
+        '''Loads the columns and offset saved by a previous parse. Returns
+        False (and loads nothing) if the cache doesn't exist or was made from
+        a different file.
+        '''
+        if not os.path.isfile(cache) or not os.path.isfile(self.fname):
+            return False
+
+        with np.load(cache) as data:
+            offset = int(data['__offset__'])
+            if offset > os.path.getsize(self.fname) or str(data['__signature__']) != self._signature():
+                return False
+            self._values = {label: data[label].tolist() for label in data.files
+                            if not label.startswith('__')}
+
+        self.offset = offset
+        self._n_records = len(next(iter(self._values.values()), []))
+        self._skip = False
+        return True
+
+def read_mdout(fname, cache=None):
+    '''Returns the energies in an mdout file as columns.
+
+    Parameters
+    ----------
+    fname : str
+        Path of the mdout file.
+
+    cache : str or bool, optional
+        Path of an npz file used to save the parsed energies, so that next
+        time only the output written since is parsed. If True, the cache is
+        saved next to the mdout file.
+
+    Returns
+    -------
+    dict
+        NumPy arrays keyed by the labels in the mdout file (see
+        MdoutParser).
+    '''
+    if cache is True:
+        cache = fname + '.npz'
+
+    parser = MdoutParser(fname)
+    if cache:
+        parser.load(cache)
+
+    offset = parser.offset
+    columns = parser.parse()
+    if cache and parser.offset != offset:
+        parser.save(cache)
+    return columns
+
+def concatenate_columns(tables, key=None, values=None):
+    '''Joins several dictionaries of columns, filling columns that are
+    missing from a table with NaN.
+
+    Parameters
+    ----------
+    tables : list
+        Dictionaries of columns, e.g. from read_mdout.
+
+    key : str, optional
+        If given, a column with this name is added containing the index of
+        the table each row came from (or the value for the table in values).
+
+    values : list, optional
+        Value of the key column for each table.
+
+    Returns
+    -------
+    dict
+        Concatenated columns.
+    '''
+    labels = []
+    for table in tables:
+        labels += [label for label in table if label not in labels]
+
+    lengths = [len(next(iter(table.values()), [])) for table in tables]
+    columns = {label: np.concatenate([table[label] if label in table else np.full(n, np.nan)
+                                      for table, n in zip(tables, lengths)] or [np.empty(0)])
+               for label in labels}
+    if key is not None:
+        if values is None:
+            values = np.arange(len(tables))
+        columns[key] = np.repeat(np.asarray(values), lengths)
+    return columns
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains classes for monitoring running simulations.
+
+FileTail
+    Reads the lines appended to a file since it was last read.
+
+Monitor
+    Follows the mdout and mdinfo files of the current step of each
+    simulation and keeps a table of their speed (ns/day), progress, estimated
+    time remaining and energies. The table can be written periodically to a
+    JSON file and/or a Prometheus text file, e.g. for a dashboard to flag slow
+    nodes and stalled jobs.
+
+A typical use would be:
+
+    from amberpy.monitor import Monitor
+
+    with Monitor(experiments, json_file='status.json',
+                 prometheus_file='amberpy.prom'):
+        for experiment in experiments:
+            experiment.run()
+"""
+import os
+import re
+import json
+import time
+import statistics
+import threading
+import logging
+
+from amberpy.mdout import parse_record, parse_ns_per_day
+
+logger = logging.getLogger(__name__)
+
+_ETA = re.compile(r'Estimated time remaining:\s*([0-9.]+)\s*(second|minute|hour)')
+
+class FileTail:
+    '''Reads the lines appended to a file since it was last read.
+
+    Only the new bytes are read on each call. If the file is replaced or
+    truncated, it is read again from the start.
+
+    Attributes
+    ----------
+    path : str
+        Path of the file.
+
+    offset : int
+        Number of bytes read so far.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self._inode = None
+        self._partial = b''
+
+    def read_lines(self):
+        '''Returns a list of the complete lines appended to the file since
+        the last call. A line that is still being written is kept until it is
+        complete.
+        '''
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return []
+
+        if stat.st_ino != self._inode or stat.st_size < self.offset:
+            self._inode = stat.st_ino
+            self.offset = 0
+            self._partial = b''
+
+        if stat.st_size == self.offset:
+            return []
+
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        self.offset += len(data)
+
+        lines = (self._partial + data).split(b'\n')
+        self._partial = lines.pop()
+        return [line.decode(errors='replace') for line in lines]
+
+class Monitor:
+    '''Monitors the progress of running simulations.
+
+    The monitor looks at the local copies of the output files, so when
+    running with longbow the table is only as up to date as the last time the
+    files were staged.
+
+    Attributes
+    ----------
+    simulations : list
+        Simulation (or Experiment) objects to monitor.
+
+    interval : float, default=60
+        Seconds between updates when the monitor is started.
+
+    json_file : str, optional
+        File the table is written to (as JSON) after each update.
+
+    prometheus_file : str, optional
+        File the table is written to in the Prometheus text format after
+        each update (e.g. for the node_exporter textfile collector).
+
+    stall_timeout : float, default=7200
+        A running simulation is flagged as stalled if its output files have
+        not changed for this many seconds. This should be longer than the
+        staging frequency.
+
+    slow_fraction : float, default=0.5
+        A simulation is flagged as slow if its speed is less than this
+        fraction of the median speed of the monitored simulations.
+    '''
+
+    def __init__(self,
+                 simulations,
+                 interval=60,
+                 json_file=None,
+                 prometheus_file=None,
+                 stall_timeout=7200,
+                 slow_fraction=0.5):
+
+        self.simulations = list(simulations)
+        self.interval = interval
+        self.json_file = json_file
+        self.prometheus_file = prometheus_file
+        self.stall_timeout = stall_timeout
+        self.slow_fraction = slow_fraction
+
+        self._rows = {}
+        self._tails = {}
+        self._mdinfo = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def table(self):
+        '''list : A row (dictionary) for each simulation.'''
+        with self._lock:
+            return [dict(row) for row in self._rows.values()]
+
+    def update(self):
+        '''Reads any new output of each simulation, updates the table and
+        writes the output files.
+
+        Returns
+        -------
+        list
+            The updated table.
+        '''
+        rows = {sim.name: self._update_simulation(sim) for sim in self.simulations}
+
+        # Compare the speed of each running simulation to the others
+        speeds = [row['ns_per_day'] for row in rows.values()
+                  if row['ns_per_day'] and not row['stalled']]
+        median = statistics.median(speeds) if speeds else None
+        for row in rows.values():
+            row['slow'] = bool(median and row['ns_per_day'] is not None and
+                               row['ns_per_day'] < self.slow_fraction * median)
+
+        with self._lock:
+            self._rows = rows
+
+        if self.json_file is not None:
+            self.write_json(self.json_file)
+        if self.prometheus_file is not None:
+            self.write_prometheus(self.prometheus_file)
+
+        return self.table
+
+    def _update_simulation(self, sim):
+        '''Returns the row of the table for a simulation.'''
+        row = {'simulation': sim.name,
+               'step': None,
+               'step_name': None,
+               'status': 'finished',
+               'nstep': None,
+               'nstlim': None,
+               'time_ps': None,
+               'ns_per_day': None,
+               'eta_seconds': None,
+               'energies': {},
+               'last_update': None,
+               'stalled': False}
+
+        # The current step is the first step that hasn't been completed
+        incomplete = [n for n, done in enumerate(sim.completed_steps, start=1) if not done]
+        if not incomplete:
+            return row
+        step_number = incomplete[0]
+        md_step = sim.md_steps[step_number-1]
+        prefix = os.path.join(sim.simulation_directory or '', sim._step_prefix(step_number))
+
+        row.update({'step': step_number,
+                    'step_name': str(md_step),
+                    'status': sim.state.get(str(step_number), {}).get('status', 'pending'),
+                    'nstlim': getattr(md_step, 'nstlim', None)})
+
+        # Only the bytes appended to the mdout file since the last update are
+        # read
+        record = self._read_mdout(prefix + '.mdout')
+        if record is not None:
+            row['energies'] = {k: v for k, v in record.items() if k not in ('NSTEP', 'TIME(PS)')}
+            row['nstep'] = int(record['NSTEP']) if 'NSTEP' in record else None
+            row['time_ps'] = record.get('TIME(PS)')
+
+        # The mdinfo file is rewritten by pmemd rather than appended to, so
+        # it is only read again when it changes
+        ns_per_day, eta = self._read_mdinfo(prefix + '.mdinfo')
+        row['ns_per_day'] = ns_per_day
+        if eta is None and ns_per_day and row['nstep'] is not None and row['nstlim']:
+            eta = (row['nstlim'] - row['nstep']) * md_step.dt / 1000 / ns_per_day * 86400
+        row['eta_seconds'] = eta
+
+        mtimes = [os.path.getmtime(f) for f in (prefix + '.mdout', prefix + '.mdinfo')
+                  if os.path.isfile(f)]
+        if mtimes:
+            row['last_update'] = max(mtimes)
+            row['stalled'] = (row['status'] in ('submitted', 'running') and
+                              time.time() - row['last_update'] > self.stall_timeout)
+
+        return row
+
+    def _read_mdout(self, path):
+        '''Returns the last energy record in the new lines of an mdout file
+        (or the last record seen if there are none).
+        '''
+        if path not in self._tails:
+            self._tails[path] = {'tail': FileTail(path), 'lines': None,
+                                 'skip': False, 'record': None}
+        state = self._tails[path]
+
+        for line in state['tail'].read_lines():
+
+            # The averages and fluctuations at the end of the file look like
+            # the other records so are skipped
+            if 'A V E R A G E S' in line or 'F L U C T U A T I O N S' in line:
+                state['skip'] = True
+            elif 'NSTEP' in line and '=' in line:
+                state['lines'] = [line]
+            elif state['lines'] is not None:
+                if line.strip().startswith('-----'):
+                    if not state['skip']:
+                        state['record'] = parse_record(state['lines'])
+                    state['lines'] = None
+                    state['skip'] = False
+                else:
+                    state['lines'].append(line)
+
+        return state['record']
+
+    def _read_mdinfo(self, path):
+        '''Returns the (ns/day, seconds remaining) from an mdinfo file.'''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None, None
+
+        key = (stat.st_mtime, stat.st_size)
+        cached = self._mdinfo.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        with open(path, 'r') as f:
+            text = f.read()
+
+        eta = None
+        match = _ETA.search(text)
+        if match is not None:
+            eta = float(match.group(1)) * {'second': 1, 'minute': 60, 'hour': 3600}[match.group(2)]
+
+        values = (parse_ns_per_day(text, recent=True), eta)
+        self._mdinfo[path] = (key, values)
+        return values
+
+    def write_json(self, path):
+        '''Writes the table to a JSON file.'''
+        self._write(path, json.dumps({'time': time.time(), 'simulations': self.table}, indent=2))
+
+    def write_prometheus(self, path):
+        '''Writes the table to a file in the Prometheus text format.'''
+        metrics = [('amberpy_ns_per_day', 'Simulation speed in ns/day', 'ns_per_day'),
+                   ('amberpy_nstep', 'Current MD step of the current step', 'nstep'),
+                   ('amberpy_step', 'Current step of the simulation', 'step'),
+                   ('amberpy_eta_seconds', 'Estimated seconds until the current step finishes', 'eta_seconds'),
+                   ('amberpy_last_update_timestamp_seconds', 'Time the output files last changed', 'last_update'),
+                   ('amberpy_stalled', 'Whether the simulation has stalled', 'stalled'),
+                   ('amberpy_slow', 'Whether the simulation is slower than the others', 'slow')]
+        table = self.table
+
+        lines = []
+        for metric, description, key in metrics:
+            lines += [f'# HELP {metric} {description}', f'# TYPE {metric} gauge']
+            for row in table:
+                if row.get(key) is not None:
+                    lines.append(f'{metric}{{simulation="{_escape(row["simulation"])}"}} {float(row[key])}')
+
+        lines += ['# HELP amberpy_energy Latest energy terms from mdout',
+                  '# TYPE amberpy_energy gauge']
+        for row in table:
+            for term, value in row['energies'].items():
+                lines.append(f'amberpy_energy{{simulation="{_escape(row["simulation"])}",'
+                             f'term="{_escape(term)}"}} {value}')
+
+        self._write(path, '\n'.join(lines) + '\n')
+
+    def _write(self, path, text):
+        '''Writes a file atomically so that it is never read half written.'''
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def start(self):
+        '''Updates the table every interval seconds in a background
+        thread.
+        '''
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        '''Stops the background thread (after one last update).'''
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.update()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.update()
+            except Exception:
+                logger.exception('Failed to update the monitor')
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+def _escape(value):
+    '''Escapes a Prometheus label value.'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
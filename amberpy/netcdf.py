@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains a reader for the classic NetCDF files written by Amber
+(trajectories and restart files) and a follower which downloads the
+complete frames of a trajectory while it is being written.
+
+NetCDFFile
+    Reads the header and variables of a classic (CDF-1) or 64-bit offset
+    (CDF-2) NetCDF file. Only the records that have been completely written
+    are read, so a trajectory can be read while pmemd is writing it.
+
+TrajectoryFollower
+    Appends the frames of a remote trajectory written since the last update
+    to a local copy, which is always a valid NetCDF file containing only
+    complete frames.
+
+A typical use would be:
+
+    from amberpy.netcdf import NetCDFFile
+
+    nc = NetCDFFile('step-3.0-production.nc')
+    coordinates = nc.read('coordinates', start=100)
+"""
+import os
+import shlex
+import struct
+import hashlib
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_ABSENT = 0
+_DIMENSION = 0x0A
+_VARIABLE = 0x0B
+_ATTRIBUTE = 0x0C
+_STREAMING = 0xFFFFFFFF
+
+# NetCDF types (1 to 6) as big-endian NumPy types
+_TYPES = {1: np.dtype('>i1'), 2: np.dtype('S1'), 3: np.dtype('>i2'),
+          4: np.dtype('>i4'), 5: np.dtype('>f4'), 6: np.dtype('>f8')}
+
+class _Header:
+    '''Reads the fields of a NetCDF header from a bytes object.'''
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, n):
+        if self.offset + n > len(self.data):
+            raise EOFError('The NetCDF header is incomplete')
+        value = self.data[self.offset:self.offset+n]
+        self.offset += n
+        return value
+
+    def int(self):
+        return struct.unpack('>I', self.read(4))[0]
+
+    def offset_value(self, version):
+        if version == 1:
+            return self.int()
+        return struct.unpack('>Q', self.read(8))[0]
+
+    def name(self):
+        n = self.int()
+        name = self.read(n).decode()
+        self.read(-n % 4)
+        return name
+
+    def values(self, nc_type, n):
+        dtype = _TYPES[nc_type]
+        size = dtype.itemsize * n
+        data = self.read(size)
+        self.read(-size % 4)
+        if nc_type == 2:
+            return data.decode(errors='replace').rstrip('\x00')
+        values = np.frombuffer(data, dtype=dtype)
+        return values[0] if n == 1 else values
+
+    def attributes(self):
+        tag, n = self.int(), self.int()
+        if tag not in (_ABSENT, _ATTRIBUTE):
+            raise Exception('Could not read the attributes of the NetCDF file')
+        attributes = {}
+        for _ in range(n):
+            name = self.name()
+            nc_type = self.int()
+            attributes[name] = self.values(nc_type, self.int())
+        return attributes
+
+def parse_header(data):
+    '''Parses the header of a NetCDF file.
+
+    Parameters
+    ----------
+    data : bytes
+        The start of the file (at least the whole header).
+
+    Returns
+    -------
+    dict
+        The 'version', 'numrecs', 'dimensions' (name: length, 0 for the
+        record dimension), 'attributes', 'variables' and 'header_size'. Each
+        variable is a dictionary of its 'dimensions', 'shape', 'dtype',
+        'attributes', 'vsize', 'begin' and whether it is a 'record' variable.
+        The 'record_size' and 'record_begin' (offset of the first record)
+        are also given.
+
+    Raises
+    ------
+    EOFError
+        If data does not contain the whole header.
+    '''
+    header = _Header(data)
+    magic = header.read(4)
+    if magic[:3] != b'CDF' or magic[3] not in (1, 2):
+        raise Exception('Not a classic or 64-bit offset NetCDF file')
+    version = magic[3]
+    numrecs = header.int()
+
+    tag, n = header.int(), header.int()
+    if tag not in (_ABSENT, _DIMENSION):
+        raise Exception('Could not read the dimensions of the NetCDF file')
+    dimensions = {}
+    for _ in range(n):
+        name = header.name()
+        dimensions[name] = header.int()
+    names = list(dimensions)
+
+    attributes = header.attributes()
+
+    tag, n = header.int(), header.int()
+    if tag not in (_ABSENT, _VARIABLE):
+        raise Exception('Could not read the variables of the NetCDF file')
+    variables = {}
+    for _ in range(n):
+        name = header.name()
+        dims = [names[header.int()] for _ in range(header.int())]
+        var_attributes = header.attributes()
+        dtype = _TYPES[header.int()]
+        vsize = header.int()
+        begin = header.offset_value(version)
+        record = bool(dims) and dimensions[dims[0]] == 0
+        variables[name] = {'dimensions': dims,
+                           'shape': tuple(dimensions[d] for d in dims[record:]),
+                           'dtype': dtype,
+                           'attributes': var_attributes,
+                           'vsize': vsize,
+                           'begin': begin,
+                           'record': record}
+
+    records = [v for v in variables.values() if v['record']]
+    if len(records) == 1:
+
+        # A single record variable isn't padded
+        var = records[0]
+        record_size = int(np.prod(var['shape'], dtype=int)) * var['dtype'].itemsize
+    else:
+        record_size = sum(v['vsize'] for v in records)
+
+    return {'version': version,
+            'numrecs': numrecs,
+            'dimensions': dimensions,
+            'attributes': attributes,
+            'variables': variables,
+            'header_size': header.offset,
+            'record_size': record_size,
+            'record_begin': min((v['begin'] for v in records), default=None)}
+
+def complete_records(header, file_size):
+    '''Returns the number of records of a NetCDF file that have been
+    completely written, from its header and the size of the file.'''
+    if header['record_begin'] is None or header['record_size'] == 0:
+        return 0
+    n = max(0, (file_size - header['record_begin']) // header['record_size'])
+    if header['numrecs'] != _STREAMING:
+        n = min(n, header['numrecs'])
+    return n
+
+def read_header(fname, chunk_size=65536):
+    '''Reads the header of a NetCDF file.'''
+    with open(fname, 'rb') as f:
+        data = b''
+        while True:
+            chunk = f.read(chunk_size)
+            data += chunk
+            try:
+                return parse_header(data)
+            except EOFError:
+                if not chunk:
+                    raise
+
+class NetCDFFile:
+    '''Classic NetCDF file (e.g. an Amber trajectory).
+
+    Attributes
+    ----------
+    fname : str
+        Path of the file.
+
+    header : dict
+        The parsed header (see parse_header).
+    '''
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.header = read_header(fname)
+
+    @property
+    def variables(self):
+        '''dict : The variables in the file.'''
+        return self.header['variables']
+
+    @property
+    def attributes(self):
+        '''dict : The global attributes of the file.'''
+        return self.header['attributes']
+
+    @property
+    def n_frames(self):
+        '''int : Number of complete records (frames) in the file.'''
+        return complete_records(self.header, os.path.getsize(self.fname))
+
+    @property
+    def n_atoms(self):
+        '''int : Length of the atom dimension (0 if there isn't one).'''
+        return self.header['dimensions'].get('atom', 0)
+
+    def read(self, name, start=0, stop=None, step=1):
+        '''Reads a variable.
+
+        Parameters
+        ----------
+        name : str
+            Name of the variable, e.g. 'coordinates', 'cell_lengths' or
+            'time'.
+
+        start, stop, step : int, optional
+            Range of records (frames) to read of a record variable. stop
+            defaults to the number of complete records.
+
+        Returns
+        -------
+        np.ndarray
+            Values of the variable (in native byte order). Record variables
+            have the records along the first axis.
+        '''
+        if name not in self.variables:
+            raise Exception(f"{self.fname} has no variable '{name}'")
+        var = self.variables[name]
+        dtype = var['dtype']
+        count = int(np.prod(var['shape'], dtype=int))
+
+        if not var['record']:
+            data = np.fromfile(self.fname, dtype=dtype, count=count, offset=var['begin'])
+            return data.reshape(var['shape']).astype(dtype.newbyteorder('='))
+
+        n_frames = self.n_frames
+        stop = n_frames if stop is None else min(stop, n_frames)
+        frames = range(*slice(start, stop, step).indices(n_frames))
+        if len(frames) == 0:
+            return np.empty((0,) + var['shape'], dtype=dtype.newbyteorder('='))
+
+        # View the records as rows of bytes and pick out the variable
+        record_size = self.header['record_size']
+        first = self.header['record_begin']
+        records = np.memmap(self.fname, dtype=np.uint8, mode='r', offset=first,
+                            shape=(frames[-1] + 1, record_size))
+        start_byte = var['begin'] - first
+        data = np.ascontiguousarray(records[frames.start:frames.stop:frames.step,
+                                            start_byte:start_byte + count * dtype.itemsize])
+        del records
+        return data.view(dtype).reshape((len(frames),) + var['shape']).astype(dtype.newbyteorder('='))
+
+class TrajectoryFollower:
+    '''Downloads the complete frames of a remote trajectory as it is
+    written.
+
+    Each update fetches the header of the remote file, works out how many
+    frames have been completely written (from the record count and the size
+    of the file) and appends the bytes of the new frames to the local copy.
+    The record count in the local header is set to the number of frames
+    downloaded, so the local copy can be read (e.g. by NetCDFFile or
+    cpptraj) at any time, and once the step has finished only the last few
+    frames are left to download.
+
+    Attributes
+    ----------
+    stager : Stager
+        Stager used to reach the host (see amberpy.staging).
+
+    local_path : str
+        Path of the local copy.
+
+    remote_path : str
+        Path of the trajectory on the host.
+
+    n_frames : int
+        Number of frames downloaded.
+    '''
+
+    def __init__(self, stager, local_path, remote_path=None):
+        self.stager = stager
+        self.local_path = local_path
+        self.remote_path = remote_path if remote_path is not None else stager.remote_path(local_path)
+        self.n_frames = 0
+        self._header_size = 1024
+
+    def update(self):
+        '''Downloads any new complete frames.
+
+        Returns
+        -------
+        int
+            Number of new frames.
+        '''
+        transport = self.stager.transport
+        remote_size = transport.size(self.remote_path)
+        if not remote_size:
+            return 0
+
+        # The header is read again each time as the record count changes
+        while True:
+            data = transport.run(f'head -c {self._header_size} {shlex.quote(self.remote_path)}')
+            try:
+                header = parse_header(data)
+                break
+            except EOFError:
+                if len(data) < self._header_size:
+                    return 0
+                self._header_size *= 2
+
+        n_frames = complete_records(header, remote_size)
+        if header['record_begin'] is None:
+            length = remote_size
+        else:
+            length = header['record_begin'] + n_frames * header['record_size']
+
+        local_size = os.path.getsize(self.local_path) if os.path.isfile(self.local_path) else 0
+        if local_size > length or local_size < header['header_size'] or \
+           not self._same_frames(local_size, header['header_size']):
+            local_size = 0
+            if os.path.isfile(self.local_path):
+                os.remove(self.local_path)
+
+        # Append the new bytes then write the header with the number of
+        # complete frames that the local copy holds
+        if local_size < length:
+            self.stager.transport.get(self.remote_path, self.local_path, local_size, length - local_size)
+            with self.stager._lock:
+                self.stager.downloaded += length - local_size
+        if os.path.getsize(self.local_path) != length:
+            raise Exception(f'Downloaded {os.path.getsize(self.local_path)} bytes of '
+                            f'{self.remote_path}, expected {length}')
+        with open(self.local_path, 'r+b') as f:
+            f.write(data[:4] + struct.pack('>I', n_frames) + data[8:header['header_size']])
+
+        new = n_frames - self.n_frames
+        self.n_frames = n_frames
+        if new > 0:
+            logger.debug(f'Downloaded {new} new frames of {self.remote_path}')
+        return new
+
+    def _same_frames(self, local_size, header_size):
+        '''Returns True if the last frames of the local copy match the remote
+        file (i.e. the remote file hasn't been rewritten).'''
+        start = max(header_size, local_size - (1 << 20))
+        if start >= local_size:
+            return True
+        with open(self.local_path, 'rb') as f:
+            f.seek(start)
+            digest = hashlib.sha256(f.read(local_size - start)).hexdigest()
+        return digest == self.stager.transport.hash(self.remote_path, start, local_size)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the in-job recovery from 'Periodic box dimensions have
+changed' errors.
+
+BoxChangeRecovery
+    Writes the commands for an NPT step which, if pmemd stops because the
+    box has changed too much, restart it straight away (inside the same job)
+    from the latest restart file. Short sub-segments that write restart files
+    more often are run until the box volume has stabilised, and then the
+    rest of the step is run as normal.
+
+A typical use would be:
+
+    from amberpy.recovery import BoxChangeRecovery
+
+    experiment.run(scheduler=scheduler, box_change_recovery=BoxChangeRecovery())
+"""
+import copy
+import os
+
+from amberpy.crossbow import pmemd_arguments
+
+BOX_CHANGE_MESSAGE = 'Periodic box dimensions have changed'
+
+class BoxChangeRecovery:
+    '''Recovers from box change errors inside the job running a step.
+
+    The outputs of each part of the step after the first are written to
+    files named like step-3.0-production.part1.mdout. Each part's mdout file
+    is also appended to the step's mdout file and, once the step has
+    finished, the last restart file is copied to the step's restart file, so
+    the step looks the same to the following steps as a step that ran in one
+    go.
+
+    Attributes
+    ----------
+    sub_segment_steps : int, default=5000
+        Number of MD steps in each sub-segment run while the box settles.
+
+    sub_segment_ntwr : int, default=100
+        Restart file frequency of the sub-segments.
+
+    max_sub_segments : int, default=20
+        Maximum number of sub-segments. After this many, the rest of the
+        step is run whether or not the volume has stabilised.
+
+    volume_tolerance : float, default=0.002
+        The volume has stabilised when it changes by less than this
+        fraction over a sub-segment.
+
+    max_restarts : int, default=10
+        Maximum number of box change errors recovered from before the job
+        fails (and is left to the retry policy).
+    '''
+
+    def __init__(self,
+                 sub_segment_steps=5000,
+                 sub_segment_ntwr=100,
+                 max_sub_segments=20,
+                 volume_tolerance=0.002,
+                 max_restarts=10):
+
+        self.sub_segment_steps = sub_segment_steps
+        self.sub_segment_ntwr = sub_segment_ntwr
+        self.max_sub_segments = max_sub_segments
+        self.volume_tolerance = volume_tolerance
+        self.max_restarts = max_restarts
+
+    def applies(self, md_step):
+        '''Returns True if a step runs at constant pressure, so its box can
+        change.
+        '''
+        return bool(md_step.arg_dict.get('ntp'))
+
+    def commands(self, simulation, step_number, executable):
+        '''Writes the mdin files for a step and returns the shell commands
+        that run it with box change recovery.
+
+        Parameters
+        ----------
+        simulation : Simulation
+            The simulation the step belongs to.
+
+        step_number : int
+            Number of the step.
+
+        executable : str
+            The pmemd executable (and launcher).
+
+        Returns
+        -------
+        list
+            Shell commands, which exit with status 1 if the step fails.
+        '''
+        md_step = simulation._step_input(step_number)
+        prefix = simulation._step_prefix(step_number)
+
+        # Writes the mdin file of the first part (the step itself)
+        simulation._step_arguments(step_number)
+
+        # The mdin files of the later parts are written from templates once
+        # the number of steps left is known
+        for suffix, ntwr in (('sub', self.sub_segment_ntwr), ('rest', md_step.arg_dict.get('ntwr'))):
+            template = copy.deepcopy(md_step)
+            template.arg_dict.update({'nstlim': 'NSTLIM', 'ntwr': ntwr, 'irest': 1, 'ntx': 5})
+            template.write(simulation.simulation_directory, f'{prefix}.{suffix}.mdin')
+
+        args = pmemd_arguments('$name.mdin',
+                               os.path.basename(simulation.parm7),
+                               '$input',
+                               os.path.basename(simulation.ref_rst7))
+
+        ntwr = md_step.arg_dict.get('ntwr')
+        volume_changed = (
+            "awk '/A V E R A G E S/ {exit} "
+            '/VOLUME/ {for (i = 1; i < NF; i++) if ($i == "VOLUME") v = $(i+2); '
+            'if (first == "") first = v; last = v} '
+            'END {if (first == "" || first == 0) exit 1; d = (last - first) / first; '
+            f"if (d < 0) d = -d; exit !(d < {self.volume_tolerance})}}' $name.mdout")
+
+        return [f'# Run {prefix} recovering from box changes',
+                f'nstlim={md_step.nstlim}',
+                'done=0',
+                'part=0',
+                'restarts=0',
+                'stable=0',
+                'sub=0',
+                f'nst={md_step.nstlim}',
+                f'ntwr={ntwr}',
+                f'input={simulation._input_rst7(step_number)}',
+                'while true; do',
+                f'    if [ $part -eq 0 ]; then name={prefix}; else name={prefix}.part$part; fi',
+                f'    {executable} {args} > $name.log 2>&1',
+                '    status=$?',
+                '    cat $name.log',
+                f'    if [ $part -gt 0 ]; then cat $name.mdout >> {prefix}.mdout; fi',
+                "    if [ $status -eq 0 ] && [ -s $name.rst7 ] && grep -q 'Total wall time' $name.mdout; then",
+                '        done=$((done + nst))',
+                '        input=$name.rst7',
+                f'        if [ $sub -eq 1 ] && {volume_changed}; then',
+                '            stable=1',
+                '        fi',
+                f"    elif grep -q '{BOX_CHANGE_MESSAGE}' $name.log $name.mdout 2> /dev/null; then",
+                '        restarts=$((restarts + 1))',
+                f'        if [ $restarts -gt {self.max_restarts} ]; then',
+                f'            echo "Giving up after $restarts box changes"',
+                '            exit 1',
+                '        fi',
+                '',
+                '        # Carry on from the last restart file that was written',
+                "        last=$(awk '/A V E R A G E S/ {exit} /NSTEP =/ {n = $3} END {print n + 0}' $name.mdout)",
+                '        written=$((last / ntwr * ntwr))',
+                '        if [ $written -gt 0 ] && [ -s $name.rst7 ]; then',
+                '            done=$((done + written))',
+                '            input=$name.rst7',
+                '        fi',
+                '        stable=0',
+                '        echo "Box change after $done steps, restarting from $input"',
+                '    else',
+                '        echo "Step failed with exit status $status"',
+                '        exit 1',
+                '    fi',
+                '',
+                '    if [ $done -ge $nstlim ]; then break; fi',
+                '',
+                '    # Run short sub-segments until the volume has stabilised',
+                '    part=$((part + 1))',
+                '    remaining=$((nstlim - done))',
+                f'    if [ $stable -eq 0 ] && [ $part -le {self.max_sub_segments} ] && '
+                f'[ $remaining -gt {self.sub_segment_steps} ]; then',
+                f'        nst={self.sub_segment_steps}',
+                '        sub=1',
+                f'        ntwr={self.sub_segment_ntwr}',
+                f'        template={prefix}.sub.mdin',
+                '    else',
+                '        nst=$remaining',
+                '        sub=0',
+                f'        ntwr={ntwr}',
+                f'        template={prefix}.rest.mdin',
+                '    fi',
+                f'    sed "s/nstlim=NSTLIM/nstlim=$nst/" $template > {prefix}.part$part.mdin',
+                'done',
+                f'if [ $part -gt 0 ]; then cp $input {prefix}.rst7; fi']
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the reduction of production trajectories on the
+cluster, before they are downloaded.
+
+TrajectoryReduction
+    Writes the commands which, after a production step has finished, run
+    cpptraj in the same job to autoimage the step's trajectory, strip the
+    solvent and keep every nth frame, and write a matching stripped
+    topology. Only the reduced trajectory and topology then need to be
+    downloaded.
+
+A typical use would be:
+
+    from amberpy.reduction import TrajectoryReduction
+
+    experiment.run(scheduler=scheduler, reduction=TrajectoryReduction(stride=2))
+"""
+import os
+import glob
+
+class TrajectoryReduction:
+    '''Reduces the trajectories of production steps with cpptraj.
+
+    The reduced trajectory of a step is named like
+    step-3.0-production.stripped.nc and the stripped topology like
+    name.stripped.parm7. If the step was continued from earlier attempts or
+    recovered from box changes, the trajectories of every attempt and part
+    are reduced into the one file.
+
+    Attributes
+    ----------
+    strip : str, default=':WAT,Na+,Cl-'
+        cpptraj mask of the atoms removed (water and ions).
+
+    autoimage : bool, default=True
+        Image the molecules back into the box around the first molecule.
+
+    stride : int, default=1
+        Keep every stride-th frame.
+
+    remove_full : bool, default=False
+        Delete the full trajectories on the cluster once they have been
+        reduced.
+
+    executable : str, default='cpptraj'
+        cpptraj executable.
+    '''
+
+    def __init__(self,
+                 strip=':WAT,Na+,Cl-',
+                 autoimage=True,
+                 stride=1,
+                 remove_full=False,
+                 executable='cpptraj'):
+
+        self.strip = strip
+        self.autoimage = autoimage
+        self.stride = stride
+        self.remove_full = remove_full
+        self.executable = executable
+
+    def applies(self, md_step):
+        '''Returns True if a step's trajectory is reduced (production steps
+        only).'''
+        return str(md_step) == 'production'
+
+    def stripped_parm7(self, simulation):
+        '''Returns the path of the stripped topology of a simulation.'''
+        return os.path.join(simulation.simulation_directory, f'{simulation.name}.stripped.parm7')
+
+    def output(self, simulation, step_number):
+        '''Returns the path of the reduced trajectory of a step.'''
+        prefix = simulation._step_prefix(step_number)
+        return os.path.join(simulation.simulation_directory, f'{prefix}.stripped.nc')
+
+    def cpptraj_input(self, parm7, trajectories, output, stripped_parm7):
+        '''Returns a cpptraj input which reduces some trajectories into one.
+
+        Parameters
+        ----------
+        parm7 : str
+            Topology of the trajectories.
+
+        trajectories : list
+            Trajectories, in order.
+
+        output : str
+            Reduced trajectory.
+
+        stripped_parm7 : str
+            Stripped topology written to match the reduced trajectory.
+        '''
+        lines = [f'parm {parm7}']
+        lines += [f'trajin {trajectory} 1 last {self.stride}' for trajectory in trajectories]
+        if self.autoimage:
+            lines.append('autoimage')
+        if self.strip:
+            lines.append(f'strip {self.strip} parmout {stripped_parm7}')
+        lines += [f'trajout {output} netcdf', 'run', 'quit']
+        return '\n'.join(lines) + '\n'
+
+    def write_input(self, simulation, step_number):
+        '''Writes a cpptraj input reducing the trajectories of a step that
+        are in the simulation directory, e.g. to run with
+        amberpy.crossbow.run_cpptraj, and returns its file name.'''
+        directory = simulation.simulation_directory
+        trajectories = []
+        for trajectory in self._trajectory_files(simulation, step_number):
+            parts = glob.glob(os.path.join(glob.escape(directory), trajectory[:-3]) + '.part*.nc')
+            parts = sorted((os.path.basename(f) for f in parts), key=lambda f: int(f[len(trajectory)+2:-3]))
+            trajectories += [f for f in [trajectory] + parts
+                             if os.path.isfile(os.path.join(directory, f))]
+        fname = simulation._step_prefix(step_number) + '.cpptraj'
+        with open(os.path.join(directory, fname), 'w') as f:
+            f.write(self.cpptraj_input(os.path.basename(simulation.parm7),
+                                       trajectories,
+                                       os.path.basename(self.output(simulation, step_number)),
+                                       os.path.basename(self.stripped_parm7(simulation))))
+        return fname
+
+    def commands(self, simulation, step_number):
+        '''Returns the shell commands, run in the simulation directory after
+        a step has finished, which reduce its trajectory. A failed reduction
+        doesn't fail the step (the full trajectory is kept).'''
+        prefix = simulation._step_prefix(step_number)
+        output = os.path.basename(self.output(simulation, step_number))
+        stripped_parm7 = os.path.basename(self.stripped_parm7(simulation))
+
+        # The parts written when recovering from box changes only exist once
+        # the step has run, so the trajectories are listed by the job
+        patterns = ' '.join(f'{f} $(ls -v {f[:-3]}.part*.nc 2> /dev/null)'
+                            for f in self._trajectory_files(simulation, step_number))
+        input_lines = self.cpptraj_input(os.path.basename(simulation.parm7), ['$f'],
+                                         output, stripped_parm7).splitlines()
+        trajin = input_lines.index('trajin $f 1 last ' + str(self.stride))
+
+        commands = [f'# Reduce the trajectory of {prefix}',
+                    'trajectories=""',
+                    f'for f in {patterns}; do',
+                    '    if [ -s "$f" ]; then trajectories="$trajectories $f"; fi',
+                    'done',
+                    '{']
+        commands += [f"    echo '{line}'" for line in input_lines[:trajin]]
+        commands += [f'    for f in $trajectories; do echo "trajin $f 1 last {self.stride}"; done']
+        commands += [f"    echo '{line}'" for line in input_lines[trajin+1:]]
+        commands += [f'}} > {prefix}.cpptraj',
+                     f'if {self.executable} -i {prefix}.cpptraj > {prefix}.cpptraj.out 2>&1 && [ -s {output} ]; then']
+        commands.append('    rm -f $trajectories' if self.remove_full else '    :')
+        commands += ['else',
+                     f'    echo "Reduction of {prefix} failed, see {prefix}.cpptraj.out"',
+                     'fi']
+        return commands
+
+    def _trajectory_files(self, simulation, step_number):
+        '''Returns the trajectories written by the attempts of a step.'''
+        attempts = simulation.attempt_numbers.get(step_number, 0)
+        return [simulation._step_prefix(step_number, attempt) + '.nc'
+                for attempt in range(attempts + 1)]
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains a class for running replicas of a simulation together.
+
+Replicas
+    Submits the same step of several replica simulations as a single array
+    job (or as bundles run from an Amber groupfile), rather than one job per
+    replica per step.
+
+A typical use would be:
+
+    from amberpy.experiments import ProteinExperiment
+    from amberpy.replicas import Replicas
+    from amberpy.schedulers import SGEScheduler
+
+    replicas = []
+    for i in range(5):
+        p = ProteinExperiment('CTB.pdb', replica_name=i)
+        p.make_system()
+        p.add_minimisation_step()
+        p.add_equilibration_step()
+        p.add_production_step()
+        replicas.append(p)
+
+    Replicas(replicas).run(SGEScheduler(host='arc4'))
+"""
+import os
+import logging
+
+from amberpy.schedulers import Job, Task, COMPLETED
+
+logger = logging.getLogger(__name__)
+
+class Replicas:
+    '''Runs several replica simulations using one array job per step.
+
+    Step N of every replica is submitted as task i of a single array job,
+    with each task running in its replica's simulation_directory. Task i of
+    step N only depends on task i of step N-1, so a replica which fails does
+    not hold up the others.
+
+    Attributes
+    ----------
+    simulations : list
+        Simulation (or Experiment) objects to run. All of the simulations
+        must have the same steps.
+
+    name : str
+        Name used for the array jobs.
+
+    directory : str
+        Directory the array jobs are run from (this is where the scheduler
+        writes the job output files).
+    '''
+
+    def __init__(self, simulations, name=None):
+        '''
+        Parameters
+        ----------
+        simulations : list
+            Simulation (or Experiment) objects to run.
+
+        name : str, optional
+            Name used for the array jobs. Defaults to the name shared by all
+            of the simulations (e.g. the experiment name without the replica
+            name).
+
+        Raises
+        ------
+        Exception
+            Raises an exception if the simulations do not have the same
+            steps.
+        '''
+        if len(simulations) == 0:
+            raise Exception('No simulations provided')
+
+        steps = [[str(step) for step in sim.md_steps] for sim in simulations]
+        if any(s != steps[0] for s in steps):
+            raise Exception('All replicas must have the same md steps')
+
+        self.simulations = list(simulations)
+
+        if name is None:
+            name = os.path.commonprefix([sim.name for sim in simulations]).rstrip('-.')
+            if name == '':
+                name = 'replicas'
+        self.name = name
+
+        self.directory = os.path.commonpath([sim.simulation_directory for sim in simulations])
+
+    @property
+    def n_steps(self):
+        '''int : Number of steps in each replica.'''
+        return len(self.simulations[0].md_steps)
+
+    def submit(self, scheduler, cores=32, gpu=True, bundle=None):
+        '''Submits one array job for every step that has not been completed
+        by all of the replicas.
+
+        Parameters
+        ----------
+        scheduler : Scheduler
+            Scheduler to submit the jobs to (see amberpy.schedulers).
+
+        cores : int, default=32
+            The number of cores to use for minimisation (and for every step
+            if gpu is False). When bundling, the total number of cores used
+            by each bundle.
+
+        gpu : bool, default=True
+            Run the non-minimisation steps on a gpu. Ignored when bundling.
+
+        bundle : int or bool, optional
+            If given, instead of an array job, the step of every bundle of
+            this many replicas (or all of the replicas if True) is written
+            into an Amber groupfile and run as one 'pmemd.MPI -ng N' job on
+            cpus. This is useful for small systems where one replica cannot
+            fill a node. cores must be divisible by the bundle size.
+
+        Returns
+        -------
+        list
+            Job ids in step order.
+        '''
+        job_ids = []
+        previous = None
+
+        for step_number in range(1, self.n_steps+1):
+
+            # Only replicas that haven't completed the step are included
+            sims = [sim for sim in self.simulations
+                    if sim.completed_steps[step_number-1] == 0]
+            if not sims:
+                continue
+
+            if bundle:
+                size = len(sims) if bundle is True else bundle
+                groups = [sims[i:i+size] for i in range(0, len(sims), size)]
+                jobs = [self._bundle_job(scheduler, step_number, group, cores, i+1)
+                        for i, group in enumerate(groups)]
+            else:
+                groups = [sims]
+                jobs = [self._array_job(scheduler, step_number, sims, cores, gpu)]
+
+            # If the replicas line up with the previous step, each job (or
+            # array task) only waits for the same replicas in the previous
+            # step, otherwise wait for the whole of the previous step
+            step_ids = []
+            for job, group in zip(jobs, groups):
+                if previous is not None:
+
+                    # Where the scheduler only waits for the previous step
+                    # to finish (SGE), each replica checks that it finished
+                    # successfully
+                    if bundle:
+                        job.requires = [requirement for sim in group
+                                        for requirement in sim._step_requirements(
+                                            step_number-1,
+                                            os.path.relpath(sim.simulation_directory, self.directory))]
+                    else:
+                        for task, sim in zip(job.tasks, group):
+                            task.requires = sim._step_requirements(step_number-1)
+
+                    if groups == [g for _, g in previous]:
+                        previous_id = previous[groups.index(group)][0]
+                        if bundle:
+                            job.dependencies = [previous_id]
+                        else:
+                            job.task_dependencies = [previous_id]
+                    else:
+                        job.dependencies = [job_id for job_id, _ in previous]
+
+                job_id = scheduler.submit(job)
+                for task, sim in enumerate(group, start=1):
+                    sim.md_job_names.append(job.name)
+                    sim.job_ids[step_number] = job_id
+                    if bundle:
+                        sim.task_ids.pop(step_number, None)
+                        sim._set_step_state(step_number, 'submitted', job_id=job_id)
+                    else:
+                        sim.task_ids[step_number] = task
+                        sim._set_step_state(step_number, 'submitted', job_id=job_id, task=task)
+
+                logger.info(f'Submitted step {step_number} of {len(group)} '
+                            f"replicas of '{self.name}' as job {job_id}")
+                step_ids.append(job_id)
+
+            previous = list(zip(step_ids, groups))
+            job_ids += step_ids
+
+        return job_ids
+
+    def _array_job(self, scheduler, step_number, sims, cores, gpu):
+        '''Returns an array job running a step of each simulation.'''
+        tasks = [Task(sim.simulation_directory,
+                      sim._step_commands(scheduler, step_number, cores, gpu),
+                      sim._step_inputs([step_number]))
+                 for sim in sims]
+        step_cores, gpus = sims[0]._step_resources(step_number, cores, gpu)
+        step_name = str(sims[0].md_steps[step_number-1])
+
+        return Job(f'{self.name}.{step_name[:3]}.{step_number}',
+                   workdir=self.directory,
+                   cores=step_cores,
+                   gpus=gpus,
+                   walltime=sims[0]._step_walltime(step_number),
+                   tasks=tasks)
+
+    def _bundle_job(self, scheduler, step_number, sims, cores, bundle_number):
+        '''Writes a groupfile for a step of each simulation and returns a
+        job running them all with pmemd.MPI.
+        '''
+        if cores % len(sims) != 0:
+            raise Exception(f'The number of cores ({cores}) must be divisible '
+                            f'by the number of bundled replicas ({len(sims)})')
+
+        step_name = str(sims[0].md_steps[step_number-1])
+        name = f'{self.name}.{step_name[:3]}.{step_number}.b{bundle_number}'
+
+        # Each line of the groupfile runs one replica in its own directory,
+        # so the outputs are written with the usual names for each replica
+        groupfile = f'{name}.groupfile'
+        with open(os.path.join(self.directory, groupfile), 'w') as f:
+            for sim in sims:
+                directory = os.path.relpath(sim.simulation_directory, self.directory)
+                f.write(sim._step_arguments(step_number, directory) + '\n')
+
+        command = (f'{scheduler.pmemd_executable(0, cores)} -ng {len(sims)} '
+                   f'-groupfile {groupfile}')
+
+        inputs = [os.path.join(self.directory, groupfile)]
+        for sim in sims:
+            inputs += sim._step_inputs([step_number])
+
+        return Job(name, [command], workdir=self.directory, cores=cores,
+                   walltime=sims[0]._step_walltime(step_number),
+                   inputs=inputs)
+
+    def run(self, scheduler, cores=32, gpu=True, bundle=None):
+        '''Submits the replicas and waits for them to finish.
+
+        Parameters are the same as for the submit method.
+
+        Raises
+        ------
+        Exception
+            Raises an exception if any of the replicas failed. Steps
+            completed by the other replicas are still marked as completed.
+        '''
+        # Pick up from where a previous run of the replicas got to
+        for sim in self.simulations:
+            sim.load_state()
+
+        job_ids = self.submit(scheduler, cores, gpu, bundle)
+        scheduler.wait(job_ids)
+
+        # Only the first failed step of each replica is reported since the
+        # steps after it are cancelled
+        failures = {}
+        for job_id in job_ids:
+            info = scheduler.info(job_id)
+            tasks = {int(task): state for task, state in info.get('tasks', {}).items()}
+            for sim in self.simulations:
+                for step_number, step_job_id in sorted(sim.job_ids.items()):
+                    if step_job_id != job_id or sim.completed_steps[step_number-1] == 1:
+                        continue
+                    task = sim.task_ids.get(step_number)
+                    if task is None:
+                        self._split_output(scheduler, job_id, sim, step_number)
+                    state = tasks.get(task, info['state'])
+                    if state == COMPLETED:
+                        sim._complete_step(step_number)
+                    else:
+                        sim._set_step_state(step_number, 'failed', job_state=state)
+                        failures.setdefault(sim.name, f"step {step_number} of "
+                                            f"'{sim.name}' ({state})")
+
+        if failures:
+            raise Exception('Replicas failed: ' + ', '.join(failures.values()))
+
+    def _split_output(self, scheduler, job_id, sim, step_number):
+        '''Copies the output of a bundle job into a replica's directory so
+        that it can be checked in the same way as the output of a job run for
+        the replica alone.
+        '''
+        output = scheduler.job_output(job_id)
+        if output:
+            fname = f'{sim._step_job_name(step_number)}.o{job_id}'
+            with open(os.path.join(sim.simulation_directory, fname), 'w') as f:
+                f.write(output)
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains an analysis of how long cosolvent molecules stay bound
+to sites on a protein.
+
+ResidueSite
+    A site made of protein residues. A molecule is bound while any of its
+    atoms is within the cutoff of an atom of the residues.
+
+GridSite
+    A site made of fixed points (e.g. the grid points of a hotspot). A
+    molecule is bound while any of its atoms is within the cutoff of a
+    point.
+
+ResidenceAnalysis
+    Finds the bound state of every cosolvent molecule at every site in each
+    frame, in one streaming pass over the trajectories of each replica. The
+    runs of bound frames are found with a vectorized run-length encoding of
+    each chunk of frames, and joined across chunks, so only a chunk of
+    states is held in memory at a time. The survival function (Kaplan-Meier,
+    with runs cut off by the start or end of a trajectory censored) and the
+    mean residence time are given for each site and cosolvent type, over
+    all of the replicas.
+
+A typical use would be:
+
+    from amberpy.residence import ResidenceAnalysis, ResidueSite
+
+    sites = [ResidueSite([45, 46, 80], name='pocket')]
+    analysis = ResidenceAnalysis.from_experiment(replicas[0], sites)
+    result = analysis.run(replicas)
+    print(result['mean_residence'])
+"""
+import logging
+
+import numpy as np
+
+from amberpy.analysis import AnalysisExecutor
+from amberpy.contacts import neighbour_pairs, cosolvent_types
+from amberpy.topology import Topology
+
+logger = logging.getLogger(__name__)
+
+class ResidueSite:
+    '''A binding site made of protein residues.
+
+    Attributes
+    ----------
+    residues : list
+        Numbers (from 1) of the residues.
+
+    name : str
+        Name of the site.
+
+    cutoff : float
+        Distance (in Angstroms) within which a molecule is bound.
+    '''
+
+    def __init__(self, residues, name=None, cutoff=4.0):
+        self.residues = list(residues)
+        self.name = name or '-'.join(str(residue) for residue in self.residues)
+        self.cutoff = cutoff
+
+    def atoms(self, topology, heavy_atoms=True):
+        '''Returns the indices of the site's atoms.'''
+        mask = np.isin(topology.atom_residues + 1, self.residues)
+        if heavy_atoms:
+            mask &= np.isin(np.arange(topology.n_atoms), topology.heavy_atoms)
+        return np.nonzero(mask)[0]
+
+class GridSite:
+    '''A binding site made of fixed points, e.g. a hotspot. The trajectory
+    must be in the same frame as the points (e.g. imaged and superimposed
+    onto the structure the points came from).
+
+    Attributes
+    ----------
+    points : np.ndarray
+        (points, 3) coordinates.
+
+    name : str
+        Name of the site.
+
+    cutoff : float
+        Distance (in Angstroms) within which a molecule is bound.
+    '''
+
+    def __init__(self, points, name=None, cutoff=1.5):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        self.name = name or 'grid'
+        self.cutoff = cutoff
+
+    def atoms(self, topology, heavy_atoms=True):
+        '''A grid site has no atoms.'''
+        return np.empty(0, dtype=int)
+
+def _histogram(groups, lengths, n_groups):
+    '''Returns a (groups, lengths) count of runs.'''
+    if len(lengths) == 0:
+        return np.zeros((n_groups, 1), dtype=np.int64)
+    width = int(lengths.max()) + 1
+    counts = np.bincount(groups * width + lengths, minlength=n_groups * width)
+    return counts.reshape(n_groups, width)
+
+def _add(a, b):
+    '''Adds two histograms of different widths.'''
+    total = np.zeros((a.shape[0], max(a.shape[1], b.shape[1])), dtype=np.int64)
+    total[:, :a.shape[1]] += a
+    total[:, :b.shape[1]] += b
+    return total
+
+def survival_function(events, censored):
+    '''Returns the Kaplan-Meier survival function of runs.
+
+    Parameters
+    ----------
+    events : np.ndarray
+        Number of complete runs of each length (in frames).
+
+    censored : np.ndarray
+        Number of runs of each length which were cut off, so only lasted at
+        least that long.
+
+    Returns
+    -------
+    np.ndarray
+        Probability that a run lasts longer than each number of frames
+        (starting with 1 for 0 frames).
+    '''
+    width = max(len(events), len(censored))
+    events = np.pad(events, (0, width - len(events)))
+    censored = np.pad(censored, (0, width - len(censored)))
+    at_risk = np.cumsum((events + censored)[::-1])[::-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        hazard = np.where(at_risk > 0, events / at_risk, 0.0)
+    hazard[0] = 0.0
+    return np.cumprod(1 - hazard)
+
+class ResidenceAnalysis:
+    '''Residence times of cosolvent molecules at binding sites.
+
+    Attributes
+    ----------
+    topology : Topology
+        Topology of the trajectories.
+
+    sites : list
+        ResidueSite and GridSite objects.
+
+    types : list
+        Cosolvent names.
+
+    frame_time : float, optional
+        Time between frames in ps. By default it is taken from the times in
+        the trajectories.
+    '''
+
+    def __init__(self, parm7, sites, cosolvents, protein_residues=None, heavy_atoms=True,
+                 frame_time=None):
+        '''
+        Parameters
+        ----------
+        parm7 : str
+            Path of the topology of the trajectories.
+
+        sites : list
+            ResidueSite and GridSite objects.
+
+        cosolvents : list
+            Cosolvent names (see amberpy.contacts.cosolvent_types).
+
+        protein_residues : list, optional
+            (first, last) ranges of protein residue numbers, which are never
+            counted as cosolvent.
+
+        heavy_atoms : bool, default=True
+            Only use the heavy atoms.
+
+        frame_time : float, optional
+            Time between frames in ps.
+        '''
+        self.topology = Topology(parm7)
+        self.sites = list(sites)
+        self.types = list(cosolvents)
+        self.frame_time = frame_time
+
+        protein = np.zeros(self.topology.n_atoms, dtype=bool)
+        for first, last in protein_residues or []:
+            residue_numbers = self.topology.atom_residues + 1
+            protein |= (residue_numbers >= first) & (residue_numbers <= last)
+        molecules = self.topology.atom_molecules
+        molecule_types = cosolvent_types(self.topology, self.types, protein)
+        cosolvent = (molecule_types[molecules] >= 0) & ~protein
+        if heavy_atoms:
+            cosolvent &= np.isin(np.arange(self.topology.n_atoms), self.topology.heavy_atoms)
+        cosolvent_atoms = np.nonzero(cosolvent)[0]
+        if len(cosolvent_atoms) == 0:
+            raise Exception(f'No molecules of {parm7} are cosolvents {self.types}')
+        cosolvent_molecules, self._atom_molecule = np.unique(molecules[cosolvent_atoms],
+                                                             return_inverse=True)
+        self._molecule_type = molecule_types[cosolvent_molecules]
+
+        # The atoms read are those of the sites then the cosolvent
+        site_atoms = [site.atoms(self.topology, heavy_atoms) for site in self.sites]
+        for site, atoms in zip(self.sites, site_atoms):
+            if isinstance(site, ResidueSite) and len(atoms) == 0:
+                raise Exception(f'Site {site.name} has no atoms')
+        self._site_slices = []
+        start = 0
+        for atoms in site_atoms:
+            self._site_slices.append(slice(start, start + len(atoms)))
+            start += len(atoms)
+        self.atoms = np.concatenate(site_atoms + [cosolvent_atoms])
+        self._n_site_atoms = start
+
+        # Each (site, molecule) column of the states belongs to a (site,
+        # type) group
+        n_molecules = len(self._molecule_type)
+        self._groups = (np.arange(len(self.sites))[:, None] * len(self.types)
+                        + self._molecule_type[None, :]).ravel()
+        self._n_columns = len(self.sites) * n_molecules
+
+    @classmethod
+    def from_experiment(cls, experiment, sites, stripped=False, **kwargs):
+        '''Returns the analysis of a ProteinCosolventExperiment. If stripped,
+        the stripped topology (see amberpy.reduction) is used.'''
+        parm7 = experiment.parm7
+        if stripped:
+            parm7 = experiment.reduction.stripped_parm7(experiment)
+        return cls(parm7, sites, experiment.cosolvents, experiment.protein_termini, **kwargs)
+
+    @property
+    def n_groups(self):
+        '''int : Number of (site, cosolvent type) groups.'''
+        return len(self.sites) * len(self.types)
+
+    def states(self, frames):
+        '''Returns a (frames, sites x molecules) array of whether each
+        molecule is bound to each site in a chunk of frames.'''
+        n_molecules = len(self._molecule_type)
+        states = np.zeros((len(frames), len(self.sites), n_molecules), dtype=bool)
+        for f, (coordinates, box) in enumerate(zip(frames.coordinates, frames.boxes)):
+            cosolvent = coordinates[self._n_site_atoms:]
+            for s, site in enumerate(self.sites):
+                if isinstance(site, GridSite):
+                    points = site.points
+                else:
+                    points = coordinates[self._site_slices[s]]
+                _, j = neighbour_pairs(points, cosolvent, site.cutoff, box)
+                states[f, s, self._atom_molecule[j]] = True
+        return states.reshape(len(frames), -1)
+
+    def map(self, frames):
+        '''Returns the runs of bound frames in a chunk of frames: the
+        histogram of the runs inside the chunk and, for each (site, molecule),
+        the lengths of the runs at the start ('lead') and end ('trail') of
+        the chunk, to be joined with the neighbouring chunks.'''
+        states = self.states(frames)
+        n_frames = len(frames)
+
+        # Run-length encode every column at once
+        padded = np.zeros((n_frames + 2, self._n_columns), dtype=np.int8)
+        padded[1:-1] = states
+        steps = np.diff(padded, axis=0).T
+        columns, starts = np.nonzero(steps == 1)
+        _, ends = np.nonzero(steps == -1)
+        lengths = ends - starts
+
+        lead = np.zeros(self._n_columns, dtype=np.int64)
+        trail = np.zeros(self._n_columns, dtype=np.int64)
+        lead[columns[starts == 0]] = lengths[starts == 0]
+        trail[columns[ends == n_frames]] = lengths[ends == n_frames]
+        inside = (starts > 0) & (ends < n_frames)
+
+        frame_time = np.nan
+        if n_frames > 1 and np.isfinite(frames.times).all():
+            frame_time = float(np.median(np.diff(frames.times)))
+
+        return {'n_frames': n_frames,
+                'lead': lead,
+                'trail': trail,
+                'events': _histogram(self._groups[columns[inside]], lengths[inside], self.n_groups),
+                'bound': np.bincount(self._groups, states.sum(axis=0), self.n_groups).astype(np.int64),
+                'frame_time': frame_time}
+
+    def reduce(self, a, b):
+        '''Joins the runs of two consecutive ranges of frames.'''
+        full_a = a['lead'] == a['n_frames']
+        full_b = b['lead'] == b['n_frames']
+
+        # Runs ending at the join which are complete (bound on both sides of
+        # it, only unbound on the outside)
+        joined = (a['trail'] > 0) & (b['lead'] > 0) & ~full_a & ~full_b
+        ended_a = (a['trail'] > 0) & (b['lead'] == 0) & ~full_a & (b['n_frames'] > 0)
+        started_b = (b['lead'] > 0) & (a['trail'] == 0) & ~full_b & (a['n_frames'] > 0)
+        lengths = np.concatenate([(a['trail'] + b['lead'])[joined],
+                                  a['trail'][ended_a],
+                                  b['lead'][started_b]])
+        groups = np.concatenate([self._groups[joined], self._groups[ended_a], self._groups[started_b]])
+        events = _add(_add(a['events'], b['events']), _histogram(groups, lengths, self.n_groups))
+
+        return {'n_frames': a['n_frames'] + b['n_frames'],
+                'lead': np.where(full_a, a['n_frames'] + b['lead'], a['lead']),
+                'trail': np.where(full_b, b['n_frames'] + a['trail'], b['trail']),
+                'events': events,
+                'bound': a['bound'] + b['bound'],
+                'frame_time': a['frame_time'] if np.isfinite(a['frame_time']) else b['frame_time']}
+
+    def _initial(self):
+        return {'n_frames': 0,
+                'lead': np.zeros(self._n_columns, dtype=np.int64),
+                'trail': np.zeros(self._n_columns, dtype=np.int64),
+                'events': np.zeros((self.n_groups, 1), dtype=np.int64),
+                'bound': np.zeros(self.n_groups, dtype=np.int64),
+                'frame_time': np.nan}
+
+    def run(self, sources, executor=None, stripped=False):
+        '''Runs the analysis.
+
+        Parameters
+        ----------
+        sources : list
+            Replicas: Simulations and/or lists of trajectory paths. The
+            trajectories of each replica are taken as one continuous
+            trajectory, and runs are never joined between replicas.
+
+        executor : AnalysisExecutor, optional
+            Executor used to run the analysis. Defaults to one using every
+            cpu.
+
+        stripped : bool, default=False
+            Use the stripped trajectories of the simulations.
+
+        Returns
+        -------
+        dict
+            The 'sites' (names), cosolvent 'types', 'n_frames', 'frame_time'
+            (ps) and (sites, types) arrays of the number of complete binding
+            events ('n_events'), the 'mean_residence' time (ps) of the
+            complete events, the mean number of molecules bound in each
+            frame ('occupancy'), and 'survival', a (sites, types, frames)
+            array of the probability that a molecule stays bound for longer
+            than each number of frames.
+        '''
+        executor = executor or AnalysisExecutor()
+        if isinstance(sources, str) or hasattr(sources, 'trajectories'):
+            sources = [sources]
+
+        n_frames = 0
+        frame_time = self.frame_time
+        events = np.zeros((self.n_groups, 1), dtype=np.int64)
+        censored = np.zeros((self.n_groups, 1), dtype=np.int64)
+        bound = np.zeros(self.n_groups, dtype=np.int64)
+        for source in sources:
+            result = executor.run(source, self.map, self.reduce, self._initial(), self.atoms, stripped)
+            if result['n_frames'] == 0:
+                continue
+
+            # Runs cut off by the start or end of the replica are censored
+            full = result['lead'] == result['n_frames']
+            cut = np.concatenate([result['lead'][result['lead'] > 0],
+                                  result['trail'][(result['trail'] > 0) & ~full]])
+            groups = np.concatenate([self._groups[result['lead'] > 0],
+                                     self._groups[(result['trail'] > 0) & ~full]])
+            censored = _add(censored, _histogram(groups, cut, self.n_groups))
+            events = _add(events, result['events'])
+            bound += result['bound']
+            n_frames += result['n_frames']
+            if frame_time is None and np.isfinite(result['frame_time']):
+                frame_time = result['frame_time']
+
+        if n_frames == 0:
+            raise Exception('No frames to analyse')
+        if frame_time is None:
+            logger.warning('The trajectories have no times, residence times are in frames')
+            frame_time = 1.0
+
+        shape = (len(self.sites), len(self.types))
+        lengths = np.arange(events.shape[1])
+        n_events = events.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (events * lengths).sum(axis=1) / n_events * frame_time
+        survival = np.array([survival_function(e, c) for e, c in zip(*_pad(events, censored))])
+        return {'sites': [site.name for site in self.sites],
+                'types': self.types,
+                'n_frames': n_frames,
+                'frame_time': frame_time,
+                'n_events': n_events.reshape(shape),
+                'mean_residence': mean.reshape(shape),
+                'occupancy': (bound / n_frames).reshape(shape),
+                'survival': survival.reshape(shape + (-1,))}
+
+def _pad(a, b):
+    '''Pads two histograms to the same width.'''
+    width = max(a.shape[1], b.shape[1])
+    return (np.pad(a, ((0, 0), (0, width - a.shape[1]))),
+            np.pad(b, ((0, 0), (0, width - b.shape[1]))))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the retry policy used to decide whether a failed MD
+step should be resubmitted.
+
+RetryPolicy
+    Classifies job failures (node CUDA failure, box change, walltime
+    exceeded, transfer error), limits the number of retries of each class of
+    failure, backs off exponentially between retries and keeps metrics on the
+    node-hours wasted by failed jobs.
+"""
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Failure classes
+CUDA = 'cuda'
+BOX_CHANGE = 'box_change'
+WALLTIME = 'walltime'
+TRANSFER = 'transfer'
+UNKNOWN = 'unknown'
+
+class RetryPolicy:
+    '''Decides whether (and when) failed steps are retried.
+
+    Attributes
+    ----------
+    max_retries : dict
+        Maximum number of retries of a step for each class of failure.
+        Failure classes which are not in the dictionary are not retried.
+
+    backoff : float, default=60.0
+        Seconds to wait before the first retry of a step.
+
+    backoff_factor : float, default=2.0
+        Factor the wait is multiplied by for each subsequent retry.
+
+    max_backoff : float, default=3600.0
+        Maximum number of seconds to wait before a retry.
+
+    exclude_nodes : bool, default=True
+        Ask the scheduler not to run a step on a node it had a CUDA failure on
+        (only supported when running with a scheduler).
+
+    patterns : dict
+        Strings searched for in the job output to classify each failure.
+
+    continues : tuple
+        Failure classes after which the step continues from the restart file
+        written by the failed attempt (as a new attempt), rather than being
+        rerun from the start.
+
+    metrics : dict
+        Number of 'failures' and 'retries' of each class and the total
+        'wasted_node_hours' spent on failed jobs.
+    '''
+
+    patterns = {CUDA: ['cudaGetDeviceCount failed',
+                       'no CUDA-capable device is detected',
+                       'cudaMalloc',
+                       'an illegal memory access was encountered',
+                       'unspecified launch failure'],
+                BOX_CHANGE: ['Periodic box dimensions have changed'],
+                WALLTIME: ['DUE TO TIME LIMIT',
+                           'exceeded hard wallclock',
+                           'h_rt limit'],
+                TRANSFER: ['StagingError',
+                           'rsync error',
+                           'lost connection',
+                           'Connection reset',
+                           'Connection timed out',
+                           'Connection refused']}
+
+    continues = (BOX_CHANGE, WALLTIME)
+
+    def __init__(self,
+                 max_retries=None,
+                 backoff=60.0,
+                 backoff_factor=2.0,
+                 max_backoff=3600.0,
+                 exclude_nodes=True):
+
+        if max_retries is None:
+            max_retries = {CUDA: 3, BOX_CHANGE: 5, WALLTIME: 2, TRANSFER: 5}
+
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.exclude_nodes = exclude_nodes
+
+        self.metrics = {'failures': {}, 'retries': {}, 'wasted_node_hours': 0.0}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def classify(self, output='', job_state=None):
+        '''Returns the class of a failure from the job output and (if known)
+        the state reported by the scheduler.
+        '''
+        if job_state == 'TIMEOUT':
+            return WALLTIME
+        for failure, patterns in self.patterns.items():
+            if any(pattern in output for pattern in patterns):
+                return failure
+        return UNKNOWN
+
+    def retry(self, key, failure, elapsed=0.0, nodes=1, sleep=time.sleep):
+        '''Records a failure and, if the step should be retried, waits for
+        the backoff period.
+
+        Parameters
+        ----------
+        key
+            Identifies the step, e.g. (simulation name, step number). Retries
+            are counted separately for each step and class of failure.
+
+        failure : str
+            Class of the failure (see classify).
+
+        elapsed : float, default=0.0
+            Seconds the failed job ran for.
+
+        nodes : int, default=1
+            Number of nodes the failed job ran on.
+
+        sleep : callable, default=time.sleep
+            Function used to wait, e.g. Scheduler.sleep.
+
+        Returns
+        -------
+        bool
+            True if the step should be retried.
+        '''
+        with self._lock:
+            failures = self.metrics['failures']
+            failures[failure] = failures.get(failure, 0) + 1
+            self.metrics['wasted_node_hours'] += nodes * (elapsed or 0.0) / 3600
+
+            count = self._counts.get((key, failure), 0)
+            if count >= self.max_retries.get(failure, 0):
+                logger.error(f'Not retrying {key} after {failure} failure '
+                             f'({count} retries). {self.summary()}')
+                return False
+
+            self._counts[(key, failure)] = count + 1
+            retries = self.metrics['retries']
+            retries[failure] = retries.get(failure, 0) + 1
+
+        delay = min(self.backoff * self.backoff_factor**count, self.max_backoff)
+        logger.warning(f'Retrying {key} after {failure} failure (retry '
+                       f'{count+1}/{self.max_retries[failure]}) in {delay:.0f} '
+                       f'seconds. {self.summary()}')
+        sleep(delay)
+        return True
+
+    def summary(self):
+        '''Returns a string summarising the failure metrics.'''
+        return (f"Failures: {self.metrics['failures']}, retries: "
+                f"{self.metrics['retries']}, wasted node-hours: "
+                f"{self.metrics['wasted_node_hours']:.2f}")
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains a vectorized RMSD and RMSF analysis of protein
+trajectories.
+
+kabsch(coordinates, reference, weights=None)
+    Superimposes a chunk of frames onto a reference at once, using a batched
+    covariance matrix and SVD, and returns the RMSD and rotated coordinates.
+
+Fluctuations
+    Running mean and sum of squared deviations of aligned coordinates, which
+    can be merged, giving the RMSF in one streaming pass.
+
+RMSDAnalysis
+    Per-frame RMSD to a reference structure (by default the minimised
+    structure of an experiment) and per-residue RMSF of the protein, run on
+    chunks of frames with AnalysisExecutor (see amberpy.analysis).
+
+A typical use would be:
+
+    from amberpy.rmsd import RMSDAnalysis
+
+    for replica in replicas:
+        result = RMSDAnalysis.from_experiment(replica).run(replica)
+        print(result['rmsd'].mean(), result['rmsf'])
+"""
+import os
+import logging
+
+import numpy as np
+
+from amberpy.analysis import AnalysisExecutor
+from amberpy.topology import Topology
+from amberpy.trajectory import read_restart
+
+logger = logging.getLogger(__name__)
+
+def kabsch(coordinates, reference, weights=None):
+    '''Superimposes frames onto a reference.
+
+    Parameters
+    ----------
+    coordinates : np.ndarray
+        (frames, atoms, 3) coordinates.
+
+    reference : np.ndarray
+        (atoms, 3) reference coordinates.
+
+    weights : np.ndarray, optional
+        Weight of each atom (e.g. masses). Defaults to equal weights.
+
+    Returns
+    -------
+    tuple
+        RMSD of each frame after superposition, (frames, 3, 3) rotation
+        matrices and the (frames, 3) and (3,) centres of the frames and the
+        reference. Frame f is superimposed by
+        (coordinates[f] - centres[f]) @ rotations[f] + reference_centre.
+    '''
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    reference = np.asarray(reference, dtype=np.float64)
+    if weights is None:
+        weights = np.ones(reference.shape[0])
+    weights = np.asarray(weights, dtype=np.float64)
+    total = weights.sum()
+
+    reference_centre = weights @ reference / total
+    centres = np.einsum('n,fni->fi', weights, coordinates) / total
+    y = reference - reference_centre
+    x = coordinates - centres[:, None, :]
+
+    # Covariance of each frame with the reference and its SVD
+    covariance = np.einsum('fni,n,nj->fij', x, weights, y)
+    u, s, vt = np.linalg.svd(covariance)
+    sign = np.sign(np.linalg.det(u @ vt))
+    sign[sign == 0] = 1
+    s[:, 2] *= sign
+    u[:, :, 2] *= sign[:, None]
+    rotations = u @ vt
+
+    # The residual follows from the singular values without rotating
+    e0 = np.einsum('fni,n,fni->f', x, weights, x) + np.einsum('ni,n,ni->', y, weights, y)
+    rmsd = np.sqrt(np.maximum(e0 - 2 * s.sum(axis=1), 0) / total)
+    return rmsd, rotations, centres, reference_centre
+
+class Fluctuations:
+    '''Running statistics of aligned coordinates, merged with Chan et al.'s
+    parallel algorithm.
+
+    Attributes
+    ----------
+    n : int
+        Number of frames.
+
+    mean : np.ndarray
+        (atoms, 3) mean coordinates.
+
+    m2 : np.ndarray
+        Sum of squared deviations from the mean of each atom.
+    '''
+
+    def __init__(self, n=0, mean=None, m2=None):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    @classmethod
+    def from_coordinates(cls, coordinates):
+        '''Returns the statistics of a (frames, atoms, 3) array.'''
+        mean = coordinates.mean(axis=0)
+        m2 = ((coordinates - mean) ** 2).sum(axis=(0, 2))
+        return cls(len(coordinates), mean, m2)
+
+    def merge(self, other):
+        '''Returns the statistics of both sets of frames.'''
+        if self.n == 0:
+            return other
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other.n / n
+        m2 = self.m2 + other.m2 + (delta ** 2).sum(axis=1) * self.n * other.n / n
+        return Fluctuations(n, mean, m2)
+
+    @property
+    def rmsf(self):
+        '''np.ndarray : Root mean square fluctuation of each atom.'''
+        return np.sqrt(self.m2 / self.n)
+
+class RMSDAnalysis:
+    '''RMSD and RMSF of a protein over trajectories.
+
+    Frames are superimposed onto the reference using the fit atoms (by
+    default the CA atoms of the protein). The RMSD of each frame is that of
+    the fit atoms and the RMSF of every protein atom is taken about its mean
+    aligned position, then averaged over each residue (mass weighted).
+
+    The atom indices come from the full topology, so stripped trajectories
+    (see amberpy.reduction) can be analysed as long as the protein is at the
+    start of the system, as it is in the systems made by tleap.
+
+    Attributes
+    ----------
+    topology : Topology
+        Topology of the system.
+
+    reference : np.ndarray
+        Reference coordinates of the protein atoms.
+
+    atoms : np.ndarray
+        Indices of the protein atoms.
+
+    fit : np.ndarray
+        Indices (into atoms) of the atoms used for the superposition and the
+        RMSD.
+
+    mass_weighted : bool
+        Weight the superposition and the RMSD by the atom masses.
+    '''
+
+    def __init__(self, parm7, reference, residues=None, fit=('CA',), mass_weighted=False):
+        '''
+        Parameters
+        ----------
+        parm7 : str
+            Path of the topology.
+
+        reference : str
+            Path of the reference structure (an rst7 file).
+
+        residues : list, optional
+            (first, last) ranges of protein residue numbers (from 1, as
+            given by Experiment.protein_termini). Defaults to every residue.
+
+        fit : list, default=('CA',)
+            Names of the atoms used for the superposition and the RMSD. If
+            None, every protein atom is used.
+
+        mass_weighted : bool, default=False
+            Weight the superposition and the RMSD by the atom masses.
+        '''
+        self.topology = Topology(parm7)
+        residue_numbers = self.topology.atom_residues + 1
+        if residues is None:
+            mask = np.ones(self.topology.n_atoms, dtype=bool)
+        else:
+            mask = np.zeros(self.topology.n_atoms, dtype=bool)
+            for first, last in residues:
+                mask |= (residue_numbers >= first) & (residue_numbers <= last)
+        self.atoms = np.nonzero(mask)[0]
+        if len(self.atoms) == 0:
+            raise Exception(f'No atoms of {parm7} are in residues {residues}')
+
+        if fit is None:
+            self.fit = np.arange(len(self.atoms))
+        else:
+            names = np.array(self.topology.atom_names)[self.atoms]
+            self.fit = np.nonzero(np.isin(names, list(fit)))[0]
+            if len(self.fit) < 3:
+                raise Exception(f'Fewer than 3 atoms named {list(fit)} to superimpose')
+
+        coordinates, _ = read_restart(reference)
+        if len(coordinates) != self.topology.n_atoms:
+            raise Exception(f'{reference} has {len(coordinates)} atoms but {parm7} '
+                            f'has {self.topology.n_atoms}')
+        self.reference = coordinates[self.atoms]
+        self.mass_weighted = mass_weighted
+
+    @classmethod
+    def from_experiment(cls, experiment, **kwargs):
+        '''Returns the analysis of an experiment's protein, using the
+        structure from its last finished minimisation step (or else the
+        structure made by tleap) as the reference.'''
+        reference = experiment.rst7
+        for step_number, md_step in enumerate(experiment.md_steps, start=1):
+            rst7 = os.path.join(experiment.simulation_directory,
+                                experiment._step_prefix(step_number) + '.rst7')
+            if str(md_step) == 'minimisation' and os.path.isfile(rst7) and os.path.getsize(rst7):
+                reference = rst7
+        return cls(experiment.parm7, reference, experiment.protein_termini, **kwargs)
+
+    @property
+    def weights(self):
+        '''np.ndarray : Weight of each fit atom.'''
+        if self.mass_weighted:
+            return self.topology.masses[self.atoms][self.fit]
+        return None
+
+    def map(self, frames):
+        '''Returns the RMSD and fluctuations of a chunk of frames of the
+        protein atoms.'''
+        coordinates = frames.coordinates
+        rmsd, rotations, centres, reference_centre = kabsch(coordinates[:, self.fit],
+                                                            self.reference[self.fit],
+                                                            self.weights)
+        aligned = np.einsum('fni,fij->fnj', coordinates - centres[:, None, :], rotations)
+        aligned += reference_centre
+        return {'indices': frames.indices,
+                'times': frames.times,
+                'rmsd': rmsd,
+                'fluctuations': Fluctuations.from_coordinates(aligned)}
+
+    @staticmethod
+    def reduce(accumulated, partial):
+        '''Merges the results of two chunks (in order).'''
+        return {key: np.concatenate([accumulated[key], partial[key]])
+                if key != 'fluctuations' else accumulated[key].merge(partial[key])
+                for key in accumulated}
+
+    def run(self, sources, executor=None, stripped=False):
+        '''Runs the analysis.
+
+        Parameters
+        ----------
+        sources : Simulation, str or list
+            Simulations and/or trajectory paths, whose frames are taken one
+            after the other.
+
+        executor : AnalysisExecutor, optional
+            Executor used to run the analysis. Defaults to one using every
+            cpu.
+
+        stripped : bool, default=False
+            Use the stripped trajectories of the simulations.
+
+        Returns
+        -------
+        dict
+            The 'rmsd' and 'times' of each frame, and its index in the
+            trajectories ('frames'), the 'rmsf' of each residue with its
+            number ('residues', from 1) and name ('residue_names'), and the
+            'atom_rmsf' of each protein atom.
+        '''
+        executor = executor or AnalysisExecutor()
+        initial = {'indices': np.empty(0, dtype=int),
+                   'times': np.empty(0),
+                   'rmsd': np.empty(0),
+                   'fluctuations': Fluctuations()}
+        result = executor.run(sources, self.map, self.reduce, initial, self.atoms, stripped)
+        fluctuations = result['fluctuations']
+        if fluctuations.n == 0:
+            raise Exception('No frames to analyse')
+
+        # Mass weighted mean square fluctuation of each residue
+        atom_rmsf = fluctuations.rmsf
+        masses = self.topology.masses[self.atoms]
+        atom_residues = self.topology.atom_residues[self.atoms]
+        residues, inverse = np.unique(atom_residues, return_inverse=True)
+        msf = np.bincount(inverse, masses * atom_rmsf ** 2) / np.bincount(inverse, masses)
+
+        return {'rmsd': result['rmsd'],
+                'times': result['times'],
+                'frames': result['indices'],
+                'rmsf': np.sqrt(msf),
+                'residues': residues + 1,
+                'residue_names': [self.topology.residue_names[r] for r in residues],
+                'atom_rmsf': atom_rmsf}
@@ -0,0 +1,1243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the scheduler backends used to submit jobs to a HPC
+cluster (or the local machine) without going through longbow.
+
+Job
+    Description of a single job (or array job) to be submitted.
+
+Task
+    One element of an array job, with its own working directory and commands.
+
+Scheduler
+    Base class defining the submit, dependency, array, status and cancel
+    interface shared by all of the backends.
+
+SGEScheduler
+    Submits jobs to a Sun Grid Engine scheduler (e.g. Arc3/Arc4).
+
+SlurmScheduler
+    Submits jobs to a Slurm scheduler.
+
+LocalScheduler
+    Runs jobs as subprocesses on the local machine.
+
+FakeScheduler
+    In-process scheduler that simulates queue wait and run time on a virtual
+    clock. Used to test the orchestration of thousands of jobs without a
+    cluster.
+
+get_scheduler(name, **kwargs)
+    Returns a scheduler instance from its name ('sge', 'slurm', 'local' or
+    'fake').
+"""
+import heapq
+import itertools
+import os
+import random
+import shlex
+import subprocess
+import threading
+import time
+import logging
+
+from amberpy.utilities import file_hash
+from amberpy.staging import get_transport
+
+logger = logging.getLogger(__name__)
+
+# Job states reported by all of the schedulers
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+COMPLETED = 'COMPLETED'
+FAILED = 'FAILED'
+CANCELLED = 'CANCELLED'
+TIMEOUT = 'TIMEOUT'
+UNKNOWN = 'UNKNOWN'
+
+# States after which a job will not change again
+FINISHED_STATES = (COMPLETED, FAILED, CANCELLED, TIMEOUT, UNKNOWN)
+
+def walltime_to_seconds(walltime):
+    '''Converts a walltime given as 'HH:MM:SS', 'HH:MM' (the longbow
+    format) or a number of seconds into an integer number of seconds.
+    '''
+    if walltime is None:
+        return None
+    if isinstance(walltime, (int, float)):
+        return int(walltime)
+    fields = [int(field) for field in str(walltime).split(':')]
+    if len(fields) == 2:
+        fields.append(0)
+    if len(fields) != 3:
+        raise Exception(f'Walltime must be in the format HH:MM:SS, not {walltime}')
+    hours, minutes, seconds = fields
+    return hours*3600 + minutes*60 + seconds
+
+def seconds_to_walltime(seconds):
+    '''Converts a number of seconds into a 'HH:MM:SS' walltime string.'''
+    seconds = int(seconds)
+    return f'{seconds // 3600:02d}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d}'
+
+class Task:
+    '''One element of an array job.
+
+    Attributes
+    ----------
+    workdir : str
+        Directory in which the task is run.
+
+    commands : list
+        Shell commands run by the task.
+
+    inputs : list
+        Local files the task reads, staged to the host before the job is
+        submitted if the scheduler has a stager.
+
+    requires : list
+        Shell commands run in workdir before the task's commands, as for
+        Job.requires.
+    '''
+    def __init__(self, workdir, commands, inputs=None, requires=None):
+        self.workdir = workdir
+        self.commands = list(commands)
+        self.inputs = list(inputs) if inputs is not None else []
+        self.requires = list(requires) if requires is not None else []
+
+class Job:
+    '''Description of a job to be submitted to a scheduler.
+
+    Attributes
+    ----------
+    name : str
+        Name of the job. The job's output file is named
+        '{name}.o{job_id}' ('{name}.o{job_id}.{task}' for array tasks).
+
+    commands : list
+        Shell commands run by the job. Ignored if tasks are given.
+
+    workdir : str
+        Directory in which the job is run.
+
+    cores : int, default=1
+        Number of cpu cores requested.
+
+    gpus : int, default=0
+        Number of gpus requested.
+
+    walltime : str or int, optional
+        Maximum run time of the job. If None, the scheduler default is used.
+
+    dependencies : list
+        Job ids which must complete successfully before this job starts.
+        Slurm enforces this itself (afterok) but SGE only waits for the
+        dependencies to finish, so on SGE the job's requires are checked
+        before it runs and the dependents of failed jobs are cancelled.
+
+    tasks : list, optional
+        List of Task objects. If given, the job is submitted as an array job
+        with one element per task.
+
+    task_dependencies : list
+        Array job ids for which task i of this job must wait for task i of
+        the dependency to complete successfully.
+
+    exclude : list
+        Node names that the job should not run on (if supported by the
+        scheduler).
+
+    inputs : list
+        Local files the job reads, staged to the host before the job is
+        submitted if the scheduler has a stager.
+
+    requires : list
+        Shell commands (e.g. tests that the outputs of the dependencies
+        exist) run in workdir before the job's commands. If one fails, the
+        job exits without running its commands.
+    '''
+    def __init__(self,
+                 name,
+                 commands=None,
+                 workdir=None,
+                 cores=1,
+                 gpus=0,
+                 walltime=None,
+                 dependencies=None,
+                 tasks=None,
+                 task_dependencies=None,
+                 exclude=None,
+                 inputs=None,
+                 requires=None):
+
+        # Job names on arc cannot start with a digit
+        if name[0].isdigit():
+            name = 'a'+name
+
+        self.name = name
+        self.commands = list(commands) if commands is not None else []
+        self.workdir = workdir if workdir is not None else os.getcwd()
+        self.cores = cores
+        self.gpus = gpus
+        self.walltime = walltime
+        self.dependencies = [str(d) for d in dependencies or [] if d]
+        self.tasks = tasks
+        self.task_dependencies = [str(d) for d in task_dependencies or [] if d]
+        self.exclude = list(exclude) if exclude is not None else []
+        self.inputs = list(inputs) if inputs is not None else []
+        self.requires = list(requires) if requires is not None else []
+
+    @property
+    def n_tasks(self):
+        '''int : Number of array tasks (0 if this is not an array job).'''
+        return len(self.tasks) if self.tasks else 0
+
+class Scheduler:
+    '''Base class for scheduler backends.
+
+    Do not use this class directly, instead use one of the classes which
+    inherit from it: SGEScheduler, SlurmScheduler, LocalScheduler or
+    FakeScheduler. Batch schedulers only need to implement the _directives,
+    _submit_command, _parse_job_id, _query and _cancel_command methods.
+
+    Attributes
+    ----------
+    host : str or None
+        Host on which scheduler commands are run (via ssh). If None,
+        commands are run on the local machine.
+
+    default_walltime : str
+        Walltime requested for jobs which do not specify one.
+
+    polling_frequency : int
+        Seconds between status checks when waiting for jobs.
+
+    gpu_modules, cpu_modules : list
+        Environment modules loaded by gpu and cpu jobs respectively.
+
+    gpu_executable, cpu_executable : str
+        Amber executables used for gpu and cpu jobs respectively.
+
+    mpi_launcher : str
+        Launcher used to run the cpu executable on more than one core.
+
+    stager : Stager, optional
+        If given, the inputs of each job are staged to the host before it is
+        submitted and jobs run in the staged directories (see
+        amberpy.staging). Otherwise the job directories must be visible to
+        the host.
+    '''
+
+    name = None
+
+    # Environment variable containing the array task id (1-based)
+    task_id_variable = 'AMBERPY_TASK_ID'
+
+    # Exit status of jobs whose requires are not met
+    requirement_exit_code = 1
+
+    def __init__(self,
+                 host=None,
+                 default_walltime='48:00:00',
+                 polling_frequency=60,
+                 gpu_modules=('amber/20gpu',),
+                 cpu_modules=('amber',),
+                 gpu_executable='pmemd.cuda_SPFP',
+                 cpu_executable='pmemd.MPI',
+                 mpi_launcher='mpirun',
+                 stager=None):
+
+        self.host = host
+        self.default_walltime = default_walltime
+        self.polling_frequency = polling_frequency
+        self.gpu_modules = list(gpu_modules)
+        self.cpu_modules = list(cpu_modules)
+        self.gpu_executable = gpu_executable
+        self.cpu_executable = cpu_executable
+        self.mpi_launcher = mpi_launcher
+        self.stager = stager
+
+        # Jobs submitted through this scheduler, keyed by job id
+        self.jobs = {}
+        self._lock = threading.RLock()
+
+    def pmemd_executable(self, gpus=0, cores=1):
+        '''Returns the command used to launch pmemd for the given resources.'''
+        if gpus:
+            return self.gpu_executable
+        elif cores > 1:
+            return f'{self.mpi_launcher} -np {cores} {self.cpu_executable}'
+        else:
+            return self.cpu_executable.replace('.MPI', '')
+
+    def render(self, job):
+        '''Returns the job script for a job.'''
+        lines = ['#!/bin/bash'] + self._directives(job)
+
+        modules = self.gpu_modules if job.gpus else self.cpu_modules
+        for module in modules:
+            lines.append(f'module load {module}')
+
+        workdir = shlex.quote(self._remote_path(job.workdir))
+        if job.requires:
+            lines.append(f'cd {workdir} || exit 1')
+            lines += self._requirements(job.requires)
+
+        if job.tasks:
+
+            # Each array task runs in its own directory with its own commands
+            lines.append(f'AMBERPY_TASK_ID=${{{self.task_id_variable}}}')
+            lines.append('case "$AMBERPY_TASK_ID" in')
+            for i, task in enumerate(job.tasks):
+                lines.append(f'    {i+1})')
+                lines.append(f'        cd {shlex.quote(self._remote_path(task.workdir))} || exit 1')
+                lines += ['        ' + line for line in self._requirements(task.requires)]
+                for command in task.commands:
+                    lines.append(f'        {command}')
+                lines.append('        ;;')
+            lines.append('esac')
+        else:
+            if not job.requires:
+                lines.append(f'cd {workdir} || exit 1')
+            lines += job.commands
+
+        return '\n'.join(lines) + '\n'
+
+    def _requirements(self, requires):
+        '''Returns the lines of a job script which exit if any of the
+        requires fail.'''
+        lines = []
+        for requirement in requires:
+            message = shlex.quote(f'Requirement not met: {requirement}')
+            lines.append(f'{requirement} || {{ echo {message}; exit {self.requirement_exit_code}; }}')
+        return lines
+
+    def submit(self, job):
+        '''Submits a job and returns its job id.'''
+        self.stage(job)
+        out = self._run(self._submit_command(job), input=self.render(job))
+        job_id = self._parse_job_id(out)
+        with self._lock:
+            self.jobs[job_id] = job
+        logger.debug(f"Submitted job '{job.name}' with id {job_id}")
+        return job_id
+
+    def stage(self, job):
+        '''Stages the inputs of a job (and its tasks) to the host, if the
+        scheduler has a stager.'''
+        if self.stager is not None:
+            self.stager.stage(job.inputs + [f for task in job.tasks or [] for f in task.inputs])
+
+    def submit_array(self, job, tasks):
+        '''Submits a list of Task objects as a single array job and returns
+        its job id.
+        '''
+        job.tasks = list(tasks)
+        return self.submit(job)
+
+    def status(self, job_id):
+        '''Returns the state of a job (e.g. PENDING, RUNNING, COMPLETED).'''
+        return self.info(job_id)['state']
+
+    def info(self, job_id):
+        '''Returns a dictionary describing a job. It always contains the
+        'state' of the job and may also contain the 'node' it ran on, the
+        number of 'nodes' it was allocated, the 'elapsed' run time in
+        seconds, the 'exit_code' and, for array jobs, the state of each of
+        the 'tasks'.
+        '''
+        return self._query(str(job_id))
+
+    def cancel(self, job_id):
+        '''Cancels a pending or running job.'''
+        self._run(self._cancel_command(str(job_id)), check=False)
+        logger.debug(f'Cancelled job {job_id}')
+
+    def wait(self, job_ids, callback=None, polling_frequency=None):
+        '''Blocks until all of the jobs have finished.
+
+        Parameters
+        ----------
+        job_ids : list
+            Job ids to wait for.
+
+        callback : callable, optional
+            Called with a dictionary of job states after every poll.
+
+        polling_frequency : int, optional
+            Overrides the polling_frequency attribute.
+
+        Returns
+        -------
+        dict
+            Final state of each job.
+        '''
+        if polling_frequency is None:
+            polling_frequency = self.polling_frequency
+
+        states = {job_id: None for job_id in job_ids}
+        while True:
+
+            # Finished jobs can't change state so only query unfinished ones
+            for job_id, state in list(states.items()):
+                if state not in FINISHED_STATES:
+                    states[job_id] = self.status(job_id)
+                    if states[job_id] in FINISHED_STATES and states[job_id] != COMPLETED:
+                        self._job_failed(job_id, states)
+            if callback is not None:
+                callback(states)
+            if all(state in FINISHED_STATES for state in states.values()):
+                return states
+            self.sleep(polling_frequency)
+
+    def job_output(self, job_id, task=None):
+        '''Returns the contents of the job's output file or an empty string
+        if it can't be read.
+        '''
+        job = self.jobs[str(job_id)]
+        fname = f'{job.name}.o{job_id}'
+        if task is not None:
+            fname += f'.{task}'
+        return self._run(['cat', os.path.join(self._remote_path(job.workdir), fname)], check=False)
+
+    def file_hash(self, path):
+        '''Returns the sha256 hash of a file on the scheduler host, or None if
+        it does not exist.
+        '''
+        if self.host is None:
+            return file_hash(path)
+        out = self._run(['sha256sum', path], check=False).split()
+        return out[0] if out else None
+
+    def now(self):
+        '''Returns the current time of the scheduler in seconds.'''
+        return time.time()
+
+    def sleep(self, seconds):
+        '''Sleeps on the scheduler's clock.'''
+        time.sleep(seconds)
+
+    def _run(self, args, input=None, check=True):
+        '''Runs a command on the scheduler host and returns its stdout.'''
+        # Commands share one connection to the host
+        if self.host is not None:
+            args = get_transport(self.host).command(' '.join(shlex.quote(arg) for arg in args))
+
+        p = subprocess.run(args,
+                           input=input,
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE,
+                           universal_newlines=True)
+
+        if check and p.returncode != 0:
+            raise Exception(f"Command '{' '.join(args)}' failed with exit "
+                            f"status {p.returncode}: {p.stderr.strip()}")
+        return p.stdout
+
+    def _dependents(self, job_id, tasks=None):
+        '''Returns the submitted jobs which depend, directly or through
+        other jobs, on a job (or on some of its array tasks).
+
+        Returns
+        -------
+        list
+            (job id, tasks) of each dependent job, in the order they depend
+            on each other. tasks is None if the whole job depends on the
+            job, otherwise it is the list of the job's array tasks which
+            depend on it through task_dependencies.
+        '''
+        with self._lock:
+            dependents = {}
+            parents = [(str(job_id), tasks)]
+            while parents:
+                parent, parent_tasks = parents.pop(0)
+                for other_id, job in self.jobs.items():
+                    if parent in job.dependencies:
+                        other_tasks = None
+                    elif parent in job.task_dependencies:
+                        other_tasks = parent_tasks
+                        if other_tasks is None:
+                            other_tasks = [str(task) for task in range(1, job.n_tasks + 1)]
+                    else:
+                        continue
+                    if other_id in dependents:
+                        known = dependents[other_id]
+                        if known is None:
+                            continue
+                        if other_tasks is not None:
+                            other_tasks = sorted(set(known) | set(other_tasks), key=int)
+                            if other_tasks == known:
+                                continue
+                        del dependents[other_id]
+                    dependents[other_id] = other_tasks
+                    parents.append((other_id, other_tasks))
+            return list(dependents.items())
+
+    def _job_failed(self, job_id, states):
+        '''Called by wait when a job finishes without completing.'''
+        pass
+
+    def _remote_path(self, path):
+        '''Returns the path on the host of a local path.'''
+        if self.stager is None:
+            return path
+        return self.stager.remote_path(path)
+
+    def _walltime(self, job):
+        return seconds_to_walltime(walltime_to_seconds(job.walltime or self.default_walltime))
+
+    def _directives(self, job):
+        return []
+
+    def _submit_command(self, job):
+        raise NotImplementedError
+
+    def _parse_job_id(self, out):
+        raise NotImplementedError
+
+    def _query(self, job_id):
+        raise NotImplementedError
+
+    def _cancel_command(self, job_id):
+        raise NotImplementedError
+
+class SGEScheduler(Scheduler):
+    '''Sun Grid Engine scheduler, as used on Arc3 and Arc4.
+
+    Attributes
+    ----------
+    parallel_environment : str, default='ib'
+        Parallel environment requested by multi-core jobs.
+
+    gpu_resource : str, default='coproc_p100'
+        Resource requested for each gpu (use 'coproc_v100' on Arc4).
+
+    accounting_timeout : int, default=300
+        Seconds a job which has left qstat is still treated as pending
+        while qacct has no record of it (qacct lags behind qstat), before
+        its state is given as UNKNOWN.
+
+    Notes
+    -----
+    -hold_jid releases a job when its dependencies finish, whatever their
+    exit status. Jobs whose requires are not met therefore exit with status
+    100, which puts them into the error state so that their own dependents
+    stay on hold, and wait cancels the dependents of any job that fails.
+    '''
+
+    name = 'sge'
+    task_id_variable = 'SGE_TASK_ID'
+
+    # SGE puts jobs which exit with status 100 into the error state
+    requirement_exit_code = 100
+
+    def __init__(self,
+                 host=None,
+                 parallel_environment='ib',
+                 gpu_resource='coproc_p100',
+                 accounting_timeout=300,
+                 **kwargs):
+
+        super().__init__(host=host, **kwargs)
+        self.parallel_environment = parallel_environment
+        self.gpu_resource = gpu_resource
+        self.accounting_timeout = accounting_timeout
+
+        # When each job missing from both qstat and qacct was first seen
+        self._unaccounted = {}
+
+        # State of the jobs removed by amberpy, which may never appear in
+        # qacct
+        self._removed = {}
+
+    def cancel(self, job_id):
+        with self._lock:
+            self._removed[str(job_id)] = CANCELLED
+        super().cancel(job_id)
+
+    def _job_failed(self, job_id, states):
+
+        # Only the tasks of dependent array jobs which depend on the failed
+        # tasks of an array job are cancelled
+        tasks = self.info(job_id).get('tasks')
+        if tasks is not None:
+            tasks = sorted((task for task, state in tasks.items() if state != COMPLETED), key=int)
+
+        # A job in the error state is still queued and holds its
+        # dependents, so the dependents are cancelled (last first, so none
+        # is released) before the failed job is removed
+        for dependent, dependent_tasks in reversed(self._dependents(job_id, tasks)):
+            if dependent_tasks is not None:
+                logger.info(f'Cancelling tasks {",".join(dependent_tasks)} of job '
+                            f'{dependent} as job {job_id} failed')
+                for task in dependent_tasks:
+                    self._run(['qdel', dependent, '-t', task], check=False)
+            elif states.get(dependent) not in FINISHED_STATES:
+                logger.info(f'Cancelling job {dependent} as job {job_id} failed')
+                self.cancel(dependent)
+        with self._lock:
+            self._removed.setdefault(str(job_id), states[job_id])
+        self._run(self._cancel_command(str(job_id)), check=False)
+
+    def _directives(self, job):
+        lines = [f'#$ -N {job.name}',
+                 f'#$ -wd {self._remote_path(job.workdir)}',
+                 '#$ -j y',
+                 '#$ -V',
+                 f'#$ -l h_rt={self._walltime(job)}']
+        if job.gpus:
+            lines.append(f'#$ -l {self.gpu_resource}={job.gpus}')
+        elif job.cores > 1:
+            lines.append(f'#$ -pe {self.parallel_environment} {job.cores}')
+        if job.dependencies:
+            lines.append(f'#$ -hold_jid {",".join(job.dependencies)}')
+        if job.task_dependencies:
+            lines.append(f'#$ -hold_jid_ad {",".join(job.task_dependencies)}')
+        if job.tasks:
+            lines.append(f'#$ -t 1-{job.n_tasks}')
+        if job.exclude:
+
+            # Only the last -l h= request is kept, so the nodes are excluded
+            # in one expression
+            lines.append(f'#$ -l h=!({"|".join(job.exclude)})')
+        return lines
+
+    def _submit_command(self, job):
+        return ['qsub', '-terse']
+
+    def _parse_job_id(self, out):
+        # Array jobs are returned as e.g. '12345.1-4:1'
+        return out.strip().split('.')[0]
+
+    def _query(self, job_id):
+
+        # Pending and running jobs are listed by qstat
+        tasks = {}
+        for line in self._run(['qstat', '-u', '*'], check=False).splitlines():
+            fields = line.split()
+            if not fields or fields[0] != job_id:
+                continue
+            state = fields[4]
+            if 'E' in state:
+                state = FAILED
+            elif 'r' in state or 't' in state:
+                state = RUNNING
+            else:
+                state = PENDING
+
+            # The queue column is only filled in for running jobs, so the
+            # columns after the submit/start date and time are [queue]
+            # slots [ja-task-ID]
+            columns = fields[7:]
+            if columns and not columns[0].isdigit():
+                columns = columns[1:]
+            if len(columns) > 1:
+                for task in _sge_task_ids(columns[1]):
+                    tasks[task] = state
+            else:
+                tasks[None] = state
+
+        if tasks:
+            states = set(tasks.values())
+            for state in (RUNNING, PENDING, FAILED):
+                if state in states:
+                    info = {'state': state}
+                    break
+            if len(tasks) > 1 or None not in tasks:
+                info['tasks'] = tasks
+            return info
+
+        # Finished jobs are only listed by qacct
+        return self._accounting(job_id)
+
+    def _accounting(self, job_id):
+
+        records = []
+        record = {}
+        for line in self._run(['qacct', '-j', job_id], check=False).splitlines():
+            if line.startswith('=='):
+                if record:
+                    records.append(record)
+                record = {}
+                continue
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                record[fields[0]] = fields[1].strip()
+        if record:
+            records.append(record)
+
+        if not records:
+            if job_id in self._removed:
+                return {'state': self._removed[job_id]}
+            with self._lock:
+                first_seen = self._unaccounted.setdefault(job_id, self.now())
+            if self.now() - first_seen < self.accounting_timeout:
+                return {'state': PENDING}
+            logger.warning(f'Job {job_id} is not listed by qstat or qacct')
+            return {'state': UNKNOWN}
+
+        tasks = {}
+        for record in records:
+            exit_code = int(record.get('exit_status', '0').split()[0])
+            failed = record.get('failed', '0').split()[0] != '0'
+            if failed and 'h_rt' in record.get('failed', ''):
+                state = TIMEOUT
+            elif exit_code == 137 and failed:
+                state = CANCELLED
+            elif failed or exit_code != 0:
+                state = FAILED
+            else:
+                state = COMPLETED
+            tasks[record.get('taskid', 'undefined')] = state
+
+        # Parallel jobs have a record for each host they ran on
+        last = records[-1]
+        hosts = set(record.get('hostname') for record in records
+                    if record.get('taskid') == last.get('taskid'))
+        info = {'state': COMPLETED,
+                'node': last.get('hostname'),
+                'nodes': len(hosts),
+                'elapsed': int(float(last.get('ru_wallclock', '0').rstrip('s'))),
+                'exit_code': int(last.get('exit_status', '0').split()[0])}
+        for state in (TIMEOUT, FAILED, CANCELLED):
+            if state in tasks.values():
+                info['state'] = state
+                break
+        if len(tasks) > 1 or 'undefined' not in tasks:
+            info['tasks'] = tasks
+        return info
+
+    def _cancel_command(self, job_id):
+        return ['qdel', job_id]
+
+def _sge_task_ids(field):
+    '''Returns the task ids in a qstat ja-task-ID field, e.g. '4-10:2' or
+    '1,3'.'''
+    ids = []
+    for part in field.split(','):
+        if '-' in part:
+            first, rest = part.split('-')
+            last, _, step = rest.partition(':')
+            ids += [str(task) for task in range(int(first), int(last) + 1, int(step or 1))]
+        else:
+            ids.append(part)
+    return ids
+
+class SlurmScheduler(Scheduler):
+    '''Slurm scheduler.
+
+    Attributes
+    ----------
+    partition : str, optional
+        Partition jobs are submitted to.
+
+    gpu_partition : str, optional
+        Partition gpu jobs are submitted to. Defaults to partition.
+
+    account : str, optional
+        Account jobs are charged to.
+    '''
+
+    name = 'slurm'
+    task_id_variable = 'SLURM_ARRAY_TASK_ID'
+
+    # Map of Slurm job states to amberpy job states
+    states = {'PENDING': PENDING,
+              'CONFIGURING': PENDING,
+              'REQUEUED': PENDING,
+              'RESIZING': PENDING,
+              'SUSPENDED': PENDING,
+              'RUNNING': RUNNING,
+              'COMPLETING': RUNNING,
+              'COMPLETED': COMPLETED,
+              'CANCELLED': CANCELLED,
+              'TIMEOUT': TIMEOUT,
+              'DEADLINE': TIMEOUT,
+              'FAILED': FAILED,
+              'NODE_FAIL': FAILED,
+              'OUT_OF_MEMORY': FAILED,
+              'BOOT_FAIL': FAILED,
+              'PREEMPTED': FAILED}
+
+    def __init__(self,
+                 host=None,
+                 partition=None,
+                 gpu_partition=None,
+                 account=None,
+                 **kwargs):
+
+        super().__init__(host=host, **kwargs)
+        self.partition = partition
+        self.gpu_partition = gpu_partition
+        self.account = account
+
+    def _directives(self, job):
+        output = f'{job.name}.o%A.%a' if job.tasks else f'{job.name}.o%j'
+        lines = [f'#SBATCH --job-name={job.name}',
+                 f'#SBATCH --chdir={self._remote_path(job.workdir)}',
+                 f'#SBATCH --output={output}',
+                 f'#SBATCH --time={self._walltime(job)}',
+                 f'#SBATCH --ntasks={max(job.cores, 1)}']
+        partition = self.gpu_partition if job.gpus and self.gpu_partition else self.partition
+        if partition:
+            lines.append(f'#SBATCH --partition={partition}')
+        if self.account:
+            lines.append(f'#SBATCH --account={self.account}')
+        if job.gpus:
+            lines.append(f'#SBATCH --gres=gpu:{job.gpus}')
+        dependencies = ([f'afterok:{d}' for d in job.dependencies] +
+                        [f'aftercorr:{d}' for d in job.task_dependencies])
+        if dependencies:
+            lines.append(f'#SBATCH --dependency={",".join(dependencies)}')
+            lines.append('#SBATCH --kill-on-invalid-dep=yes')
+        if job.tasks:
+            lines.append(f'#SBATCH --array=1-{job.n_tasks}')
+        if job.exclude:
+            lines.append(f'#SBATCH --exclude={",".join(job.exclude)}')
+        return lines
+
+    def _submit_command(self, job):
+        return ['sbatch', '--parsable']
+
+    def _parse_job_id(self, out):
+        # Federated clusters return 'job_id;cluster'
+        return out.strip().split(';')[0]
+
+    def _query(self, job_id):
+
+        out = self._run(['sacct', '-j', job_id, '-n', '-P', '-o',
+                         'JobID,State,NodeList,ElapsedRaw,ExitCode,NNodes'], check=False)
+        tasks = {}
+        info = {'state': UNKNOWN}
+        for line in out.splitlines():
+            fields = line.split('|')
+            if len(fields) < 6 or '.' in fields[0]:
+                # Skip job steps (e.g. 123.batch)
+                continue
+            state = self.states.get(fields[1].split()[0], UNKNOWN)
+            if '_' in fields[0]:
+                task = fields[0].split('_')[1]
+                if not task.startswith('['):
+                    tasks[task] = state
+                    continue
+                state = PENDING
+            info = {'state': state,
+                    'node': fields[2] or None,
+                    'elapsed': int(fields[3] or 0),
+                    'exit_code': int(fields[4].split(':')[0] or 0),
+                    'nodes': int(fields[5] or 1)}
+
+        if tasks:
+            states = set(tasks.values())
+            if info['state'] == PENDING:
+                states.add(PENDING)
+            for state in (RUNNING, PENDING, TIMEOUT, FAILED, CANCELLED, COMPLETED):
+                if state in states:
+                    info['state'] = state
+                    break
+            info['tasks'] = tasks
+        return info
+
+    def _cancel_command(self, job_id):
+        return ['scancel', job_id]
+
+class LocalScheduler(Scheduler):
+    '''Runs jobs as subprocesses on the local machine.
+
+    Dependencies and array jobs are handled in the same way as a batch
+    scheduler, which makes this useful for running short jobs (e.g.
+    benchmarks) on a workstation.
+
+    Attributes
+    ----------
+    max_jobs : int, default=1
+        Maximum number of jobs (or array tasks) run at the same time.
+    '''
+
+    name = 'local'
+
+    def __init__(self, max_jobs=1, polling_frequency=5, **kwargs):
+
+        # Modules are not available on most workstations
+        kwargs.setdefault('gpu_modules', ())
+        kwargs.setdefault('cpu_modules', ())
+
+        super().__init__(host=None, polling_frequency=polling_frequency, **kwargs)
+        self.max_jobs = max_jobs
+        self._ids = itertools.count(1)
+        self._units = {}
+        self._order = []
+
+    def submit(self, job):
+        self.stage(job)
+        with self._lock:
+            job_id = str(next(self._ids))
+            self.jobs[job_id] = job
+            script = os.path.join(self._remote_path(job.workdir), f'{job.name}.{job_id}.sh')
+            os.makedirs(os.path.dirname(script), exist_ok=True)
+            with open(script, 'w') as f:
+                f.write(self.render(job))
+            for task in range(1, max(job.n_tasks, 1) + 1):
+                key = (job_id, task if job.tasks else None)
+                self._units[key] = {'state': PENDING, 'script': script, 'process': None}
+                self._order.append(key)
+            self._update()
+        logger.debug(f"Submitted job '{job.name}' with id {job_id}")
+        return job_id
+
+    def info(self, job_id):
+        with self._lock:
+            self._update()
+            return _aggregate(self.jobs[str(job_id)],
+                              {key[1]: unit for key, unit in self._units.items()
+                               if key[0] == str(job_id)})
+
+    def cancel(self, job_id):
+        with self._lock:
+            for key, unit in self._units.items():
+                if key[0] != str(job_id) or unit['state'] in FINISHED_STATES:
+                    continue
+                if unit['process'] is not None:
+                    unit['process'].terminate()
+                unit['state'] = CANCELLED
+            self._update()
+
+    def _update(self):
+
+        # Check on running processes
+        for unit in self._units.values():
+            if unit['state'] == RUNNING:
+                returncode = unit['process'].poll()
+                if returncode is not None:
+                    unit['end'] = time.time()
+                    unit['exit_code'] = returncode
+                    unit['state'] = COMPLETED if returncode == 0 else FAILED
+
+        # Start any jobs whose dependencies are satisfied
+        running = sum(unit['state'] == RUNNING for unit in self._units.values())
+        for key in self._order:
+            unit = self._units[key]
+            if unit['state'] != PENDING:
+                continue
+            ready = _dependencies_ready(self.jobs[key[0]], key[1], self._units)
+            if ready is None:
+                unit['state'] = CANCELLED
+            elif ready and running < self.max_jobs:
+                self._start(key, unit)
+                running += 1
+
+    def _start(self, key, unit):
+        job_id, task = key
+        job = self.jobs[job_id]
+        fname = f'{job.name}.o{job_id}' + (f'.{task}' if task is not None else '')
+        env = dict(os.environ)
+        if task is not None:
+            env[self.task_id_variable] = str(task)
+        workdir = self._remote_path(job.workdir)
+        with open(os.path.join(workdir, fname), 'w') as out:
+            unit['process'] = subprocess.Popen(['bash', unit['script']],
+                                               cwd=workdir,
+                                               env=env,
+                                               stdout=out,
+                                               stderr=subprocess.STDOUT)
+        unit['state'] = RUNNING
+        unit['start'] = time.time()
+        unit['node'] = 'localhost'
+
+    def job_output(self, job_id, task=None):
+        job = self.jobs[str(job_id)]
+        fname = f'{job.name}.o{job_id}' + (f'.{task}' if task is not None else '')
+        try:
+            with open(os.path.join(self._remote_path(job.workdir), fname), 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return ''
+
+class FakeScheduler(Scheduler):
+    '''In-process scheduler which simulates queue wait and run time on a
+    virtual clock.
+
+    Nothing is executed: jobs move from PENDING to RUNNING after the queue
+    wait and finish after the run time, respecting dependencies, arrays,
+    walltimes and the number of available slots. Because time is virtual,
+    waiting for thousands of week-long jobs takes seconds, so this can be
+    used to load-test the orchestration code on a laptop.
+
+    Attributes
+    ----------
+    queue_wait : float or callable, default=0.0
+        Seconds a job waits in the queue once its dependencies are
+        satisfied. If callable, it is called with (job, task).
+
+    run_time : float or callable, default=3600.0
+        Seconds a job runs for. If callable, it is called with (job, task).
+
+    slots : int or None, default=None
+        Maximum number of jobs running at the same time (None is unlimited).
+
+    nodes : int, default=16
+        Number of simulated nodes that jobs are spread across.
+
+    fail : callable, optional
+        Called with (job, task, node) when a job finishes. If it returns a
+        string, the job fails and the string is written to its output.
+
+    failure_rate : float, default=0.0
+        Probability that a job fails at random.
+
+    on_finish : callable, optional
+        Called with (job, task, state) when a job finishes, e.g. to create
+        the job's output files.
+
+    seed : int, optional
+        Seed for the random number generator.
+    '''
+
+    name = 'fake'
+
+    def __init__(self,
+                 queue_wait=0.0,
+                 run_time=3600.0,
+                 slots=None,
+                 nodes=16,
+                 fail=None,
+                 failure_rate=0.0,
+                 on_finish=None,
+                 seed=None,
+                 **kwargs):
+
+        super().__init__(host=None, **kwargs)
+        self.queue_wait = queue_wait
+        self.run_time = run_time
+        self.slots = slots
+        self.nodes = [f'node{i+1:03d}' for i in range(nodes)]
+        self.fail = fail
+        self.failure_rate = failure_rate
+        self.on_finish = on_finish
+        self.random = random.Random(seed)
+        self.time = 0.0
+        self.submitted = 0
+
+        self._ids = itertools.count(1)
+        self._seq = itertools.count()
+        self._units = {}
+        self._job_units = {}
+        self._waiting_on = {}
+        self._waiters = {}
+        self._ready = []
+        self._running = []
+        self._n_running = 0
+        self._next_node = 0
+
+    def submit(self, job):
+        with self._lock:
+            job_id = str(next(self._ids))
+            self.jobs[job_id] = job
+            self.submitted += 1
+            keys = [(job_id, task) for task in (range(1, job.n_tasks + 1) if job.tasks else [None])]
+            self._job_units[job_id] = keys
+
+            for key in keys:
+                self._units[key] = {'state': PENDING, 'submit': self.time, 'output': ''}
+
+                # Find the units which must complete before this one can start
+                deps = set()
+                for dep in job.dependencies:
+                    deps.update(self._job_units.get(dep, []))
+                for dep in job.task_dependencies:
+                    if (dep, key[1]) in self._units:
+                        deps.add((dep, key[1]))
+
+                self._waiting_on[key] = set()
+                for dep in deps:
+                    state = self._units[dep]['state']
+                    if state in FINISHED_STATES and state != COMPLETED:
+                        self._waiting_on[key] = None
+                        break
+                    elif state not in FINISHED_STATES:
+                        self._waiting_on[key].add(dep)
+                        self._waiters.setdefault(dep, []).append(key)
+
+                if self._waiting_on[key] is None:
+                    self._finish(key, CANCELLED)
+                elif not self._waiting_on[key]:
+                    self._make_ready(key)
+
+            self._advance(self.time)
+        return job_id
+
+    def status(self, job_id):
+        # Skip building the info dictionary for single jobs since this is
+        # called for every job on every poll
+        keys = self._job_units[str(job_id)]
+        if len(keys) == 1:
+            return self._units[keys[0]]['state']
+        return self.info(job_id)['state']
+
+    def info(self, job_id):
+        with self._lock:
+            return _aggregate(self.jobs[str(job_id)],
+                              {key[1]: self._units[key] for key in self._job_units[str(job_id)]})
+
+    def cancel(self, job_id):
+        with self._lock:
+            for key in self._job_units[str(job_id)]:
+                if self._units[key]['state'] not in FINISHED_STATES:
+                    self._finish(key, CANCELLED)
+            self._advance(self.time)
+
+    def job_output(self, job_id, task=None):
+        with self._lock:
+            return self._units[(str(job_id), task)]['output']
+
+    def now(self):
+        return self.time
+
+    def sleep(self, seconds):
+        with self._lock:
+            self._advance(self.time + seconds)
+
+    def _value(self, value, job, task):
+        return value(job, task) if callable(value) else value
+
+    def _make_ready(self, key):
+        job = self.jobs[key[0]]
+        ready = self.time + self._value(self.queue_wait, job, key[1])
+        heapq.heappush(self._ready, (ready, next(self._seq), key))
+
+    def _start(self, key):
+        job = self.jobs[key[0]]
+        unit = self._units[key]
+
+        # Assign the next node that the job hasn't excluded
+        for _ in range(len(self.nodes)):
+            node = self.nodes[self._next_node % len(self.nodes)]
+            self._next_node += 1
+            if node not in job.exclude:
+                break
+
+        run_time = self._value(self.run_time, job, key[1])
+        walltime = walltime_to_seconds(job.walltime or self.default_walltime)
+        unit.update({'state': RUNNING, 'start': self.time, 'node': node})
+        unit['timeout'] = run_time > walltime
+        heapq.heappush(self._running, (self.time + min(run_time, walltime), next(self._seq), key))
+        self._n_running += 1
+
+    def _finish(self, key, state):
+
+        # Use a stack rather than recursion so that long chains of dependent
+        # jobs can be cancelled
+        stack = [(key, state)]
+        while stack:
+            key, state = stack.pop()
+            unit = self._units[key]
+            if unit['state'] == RUNNING:
+                self._n_running -= 1
+            unit['state'] = state
+            unit['end'] = self.time
+            if self.on_finish is not None:
+                self.on_finish(self.jobs[key[0]], key[1], state)
+
+            # Release (or cancel) any units waiting on this one
+            for dependent in self._waiters.pop(key, []):
+                if self._units[dependent]['state'] != PENDING or self._waiting_on[dependent] is None:
+                    continue
+                if state != COMPLETED:
+                    self._waiting_on[dependent] = None
+                    stack.append((dependent, CANCELLED))
+                else:
+                    self._waiting_on[dependent].discard(key)
+                    if not self._waiting_on[dependent]:
+                        self._make_ready(dependent)
+
+    def _advance(self, until):
+
+        while True:
+
+            # Start as many ready units as there are free slots
+            while (self._ready and self._ready[0][0] <= self.time and
+                   (self.slots is None or self._n_running < self.slots)):
+                _, _, key = heapq.heappop(self._ready)
+                if self._units[key]['state'] == PENDING:
+                    self._start(key)
+
+            # Find the time of the next event
+            next_time = None
+            if self._running:
+                next_time = self._running[0][0]
+            if self._ready and (self.slots is None or self._n_running < self.slots):
+                ready_time = max(self._ready[0][0], self.time)
+                next_time = ready_time if next_time is None else min(next_time, ready_time)
+
+            if next_time is None or next_time > until:
+                self.time = max(self.time, until)
+                return
+
+            self.time = next_time
+
+            # Finish any units whose run time is up
+            while self._running and self._running[0][0] <= self.time:
+                _, _, key = heapq.heappop(self._running)
+                unit = self._units[key]
+                if unit['state'] != RUNNING:
+                    continue
+                job = self.jobs[key[0]]
+                message = self.fail(job, key[1], unit['node']) if self.fail is not None else None
+                if message is None and self.random.random() < self.failure_rate:
+                    message = 'Job failed at random'
+                if unit['timeout']:
+                    unit['output'] = 'Job exceeded walltime'
+                    self._finish(key, TIMEOUT)
+                elif message:
+                    unit['output'] = message
+                    self._finish(key, FAILED)
+                else:
+                    self._finish(key, COMPLETED)
+
+def _dependencies_ready(job, task, units):
+    '''Returns True if all of a job's dependencies have completed, False if
+    any are still pending/running and None if any have failed.
+    '''
+    deps = [unit for key, unit in units.items() if key[0] in job.dependencies]
+    deps += [units[(dep, task)] for dep in job.task_dependencies if (dep, task) in units]
+    for unit in deps:
+        if unit['state'] in FINISHED_STATES and unit['state'] != COMPLETED:
+            return None
+    return all(unit['state'] == COMPLETED for unit in deps)
+
+def _aggregate(job, units):
+    '''Combines the states of the units (array tasks) of a job into a
+    single info dictionary.
+    '''
+    states = [unit['state'] for unit in units.values()]
+    for state in (RUNNING, PENDING, TIMEOUT, FAILED, CANCELLED, COMPLETED):
+        if state in states:
+            break
+
+    last = list(units.values())[-1]
+    info = {'state': state, 'node': last.get('node'), 'nodes': 1}
+    if 'start' in last:
+        info['elapsed'] = last.get('end', last['start']) - last['start']
+    if 'exit_code' in last:
+        info['exit_code'] = last['exit_code']
+    if job.tasks:
+        info['tasks'] = {task: unit['state'] for task, unit in units.items()}
+    return info
+
+def get_scheduler(name, **kwargs):
+    '''Returns a scheduler instance.
+
+    Parameters
+    ----------
+    name : str
+        Name of the scheduler: 'sge', 'slurm', 'local' or 'fake'.
+
+    **kwargs
+        Passed to the scheduler class.
+    '''
+    schedulers = {scheduler.name: scheduler for scheduler in
+                  (SGEScheduler, SlurmScheduler, LocalScheduler, FakeScheduler)}
+    try:
+        return schedulers[name.lower()](**kwargs)
+    except KeyError:
+        raise Exception(f'Scheduler must be one of {list(schedulers)}, not {name}')
@@ -16,10 +16,20 @@ ProductionInput
     ensemble.
 
 """
-from amberpy.crossbow import run_pmemd
-from amberpy.utilities import get_name_from_file
+from amberpy.crossbow import CrossbowClient, pmemd_arguments
+from amberpy.schedulers import Job, PENDING, RUNNING, COMPLETED, walltime_to_seconds, seconds_to_walltime
+from amberpy.retry import RetryPolicy, BOX_CHANGE, CUDA, UNKNOWN
+from amberpy.utilities import get_name_from_file, file_hash
+from amberpy.mdout import read_ns_per_day, read_mdout, concatenate_columns
+from amberpy.netcdf import TrajectoryFollower
+from amberpy.archive import archive_trajectory
+from amberpy.trajectory import restart_time
 import os
 import copy
+import glob
+import json
+import math
+import time
 from typing import Union
 from amberpy import get_module_logger
 import logging
@@ -411,6 +421,59 @@ class ProductionInput(MDInput):
     def __str__(self):
         return 'production'
 
+def segment_lengths(nstlim, dt, ns_per_day, walltime, safety_margin=0.1, ntwx=None):
+    '''Splits a number of MD steps into segments which each fit into a
+    walltime.
+
+    Parameters
+    ----------
+    nstlim : int
+        Total number of MD steps.
+
+    dt : float
+        Integrator time step in picoseconds.
+
+    ns_per_day : float
+        Speed of the simulation.
+
+    walltime : int
+        Maximum walltime of a segment in seconds.
+
+    safety_margin : float, default=0.1
+        Fraction of the walltime kept free in case a segment runs slower than
+        expected.
+
+    ntwx : int, optional
+        Frame frequency. If given, segments are made a multiple of it so that
+        no frames are lost between segments.
+
+    Returns
+    -------
+    tuple
+        Lists of the number of MD steps in each segment and the walltime (in
+        seconds, rounded up to the minute) requested for each segment.
+    '''
+    steps_per_second = ns_per_day * 1000 / dt / 86400
+    max_steps = int(walltime * (1 - safety_margin) * steps_per_second)
+    if ntwx and max_steps >= ntwx:
+        max_steps -= max_steps % ntwx
+    if max_steps < 1:
+        raise Exception(f'A walltime of {walltime} seconds is too short to run '
+                        f'any steps at {ns_per_day} ns/day')
+
+    # Share the steps evenly between the segments
+    n_segments = math.ceil(nstlim / max_steps)
+    size = math.ceil(nstlim / n_segments)
+    if ntwx and max_steps >= ntwx:
+        size = math.ceil(size / ntwx) * ntwx
+    lengths = [size] * (nstlim // size)
+    if nstlim % size:
+        lengths.append(nstlim % size)
+
+    walltimes = [min(walltime, 60 * math.ceil(n / steps_per_second / (1 - safety_margin) / 60))
+                 for n in lengths]
+    return lengths, walltimes
+
 class Simulation:
     """Class for running MD simulations.
     
@@ -484,6 +547,24 @@ class Simulation:
         self.md_job_names = []
         self.trajectories = []
         self.completed_steps = []
+        self.job_ids = {}
+        self.task_ids = {}
+        self.attempt_numbers = {}
+        self.state = {}
+        self._adopted = {}
+        self.restarts = {}
+        self.excluded_nodes = []
+        self.walltimes = {}
+        self.nstlims = {}
+        self.segments = {}
+        self.stop_after = None
+        self.box_change_recovery = None
+        self.reduction = None
+        self.stripped_trajectories = []
+        self.io_budget = None
+        self._io_budget_checked = False
+        self._followers = {}
+        self._followed = float('-inf')
     
     def add_minimisation_step(
             self, 
@@ -661,7 +742,10 @@ class Simulation:
             save_frame_frequency: int = 25000,
             restraints: Union[str, tuple] = None,
             md_input: ProductionInput = None,
-            quiet=False
+            quiet=False,
+            segment_walltime: str = None,
+            safety_margin: float = 0.1,
+            ns_per_day: float = None
             ):
         
         '''Adds a Production step to the simulation.
@@ -685,6 +769,21 @@ class Simulation:
         md_input : EquilibrationInput, optional
             Overrides all other arguments and instead uses an 
             EquilibrationInput instance.
+
+        segment_walltime : str, optional
+            If given (e.g. '12:00:00'), the production step is split into 
+            segments which each fit into this walltime, and each segment
+            requests only the walltime it needs. The speed of the simulation 
+            is measured from the mdinfo file of the previous step, so the
+            production step is split once the previous step has finished.
+
+        safety_margin : float, default=0.1
+            Fraction of the segment walltime kept free in case the segment 
+            runs slower than expected.
+
+        ns_per_day : float, optional
+            Speed of the production simulation (e.g. from a benchmark). If 
+            given, it is used instead of the speed of the previous step.
         '''       
         
         # If no md_input provided, build one from the key word arguments
@@ -728,12 +827,27 @@ class Simulation:
             
         else:
             raise Exception('md_input must be an instance of the ProductionInput class or None')
+
+        if segment_walltime is not None:
+            md_input.segmentation = {'walltime': walltime_to_seconds(segment_walltime),
+                                     'safety_margin': safety_margin,
+                                     'ns_per_day': ns_per_day}
+
         if not quiet:
             logger.debug(f'Production flags: {md_input.arg_dict}')
 
     def run(self,
             arc = 3,
-            cores = 32
+            cores = 32,
+            scheduler = None,
+            gpu = True,
+            chain = None,
+            retry_policy = None,
+            convergence = None,
+            box_change_recovery = None,
+            client = None,
+            follow_trajectories = None,
+            reduction = None
             ):
         '''Writes the mdin files and runs the simulation using crossbow.
 
@@ -754,16 +868,89 @@ class Simulation:
             The number of cores to use for minimisation (if minimisation is 
             used).
 
+        scheduler : Scheduler, optional
+            If given, the steps are submitted through this scheduler (see 
+            amberpy.schedulers) instead of crossbow/longbow. The simulation 
+            directory must be visible to the scheduler.
+
+        gpu : bool, default=True
+            Run the non-minimisation steps on a gpu when using a scheduler.
+
+        chain : bool or list, optional
+            Run several steps inside a single job when using a scheduler. See
+            the submit method.
+
+        retry_policy : RetryPolicy, optional
+            Decides which failed steps are resubmitted (see amberpy.retry).
+            Defaults to RetryPolicy().
+
+        convergence : ConvergenceController, optional
+            If given, the simulation's energies are checked after each 
+            production step and the remaining production steps are cancelled
+            once they have converged (see amberpy.convergence).
+
+        box_change_recovery : BoxChangeRecovery, optional
+            Recover from box change errors in NPT steps inside the job, 
+            rather than resubmitting the step (see amberpy.recovery). 
+            Requires a scheduler.
+
+        client : CrossbowClient, optional
+            Client used to submit the steps through crossbow/longbow (see
+            amberpy.crossbow). A client can be shared by simulations run from
+            different threads. Defaults to CrossbowClient().
+
+        follow_trajectories : int, optional
+            When the scheduler has a stager (see amberpy.staging), download
+            the new frames of the trajectories of running steps every this
+            many seconds, so that they can be analysed before the steps have
+            finished (see amberpy.netcdf.TrajectoryFollower). Steps whose
+            trajectories are reduced aren't followed.
+
+        reduction : TrajectoryReduction, optional
+            Reduce (autoimage, strip and stride) the trajectory of each 
+            production step with cpptraj on the cluster at the end of its
+            job, so that only the reduced trajectory and a stripped topology
+            are downloaded (see amberpy.reduction). Requires a scheduler.
+
         '''
 
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+
+        if box_change_recovery is not None:
+            self.box_change_recovery = box_change_recovery
+
+        if reduction is not None:
+            self.reduction = reduction
+
+        self._check_io_budget()
+
+        if scheduler is not None:
+            return self._run_with_scheduler(scheduler, cores, gpu, chain, retry_policy,
+                                            convergence, follow_trajectories)
+        elif chain:
+            raise Exception('Chaining steps requires a scheduler')
+        elif self.box_change_recovery is not None:
+            raise Exception('Box change recovery requires a scheduler')
+        elif self.reduction is not None:
+            raise Exception('Trajectory reduction requires a scheduler')
+
         
+        if client is None:
+            client = CrossbowClient()
+
+        # Pick up from where a previous run of this simulation got to
+        self.load_state()
+
         # Longbow doesn't like absolute paths so get the basenames of the 
         # input files
         parm7 = os.path.basename(self.parm7)
         rst7 = os.path.basename(self.rst7)
         ref_rst7 = os.path.basename(self.ref_rst7)
 
-        # Iterate through md steps and get step number (i)        
+        # Iterate through md steps and get step number (i). Segmented steps
+        # are split (replacing items after the current one) as the loop goes
+        self._segment_steps()
         for step_number, md_step in enumerate(self.md_steps):
 
             # Create a key word argument dictionary for crossbow and add 
@@ -773,11 +960,24 @@ class Simulation:
             kwargs['localworkdir'] = self.simulation_directory
             
             step_number += 1
+
+            # The remaining steps aren't needed once production has converged
+            if self.stop_after is not None and step_number > self.stop_after:
+                break
             step_name = md_step.__str__()
             if step_name == 'production':
                 kwargs['stagingfrequency'] = 3600
+            if step_number in self.walltimes:
+                # Longbow's maxtime is HH:MM, so round up to whole minutes
+                minutes = math.ceil(self.walltimes[step_number] / 60)
+                kwargs['maxtime'] = f'{minutes // 60:02d}:{minutes % 60:02d}'
             
-            attempt_number = 0
+            attempt_number = self.attempt_numbers.get(step_number, 0)
+
+            # A step that failed part way through continues from the restart
+            # file of the failed attempt
+            if self.completed_steps[step_number-1] == 0 and step_number in self.restarts:
+                rst7 = self.restarts[step_number]
             
             while True:
                 
@@ -791,45 +991,938 @@ class Simulation:
                     kwargs['minimisation'] = True
                     kwargs['cores'] = cores
                 else:
-                    self.trajectories.append(os.path.join(self.simulation_directory, fname.replace('mdin', 'nc')))
+                    trajectory = os.path.join(self.simulation_directory, fname.replace('mdin', 'nc'))
+                    if trajectory not in self.trajectories:
+                        self.trajectories.append(trajectory)
 
-                # If step is not completed
-                if self.completed_steps[step_number-1] == 0:
+                if self.completed_steps[step_number-1] == 1:
+                    # The step has already been completed so the next step
+                    # starts from its restart file
+                    rst7 = f'step-{step_number}.{attempt_number}-{step_name}.rst7'
+                    break
 
-                    md_step.write(self.simulation_directory, fname)
+                self._step_input(step_number).write(self.simulation_directory, fname)
+                self._set_step_state(step_number, 'written', restart=self.restarts.get(step_number),
+                                     nstlim=self.nstlims.get(step_number))
 
-                    # Get the name for the job from the simulation name, step name, and 
-                    # step number
-                    job_name = self.name + '.' + step_name[:3] + '.' + str(step_number) + '.' + str(attempt_number)
-                    self.md_job_names.append(job_name)
+                # Get the name for the job from the simulation name, step name, and 
+                # step number
+                job_name = self.name + '.' + step_name[:3] + '.' + str(step_number) + '.' + str(attempt_number)
+                self.md_job_names.append(job_name)
 
-                    # Get the positional arguments in a tuple. The positional arguments
-                    # for crossbow are (name, user, mdin, parm7, rst7, ref_rst7)
-                    args = (job_name, fname, parm7, rst7, ref_rst7)
+                # Get the positional arguments in a tuple. The positional arguments
+                # for crossbow are (name, user, mdin, parm7, rst7, ref_rst7)
+                args = (job_name, fname, parm7, rst7, ref_rst7)
 
-                    if step_number != 1:
-                        kwargs['hold_jid'] = self.md_job_names[step_number+attempt_number-2]
-                
-                    if self.completed_steps[step_number-1] == 0:
-                        error_code = run_pmemd(*args, **kwargs)
-
-                        if error_code == 0:
-                            rst7 = f'step-{step_number}.{attempt_number}-{step_name}.rst7'
-                            self.completed_steps[step_number-1] = 1
-                            break
-                        elif error_code == 1:
-                            rst7 = f'step-{step_number}.{attempt_number}-{step_name}.rst7'
-                            attempt_number += 1
-                            self.completed_steps.append(0)
-                            continue
-                        elif error_code == 2:
-                            self.run(arc, cores)
-                            
-                    else:
-                        rst7 = f'step-{step_number}.{attempt_number}-{step_name}.rst7'
-                        break              
+                # Hold the job until the previous job has finished
+                if len(self.md_job_names) > 1:
+                    kwargs['hold_jid'] = self.md_job_names[-2]
+
+                self._set_step_state(step_number, 'submitted', job_id=job_name)
+                try:
+                    error_code = client.run_pmemd(*args, **kwargs)
+                    failure = {0: None, 1: BOX_CHANGE, 2: CUDA}.get(error_code, UNKNOWN)
+
+                    # pmemd can stop early (e.g. killed at the walltime)
+                    # without either error
+                    if failure is None and not self._step_finished(step_number):
+                        output = client.job_output(job_name, self.simulation_directory)
+                        failure = retry_policy.classify(output)
+                except Exception as error:
+                    # Errors raised while staging files are retried, 
+                    # anything else is not
+                    failure = retry_policy.classify(str(error))
+                    if failure == UNKNOWN:
+                        self._set_step_state(step_number, 'failed', failure=failure)
+                        raise
+
+                if failure is None:
+                    rst7 = f'step-{step_number}.{attempt_number}-{step_name}.rst7'
+                    self._complete_step(step_number)
+                    self._segment_steps()
+                    self._check_convergence(step_number, convergence)
+                    break
+
+                # Only the failed step is resubmitted
+                self._set_step_state(step_number, 'failed', failure=failure)
+                if not retry_policy.retry((self.name, step_number), failure):
+                    raise Exception(f"Step {step_number} of '{self.name}' "
+                                    f'failed ({failure})')
+
+                self._prepare_retry(step_number, failure, retry_policy)
+                attempt_number = self.attempt_numbers.get(step_number, 0)
+                rst7 = self.restarts.get(step_number, rst7)
+
+    def submit(self,
+               scheduler,
+               cores = 32,
+               gpu = True,
+               chain = None,
+               last_step = None):
+        '''Writes the mdin files for the steps that have not been completed
+        and submits them to a scheduler as a chain of dependent jobs.
+
+        Unlike run, this method does not wait for the jobs to finish, so many
+        simulations can be submitted before waiting on the scheduler.
+
+        Parameters
+        ----------
+        scheduler : Scheduler
+            Scheduler to submit the jobs to (see amberpy.schedulers).
+
+        cores : int, default=32
+            The number of cores to use for minimisation (and for every step
+            if gpu is False).
+
+        gpu : bool, default=True
+            Run the non-minimisation steps on a gpu.
+
+        chain : bool or list, optional
+            Run several steps back to back inside a single job, so that they
+            only queue (and are staged) once. If True, all of the steps are 
+            run in one job. Alternatively, give a list of (first, last) step
+            numbers, e.g. [(1, 2)] to run minimisation and equilibration in
+            one job and every other step in its own job. Each step in a chain
+            is checked (exit status and output) before the next one starts.
+
+        last_step : int, optional
+            Only submit the steps up to and including this step.
+
+        Returns
+        -------
+        list
+            Job ids of the submitted steps in step order.
+        '''
+        self._check_io_budget()
+
+        job_ids = []
+        dependency = None
+        previous_step = None
+
+        for steps in self._step_groups(chain):
+
+            steps = [n for n in steps if self.completed_steps[n-1] == 0 and
+                     (last_step is None or n <= last_step) and
+                     (self.stop_after is None or n <= self.stop_after)]
+            if not steps:
+                continue
+
+            # Steps still queued/running from a previous run are not 
+            # resubmitted
+            adopted = set(self._adopted.get(n) for n in steps)
+            if len(adopted) == 1 and None not in adopted:
+                dependency = adopted.pop()
+                previous_step = steps[-1]
+                job_ids.append(dependency)
+                continue
+
+            if len(steps) == 1:
+                job = self._step_job(scheduler, steps[0], cores, gpu)
+            else:
+                job = self._chain_job(scheduler, steps, cores, gpu)
+
+            # Each job waits for the previous job to finish successfully,
+            # which the job checks itself where the scheduler doesn't
+            if dependency is not None:
+                job.dependencies = [dependency]
+                job.requires = self._step_requirements(previous_step)
+
+            dependency = scheduler.submit(job)
+            previous_step = steps[-1]
+            self.md_job_names.append(job.name)
+            for step_number in steps:
+                self.job_ids[step_number] = dependency
+                self._set_step_state(step_number, 'submitted', job_id=dependency)
+            job_ids.append(dependency)
+
+            logger.info(f"Submitted step(s) {', '.join(map(str, steps))} of "
+                        f"'{self.name}' as job {dependency}")
+
+        return job_ids
+
+    def _check_io_budget(self):
+        '''Warns (once) if the outputs of the simulation would exceed its I/O
+        budget (see amberpy.io_budget).'''
+        if self.io_budget is not None and not self._io_budget_checked:
+            self.io_budget.check(self)
+            self._io_budget_checked = True
+
+    def _run_with_scheduler(self, scheduler, cores, gpu, chain, retry_policy, convergence=None,
+                            follow_trajectories=None):
+        '''Submits the steps that have not been completed to a scheduler and
+        waits for them to finish, resubmitting failed steps according to the
+        retry policy.
+        '''
+        def callback(states):
+            self._update_running(states)
+            if follow_trajectories is not None:
+                self._follow_trajectories(scheduler, follow_trajectories)
+            if convergence is not None:
+                self._converge_finished_steps(states, scheduler, convergence)
+
+        # Pick up from where a previous run of this simulation got to
+        self.load_state(scheduler)
+
+        while True:
+
+            # Steps which can't be segmented until the previous step has 
+            # finished are submitted after it
+            self._segment_steps()
+            last_step = self._segmentation_barrier()
+
+            job_ids = self.submit(scheduler, cores, gpu, chain, last_step)
+            states = scheduler.wait(job_ids, callback=callback)
+
+            failed_step = None
+            for step_number, job_id in sorted(self.job_ids.items()):
+                if job_id not in states or self.completed_steps[step_number-1] == 1:
+                    continue
+                if self.stop_after is not None and step_number > self.stop_after:
+                    continue
+                self._fetch_outputs(scheduler, step_number)
+
+                # Steps of a failed chain which finished before the failure 
+                # are still completed
+                if states[job_id] == COMPLETED or self._step_finished(step_number):
+                    self._complete_step(step_number)
+                else:
+                    failed_step = step_number
+                    break
+
+            if failed_step is None:
+                if last_step is None or self.stop_after is not None:
+                    return
+                continue
+
+            # The steps after the failed step were never run, so only the
+            # failed step needs fixing before everything left is resubmitted
+            job_id = self.job_ids[failed_step]
+            self._adopted.pop(failed_step, None)
+            info = scheduler.info(job_id)
+            failure = retry_policy.classify(scheduler.job_output(job_id) or '', info['state'])
+            self._set_step_state(failed_step, 'failed', job_state=info['state'],
+                                 failure=failure)
+
+            if not retry_policy.retry((self.name, failed_step), failure,
+                                      elapsed=info.get('elapsed', 0),
+                                      nodes=info.get('nodes', 1),
+                                      sleep=scheduler.sleep):
+                raise Exception(f"Step {failed_step} of '{self.name}' (job "
+                                f"{job_id}) finished with state "
+                                f"{info['state']} ({failure})")
+
+            self._prepare_retry(failed_step, failure, retry_policy, info.get('node'))
+
+    def _follow_trajectories(self, scheduler, interval):
+        '''Scheduler.wait callback which downloads the new frames of the
+        trajectories of running steps every interval seconds.
+        '''
+        if scheduler.stager is None or scheduler.now() - self._followed < interval:
+            return
+        self._followed = scheduler.now()
+
+        for step_number in range(1, len(self.md_steps)+1):
+            status = self.state.get(str(step_number), {}).get('status')
+            if status == 'running' and str(self.md_steps[step_number-1]) != 'minimisation' \
+               and not self._reduces(step_number):
+                self._trajectory_follower(scheduler, step_number).update()
+
+    def _trajectory_follower(self, scheduler, step_number):
+        '''Returns the follower of the trajectory of a step.'''
+        path = os.path.join(self.simulation_directory, self._step_prefix(step_number) + '.nc')
+        if path not in self._followers:
+            self._followers[path] = TrajectoryFollower(scheduler.stager, path)
+        return self._followers[path]
+
+    def _fetch_outputs(self, scheduler, step_number):
+        '''Downloads the new parts of the output files of a step, if the
+        scheduler has a stager.
+        '''
+        stager = scheduler.stager
+        if stager is None:
+            return
+        prefix = os.path.join(self.simulation_directory, self._step_prefix(step_number))
+        outputs = [prefix + suffix for suffix in ('.mdout', '.mdinfo', '.rst7')]
+
+        # Only the reduced trajectory is downloaded if there is one
+        if self._reduces(step_number):
+            outputs += [self.reduction.output(self, step_number), self.reduction.stripped_parm7(self)]
+        for path in outputs:
+            if stager.transport.exists(stager.remote_path(path)):
+                stager.pull(stager.remote_path(path), path)
+        if str(self.md_steps[step_number-1]) != 'minimisation':
+            reduced = self._reduces(step_number) and os.path.isfile(self.reduction.output(self, step_number))
+            if not reduced:
+                self._trajectory_follower(scheduler, step_number).update()
+
+    def _converge_finished_steps(self, states, scheduler, convergence):
+        '''Scheduler.wait callback which completes the steps whose jobs have
+        just finished and checks whether the simulation has converged after
+        the last of them.
+        '''
+        finished = [n for n, job_id in sorted(self.job_ids.items())
+                    if states.get(job_id) == COMPLETED and self.completed_steps[n-1] == 0]
+        for step_number in finished:
+            self._fetch_outputs(scheduler, step_number)
+            self._complete_step(step_number)
+        if finished:
+            self._check_convergence(finished[-1], convergence, scheduler)
+
+    def _check_convergence(self, step_number, convergence, scheduler=None):
+        '''Checks whether the simulation has converged after a production
+        step and, if so, cancels the remaining production steps.
+
+        Returns
+        -------
+        bool
+            True if the remaining steps were cancelled.
+        '''
+        if convergence is None or self.stop_after is not None:
+            return False
+        if str(self.md_steps[step_number-1]) != 'production':
+            return False
+
+        # Only stop if everything left is production
+        remaining = [n for n in range(step_number+1, len(self.md_steps)+1)
+                     if self.completed_steps[n-1] == 0]
+        if not remaining or any(str(self.md_steps[n-1]) != 'production' for n in remaining):
+            return False
+
+        converged, evidence = convergence.check(self, step_number)
+        self.state[str(step_number)]['convergence'] = evidence
+        if not converged:
+            self.save_state()
+            return False
+
+        logger.info(f"'{self.name}' has converged after step {step_number}, "
+                    f"cancelling step(s) {', '.join(map(str, remaining))}")
+        self.stop_after = step_number
+
+        # Steps run in the same job as this step can't be cancelled
+        job_ids = set(self.job_ids.get(n) for n in remaining) - {self.job_ids.get(step_number), None}
+        if scheduler is not None:
+            for job_id in job_ids:
+                scheduler.cancel(job_id)
+        for n in remaining:
+            self._set_step_state(n, 'cancelled', reason='converged')
+        return True
+
+    def _prepare_retry(self, step_number, failure, retry_policy, node=None):
+        '''Avoids the node a step failed on (for CUDA failures) and, for 
+        failures after which the step can continue, makes the next attempt
+        start from the restart file of the failed attempt.
+        '''
+        if failure == CUDA and retry_policy.exclude_nodes and node is not None:
+            if node not in self.excluded_nodes:
+                logger.info(f"Excluding node {node} from '{self.name}'")
+                self.excluded_nodes.append(node)
+
+        if failure in retry_policy.continues:
+            restart = self._step_prefix(step_number) + '.rst7'
+            path = os.path.join(self.simulation_directory, restart)
+
+            # If no restart file was written the attempt is simply rerun
+            if not os.path.isfile(path) or os.path.getsize(path) == 0:
+                return
+
+            # The next attempt only runs the MD steps that are left
+            remaining = self._remaining_steps(step_number, path)
+            if remaining is not None and remaining < 1:
+                return
+            self.restarts[step_number] = restart
+            self.attempt_numbers[step_number] = self.attempt_numbers.get(step_number, 0) + 1
+            if remaining is not None:
+                logger.info(f"Continuing step {step_number} of '{self.name}' "
+                            f'with {remaining} MD steps left')
+                self.nstlims[step_number] = remaining
+
+    def _remaining_steps(self, step_number, restart):
+        '''Returns the number of MD steps of a step left after a failed
+        attempt which wrote a restart file, from the times in the attempt's
+        input and restart files or else the last NSTEP in its mdout file
+        (None if neither is known).
+        '''
+        md_step = self._step_input(step_number)
+        nstlim = getattr(md_step, 'nstlim', None)
+        dt = getattr(md_step, 'dt', None)
+        if nstlim is None or not dt:
+            return None
+
+        done = None
+        try:
+            start = restart_time(os.path.join(self.simulation_directory,
+                                              self._input_rst7(step_number)))
+            end = restart_time(restart)
+            if start is not None and end is not None:
+                done = int(round((end - start) / dt))
+        except Exception:
+            pass
+
+        # The restart file is written every ntwr steps, so it is at least
+        # as far as the last multiple of ntwr printed in the mdout file
+        if done is None:
+            mdout = os.path.join(self.simulation_directory, self._step_prefix(step_number) + '.mdout')
+            try:
+                nstep = read_mdout(mdout).get('NSTEP')
+            except Exception:
+                nstep = None
+            if nstep is None or len(nstep) == 0:
+                return None
+            ntwr = md_step.arg_dict.get('ntwr') or 1
+            done = int(nstep[-1]) // ntwr * ntwr
+        return nstlim - done
+
+    def _step_input(self, step_number):
+        '''Returns the MDInput of a step, with nstlim set to the steps left
+        if the attempt continues from a failed one.'''
+        md_step = self.md_steps[step_number-1]
+        if step_number not in self.nstlims:
+            return md_step
+        md_step = copy.deepcopy(md_step)
+        md_step.nstlim = self.nstlims[step_number]
+        md_step.arg_dict['nstlim'] = md_step.nstlim
+        return md_step
+
+    def _step_groups(self, chain):
+        '''Returns a list of lists of step numbers, where each list is run
+        in one job.
+        '''
+        n_steps = len(self.md_steps)
+
+        if not chain:
+            return [[n] for n in range(1, n_steps+1)]
+        elif chain is True:
+            return [list(range(1, n_steps+1))]
+
+        groups = []
+        next_step = 1
+        for first, last in sorted(chain):
+            if first < next_step or last < first or last > n_steps:
+                raise Exception(f'Invalid chain of steps ({first}, {last})')
+            groups += [[n] for n in range(next_step, first)]
+            groups.append(list(range(first, last+1)))
+            next_step = last + 1
+        groups += [[n] for n in range(next_step, n_steps+1)]
+        return groups
+
+    def _chain_job(self, scheduler, steps, cores, gpu):
+        '''Writes the mdin files for several steps and returns a scheduler 
+        Job that runs them one after the other.
+        '''
+
+        # If any step is run on a gpu, run the whole chain on the gpu
+        resources = [self._step_resources(n, cores, gpu) for n in steps]
+        gpus = max(g for _, g in resources)
+        chain_cores = 1 if gpus else cores
+        executable = scheduler.pmemd_executable(gpus, chain_cores)
+
+        commands = []
+        for step_number in steps:
+            prefix = self._step_prefix(step_number)
+            if self._recovers(step_number):
+                commands += self.box_change_recovery.commands(self, step_number, executable)
+            else:
+                commands += [f'{executable} {self._step_arguments(step_number)}',
+                             'status=$?',
+                             f'if [ $status -ne 0 ] || [ ! -s {prefix}.rst7 ] || '
+                             f"! grep -q 'Total wall time' {prefix}.mdout; then",
+                             f'    echo "Step {step_number} failed with exit status $status"',
+                             '    exit 1',
+                             'fi']
+            if self._reduces(step_number):
+                commands += self.reduction.commands(self, step_number)
+
+        # The chain only gets a walltime if all of its steps have one
+        walltime = None
+        if all(n in self.walltimes for n in steps):
+            walltime = seconds_to_walltime(sum(self.walltimes[n] for n in steps))
+
+        return Job(f'{self.name}.chain.{steps[0]}-{steps[-1]}',
+                   commands,
+                   workdir=self.simulation_directory,
+                   cores=chain_cores,
+                   gpus=gpus,
+                   walltime=walltime,
+                   exclude=self.excluded_nodes,
+                   inputs=self._step_inputs(steps))
+
+    def _step_requirements(self, step_number, directory=''):
+        '''Returns shell commands which test that pmemd finished a step (see
+        _step_finished). File names are given relative to directory (the
+        simulation directory by default).'''
+        prefix = os.path.join(directory, self._step_prefix(step_number))
+        return [f'test -s {prefix}.rst7',
+                f"grep -q 'Total wall time' {prefix}.mdout"]
+
+    def _step_finished(self, step_number):
+        '''Returns True if pmemd finished a step, i.e. its restart file was
+        written and its mdout file reports the total wall time.
+        '''
+        prefix = os.path.join(self.simulation_directory, self._step_prefix(step_number))
+        try:
+            if os.path.getsize(prefix + '.rst7') == 0:
+                return False
+            with open(prefix + '.mdout', 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(f.tell() - 4096, 0))
+                return b'Total wall time' in f.read()
+        except OSError:
+            return False
+
+    def _complete_step(self, step_number, outputs=None):
+        '''Marks a step as completed and records its trajectory. The hashes
+        of its output files are saved in the state file unless they are
+        given.
+        '''
+        self.completed_steps[step_number-1] = 1
+        if str(self.md_steps[step_number-1]) != 'minimisation':
+
+            # Earlier attempts which were continued from are part of the
+            # step's trajectory, as are the parts run when recovering from
+            # box changes. Trajectories that are not here (e.g. only the
+            # reduced trajectory was downloaded) are left out
+            attempts = self.attempt_numbers.get(step_number, 0)
+            for attempt_number in range(attempts + 1):
+                prefix = os.path.join(self.simulation_directory,
+                                      self._step_prefix(step_number, attempt_number))
+                trajectories = [prefix + '.nc']
+                parts = glob.glob(glob.escape(prefix) + '.part*.nc')
+                trajectories += sorted(parts, key=lambda f: int(f[len(prefix)+5:-3]))
+                for trajectory in trajectories:
+                    if os.path.isfile(trajectory) and trajectory not in self.trajectories:
+                        self.trajectories.append(trajectory)
+
+            if self._reduces(step_number):
+                reduced = self.reduction.output(self, step_number)
+                if os.path.isfile(reduced) and reduced not in self.stripped_trajectories:
+                    self.stripped_trajectories.append(reduced)
+
+        if outputs is None:
+            outputs = {}
+            for suffix in ('.rst7', '.mdout'):
+                fname = self._step_prefix(step_number) + suffix
+                digest = file_hash(os.path.join(self.simulation_directory, fname))
+                if digest is not None:
+                    outputs[fname] = digest
+        self._set_step_state(step_number, 'finished', outputs=outputs)
+
+    @property
+    def state_file(self):
+        '''str : Path of the file the simulation state is saved to.'''
+        directory = self.simulation_directory or os.getcwd()
+        return os.path.join(directory, f'{self.name}.state.json')
+
+    def save_state(self):
+        '''Saves the state of each step (status, attempt number, job id and
+        output file hashes) to the state file.
+        '''
+        state = {'name': self.name,
+                 'segments': self.segments,
+                 'stop_after': self.stop_after,
+                 'steps': self.state}
+
+        # Write to a temporary file first so that the state file is never
+        # left half written if the process is killed
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, self.state_file)
+
+    def load_state(self, scheduler=None):
+        '''Reads the state file written by a previous run of this simulation
+        and marks the steps whose outputs still exist and validate as
+        completed. Steps whose jobs are still queued or running on the 
+        scheduler are adopted rather than resubmitted.
+
+        Parameters
+        ----------
+        scheduler : Scheduler, optional
+            Scheduler used to query jobs and to check outputs which only 
+            exist in the remote working directory.
+        '''
+        if not os.path.isfile(self.state_file):
+            return
+
+        with open(self.state_file, 'r') as f:
+            saved = json.load(f)
+
+        # Split the steps that were segmented in the same way as before
+        for step_number, segments in sorted(saved.get('segments', {}).items(),
+                                            key=lambda item: int(item[0])):
+            md_step = self.md_steps[int(step_number)-1]
+            if str(step_number) not in self.segments and getattr(md_step, 'segmentation', None) is not None:
+                self.segment_step(int(step_number), segments['nstlim'], segments['walltimes'])
+        self.stop_after = saved.get('stop_after')
+        saved = saved['steps']
+
+        for step_number in range(1, len(self.md_steps)+1):
+
+            # Stop at the first step that doesn't match the saved state
+            record = saved.get(str(step_number))
+            if record is None or record['name'] != str(self.md_steps[step_number-1]):
+                break
+
+            self.state[str(step_number)] = record
+            self.attempt_numbers[step_number] = record['attempt']
+            if record.get('restart'):
+                self.restarts[step_number] = record['restart']
+            if record.get('nstlim'):
+                self.nstlims[step_number] = record['nstlim']
+
+            if self.completed_steps[step_number-1] == 1:
+                continue
+
+            if record['status'] == 'finished' and self._validate_step(step_number, record, scheduler):
+                logger.info(f"Step {step_number} of '{self.name}' has already "
+                            'been completed')
+                self._complete_step(step_number, record['outputs'])
+
+            elif record['status'] in ('submitted', 'running') and scheduler is not None:
+                job_id = record.get('job_id')
+                try:
+                    job_state = scheduler.status(job_id)
+                except Exception:
+                    job_state = None
+
+                if job_state in (PENDING, RUNNING):
+                    logger.info(f"Step {step_number} of '{self.name}' is still "
+                                f'queued/running as job {job_id}')
+                    self.job_ids[step_number] = job_id
+                    self._adopted[step_number] = job_id
+                    if job_id not in scheduler.jobs:
+                        scheduler.jobs[job_id] = Job(self._step_job_name(step_number),
+                                                     workdir=self.simulation_directory)
+                elif job_state == COMPLETED and self._step_finished(step_number):
+                    self._complete_step(step_number)
                 else:
-                    break      
+                    break
+            else:
+                break
+
+    def _validate_step(self, step_number, record, scheduler=None):
+        '''Returns True if the outputs of a finished step still match the
+        hashes in its state record, either locally or in the scheduler's
+        working directory.
+        '''
+        if not record.get('outputs'):
+            return self._step_finished(step_number)
+
+        for fname, digest in record['outputs'].items():
+            path = os.path.join(self.simulation_directory, fname)
+            if file_hash(path) == digest:
+                continue
+            if scheduler is not None and scheduler.host is not None:
+                if scheduler.file_hash(scheduler._remote_path(path)) == digest:
+                    continue
+            return False
+        return True
+
+    def _set_step_state(self, step_number, status, **kwargs):
+        '''Updates the state record of a step and saves the state file.'''
+        record = self.state.setdefault(str(step_number), {})
+        record.update({'step': step_number,
+                       'name': str(self.md_steps[step_number-1]),
+                       'attempt': self.attempt_numbers.get(step_number, 0),
+                       'status': status,
+                       'time': time.strftime('%Y-%m-%d %H:%M:%S')})
+        if status in ('written', 'submitted'):
+            record['outputs'] = {}
+        record.update(kwargs)
+        self.save_state()
+
+    def _update_running(self, states):
+        '''Scheduler.wait callback which records steps that have started.'''
+        for step_number, job_id in self.job_ids.items():
+            record = self.state.get(str(step_number), {})
+            if states.get(job_id) == RUNNING and record.get('status') == 'submitted':
+                self._set_step_state(step_number, 'running')
+
+    def _step_prefix(self, step_number, attempt_number=None):
+        '''Returns the file name prefix of a step,
+        e.g. step-1.0-minimisation.
+        '''
+        if attempt_number is None:
+            attempt_number = self.attempt_numbers.get(step_number, 0)
+        step_name = str(self.md_steps[step_number-1])
+        return f'step-{step_number}.{attempt_number}-{step_name}'
+
+    def _step_job_name(self, step_number, attempt_number=None):
+        '''Returns the job name of a step.'''
+        if attempt_number is None:
+            attempt_number = self.attempt_numbers.get(step_number, 0)
+        step_name = str(self.md_steps[step_number-1])
+        return self.name + '.' + step_name[:3] + '.' + str(step_number) + '.' + str(attempt_number)
+
+    def _input_rst7(self, step_number):
+        '''Returns the name of the coordinate file a step starts from.'''
+        if step_number in self.restarts:
+            return self.restarts[step_number]
+        if step_number == 1:
+            return os.path.basename(self.rst7)
+        return self._step_prefix(step_number-1) + '.rst7'
+
+    def _step_resources(self, step_number, cores, gpu):
+        '''Returns the (cores, gpus) used to run a step. Minimisation is run
+        on cpus, everything else on a gpu (if gpu).
+        '''
+        minimisation = str(self.md_steps[step_number-1]) == 'minimisation'
+        gpus = 1 if gpu and not minimisation else 0
+        return (1 if gpus else cores), gpus
+
+    def _step_arguments(self, step_number, directory=''):
+        '''Writes the mdin file for a step and returns the pmemd arguments
+        that run it. File names are given relative to directory.
+        '''
+        md_step = self._step_input(step_number)
+        fname = self._step_prefix(step_number) + '.mdin'
+        md_step.write(self.simulation_directory, fname)
+        self._set_step_state(step_number, 'written', restart=self.restarts.get(step_number),
+                             nstlim=self.nstlims.get(step_number))
+
+        return pmemd_arguments(os.path.join(directory, fname),
+                               os.path.join(directory, os.path.basename(self.parm7)),
+                               os.path.join(directory, self._input_rst7(step_number)),
+                               os.path.join(directory, os.path.basename(self.ref_rst7)),
+                               str(md_step) == 'minimisation')
+
+    def _step_commands(self, scheduler, step_number, cores, gpu):
+        '''Writes the mdin file for a step and returns the commands that run
+        it.
+        '''
+        step_cores, gpus = self._step_resources(step_number, cores, gpu)
+        executable = scheduler.pmemd_executable(gpus, step_cores)
+        if self._recovers(step_number):
+            commands = self.box_change_recovery.commands(self, step_number, executable)
+        else:
+            commands = [f'{executable} {self._step_arguments(step_number)}']
+        if self._reduces(step_number):
+            commands += ['status=$?',
+                         'if [ $status -ne 0 ]; then exit $status; fi']
+            commands += self.reduction.commands(self, step_number)
+        return commands
+
+    def _reduces(self, step_number):
+        '''Returns True if the trajectory of a step is reduced at the end of
+        its job.
+        '''
+        return (self.reduction is not None and
+                self.reduction.applies(self.md_steps[step_number-1]))
+
+    def _recovers(self, step_number):
+        '''Returns True if box change errors in a step are recovered from
+        inside its job.
+        '''
+        return (self.box_change_recovery is not None and
+                self.box_change_recovery.applies(self.md_steps[step_number-1]))
+
+    def _step_job(self, scheduler, step_number, cores, gpu):
+        '''Writes the mdin file for a step and returns a scheduler Job that
+        runs it.
+        '''
+        step_cores, gpus = self._step_resources(step_number, cores, gpu)
+        return Job(self._step_job_name(step_number),
+                   self._step_commands(scheduler, step_number, cores, gpu),
+                   workdir=self.simulation_directory,
+                   cores=step_cores,
+                   gpus=gpus,
+                   walltime=self._step_walltime(step_number),
+                   exclude=self.excluded_nodes,
+                   inputs=self._step_inputs([step_number]))
+
+    def _step_inputs(self, steps):
+        '''Returns the local files read by the jobs running some steps (their
+        mdin files, the topology and the coordinate files which aren't
+        written by an earlier step).
+        '''
+        directory = self.simulation_directory
+        inputs = [self.parm7, self.ref_rst7]
+        for step_number in steps:
+            prefix = self._step_prefix(step_number)
+            inputs.append(os.path.join(directory, prefix + '.mdin'))
+            if self._recovers(step_number):
+                inputs += [os.path.join(directory, f'{prefix}.{suffix}.mdin') for suffix in ('sub', 'rest')]
+            if step_number == 1 and step_number not in self.restarts:
+                inputs.append(self.rst7)
+        return list(dict.fromkeys(os.path.abspath(f) for f in inputs))
+
+    def _step_walltime(self, step_number):
+        '''Returns the walltime requested for a step, or None to use the 
+        scheduler's default walltime.
+        '''
+        if step_number in self.walltimes:
+            return seconds_to_walltime(self.walltimes[step_number])
+        return None
+
+    def _segmentation_barrier(self):
+        '''Returns the number of the step before the first step that is
+        waiting for it to finish so that it can be segmented, or None.
+        '''
+        for step_number, md_step in enumerate(self.md_steps, start=1):
+            if getattr(md_step, 'segmentation', None) is not None:
+                return step_number - 1
+        return None
+
+    def _segment_steps(self):
+        '''Splits each step added with a segment_walltime into segments, 
+        if the speed of the simulation is known.
+        '''
+        for step_number, md_step in enumerate(self.md_steps, start=1):
+            segmentation = getattr(md_step, 'segmentation', None)
+            if segmentation is None:
+                continue
+
+            # The speed is measured from the previous step, scaled by the
+            # ratio of the time steps
+            ns_per_day = segmentation['ns_per_day']
+            if ns_per_day is None and step_number == 1:
+                logger.warning(f"Step 1 of '{self.name}' has no previous step to "
+                               'measure the speed of, so it will not be segmented')
+                self.segment_step(step_number, [md_step.nstlim], [None])
+                continue
+            if ns_per_day is None:
+                if self.completed_steps[step_number-2] == 0:
+                    return
+                previous = self.md_steps[step_number-2]
+                prefix = os.path.join(self.simulation_directory, self._step_prefix(step_number-1))
+                ns_per_day = read_ns_per_day(prefix + '.mdinfo') or read_ns_per_day(prefix + '.mdout')
+                if ns_per_day is not None and getattr(previous, 'dt', None):
+                    ns_per_day *= md_step.dt / previous.dt
+
+            if ns_per_day is None:
+                logger.warning(f"Couldn't measure the speed of step "
+                               f"{step_number-1} of '{self.name}', so step "
+                               f'{step_number} will not be segmented')
+                self.segment_step(step_number, [md_step.nstlim], [None])
+                continue
+
+            nstlim, walltimes = segment_lengths(md_step.nstlim,
+                                                md_step.dt,
+                                                ns_per_day,
+                                                segmentation['walltime'],
+                                                segmentation['safety_margin'],
+                                                md_step.arg_dict.get('ntwx'))
+            logger.info(f"Splitting step {step_number} of '{self.name}' into "
+                        f'{len(nstlim)} segments ({ns_per_day:.1f} ns/day)')
+            self.segment_step(step_number, nstlim, walltimes)
+            self.save_state()
+            return self._segment_steps()
+
+    def segment_step(self, step_number, nstlim, walltimes=None):
+        '''Replaces a step with segments that continue from each other.
+
+        Parameters
+        ----------
+        step_number : int
+            Number of the step to split (counting from 1).
+
+        nstlim : list
+            Number of MD steps in each segment.
+
+        walltimes : list, optional
+            Walltime (in seconds) requested for each segment, or None to use
+            the scheduler's default.
+        '''
+        if walltimes is None:
+            walltimes = [None] * len(nstlim)
+
+        md_step = self.md_steps[step_number-1]
+        segments = []
+        for n in nstlim:
+            segment = copy.deepcopy(md_step)
+            segment.segmentation = None
+            segment.nstlim = n
+            segment.arg_dict['nstlim'] = n
+            segments.append(segment)
+
+        # Shift the walltimes of the later steps
+        n_new = len(segments) - 1
+        self.walltimes = {(n + n_new if n > step_number else n): w
+                          for n, w in self.walltimes.items() if n != step_number}
+        self.nstlims = {(n + n_new if n > step_number else n): w
+                        for n, w in self.nstlims.items() if n != step_number}
+        for i, walltime in enumerate(walltimes):
+            if walltime is not None:
+                self.walltimes[step_number + i] = walltime
+
+        self.md_steps[step_number-1:step_number] = segments
+        self.completed_steps[step_number-1:step_number] = [0] * len(segments)
+        self.segments[str(step_number)] = {'nstlim': list(nstlim),
+                                           'walltimes': list(walltimes)}
+
+
+    def step_mdouts(self, step_number):
+        '''Returns the paths of the mdout files written by a step, one for
+        each attempt that the step was continued from (in order).
+        '''
+        mdouts = []
+        for attempt_number in range(self.attempt_numbers.get(step_number, 0) + 1):
+            mdout = os.path.join(self.simulation_directory or '',
+                                 self._step_prefix(step_number, attempt_number) + '.mdout')
+            if os.path.isfile(mdout):
+                mdouts.append(mdout)
+        return mdouts
+
+    def read_energies(self, cache=True):
+        '''Returns the energies written to the mdout files of every MD step
+        (and segment) of the simulation, in order.
+
+        Parameters
+        ----------
+        cache : bool, default=True
+            Save the parsed energies next to each mdout file, so that reading
+            them again only parses output written since.
+
+        Returns
+        -------
+        dict
+            NumPy arrays keyed by the labels in the mdout files (e.g. 
+            'NSTEP', 'TIME(PS)', 'TEMP(K)', 'Etot', 'Density'), plus a 'STEP'
+            column with the step number each record came from. Minimisation
+            steps are not included.
+        '''
+        tables = []
+        step_numbers = []
+        for step_number, md_step in enumerate(self.md_steps, start=1):
+            if str(md_step) == 'minimisation':
+                continue
+            for mdout in self.step_mdouts(step_number):
+                tables.append(read_mdout(mdout, cache))
+                step_numbers.append(step_number)
+
+        return concatenate_columns(tables, 'STEP', step_numbers)
+
+    def archive(self, precision=1000, codec='zlib', remove=False):
+        '''Converts the trajectories of the completed steps into compressed
+        archive files (see amberpy.archive). The trajectories (and stripped
+        trajectories) listed by the simulation are replaced by the archives,
+        which amberpy's trajectory readers read in the same way.
+
+        Parameters
+        ----------
+        precision : float, default=1000
+            Coordinates are kept to 1/precision Angstroms.
+
+        codec : str, default='zlib'
+            'zlib' or 'lzma' (smaller but slower).
+
+        remove : bool, default=False
+            Delete each trajectory once it has been archived.
+
+        Returns
+        -------
+        list
+            Report of each archived trajectory (see archive_trajectory).
+        '''
+        reports = []
+        for trajectories in (self.trajectories, self.stripped_trajectories):
+            for i, trajectory in enumerate(trajectories):
+                if not trajectory.endswith('.nc') or not os.path.isfile(trajectory):
+                    continue
+                report = archive_trajectory(trajectory, precision=precision,
+                                            codec=codec, remove=remove)
+                trajectories[i] = report['output']
+                reports.append(report)
+        return reports
 
     def remove_last_step(self):
 
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the staging of files to and from the remote working
+directories of simulations.
+
+Transport
+    Base class which runs shell commands on a host and implements file
+    operations (upload, append, ranged download, hash, link) on top of them.
+
+SSHTransport
+    Runs commands over one multiplexed ssh connection (ControlMaster) per
+    host.
+
+LocalTransport
+    Runs the same commands on the local machine, so a local directory can
+    stand in for the remote filesystem.
+
+Stager
+    Uploads input files into a content-addressed store on the remote host,
+    so each unique file (e.g. the topology shared by every step and replica)
+    is uploaded once and linked into each working directory, and transfers
+    only the new bytes of growing files in either direction.
+
+get_transport(host)
+    Returns the shared transport of a host (a LocalTransport if host is
+    None).
+
+A typical use would be:
+
+    from amberpy.staging import Stager, get_transport
+    from amberpy.schedulers import SGEScheduler
+
+    stager = Stager(get_transport('arc4'), '/nobackup/user/amberpy-store')
+    scheduler = SGEScheduler(host='arc4', stager=stager)
+    experiment.run(scheduler=scheduler)
+"""
+import os
+import shlex
+import hashlib
+import subprocess
+import threading
+import logging
+
+from amberpy.utilities import file_hash
+
+logger = logging.getLogger(__name__)
+
+# Number of bytes before the end of the shorter copy of a growing file that
+# are compared before only the new bytes are transferred
+CHECK_WINDOW = 1 << 20
+
+class Transport:
+    '''Base class for transports.
+
+    Subclasses only need to implement the command method, which returns the
+    arguments that run a shell command on the host.
+    '''
+
+    def command(self, command):
+        '''Returns the subprocess arguments that run a shell command on the
+        host.'''
+        raise NotImplementedError
+
+    def run(self, command, stdin=None, stdout=subprocess.PIPE, check=True):
+        '''Runs a shell command on the host.
+
+        Parameters
+        ----------
+        command : str
+            Shell command.
+
+        stdin : file, optional
+            File object the command reads from.
+
+        stdout : file, optional
+            File object the command writes to. By default the output is
+            returned.
+
+        check : bool, default=True
+            Raise an exception if the command fails.
+
+        Returns
+        -------
+        bytes
+            The output of the command (empty if stdout was given).
+        '''
+        p = subprocess.run(self.command(command),
+                           stdin=stdin,
+                           stdout=stdout,
+                           stderr=subprocess.PIPE)
+        if check and p.returncode != 0:
+            raise Exception(f"Command '{command}' failed with exit status "
+                            f"{p.returncode}: {p.stderr.decode().strip()}")
+        return p.stdout or b''
+
+    def size(self, path):
+        '''Returns the size of a file in bytes, or None if it doesn't
+        exist.'''
+        out = self.run(f'stat -c %s {shlex.quote(path)} 2> /dev/null', check=False).strip()
+        return int(out) if out else None
+
+    def exists(self, path):
+        '''Returns True if a file exists.'''
+        return self.size(path) is not None
+
+    def makedirs(self, path):
+        '''Creates a directory (and its parents).'''
+        self.run(f'mkdir -p {shlex.quote(path)}')
+
+    def put(self, local_path, path):
+        '''Uploads a file. The file is written under a temporary name and
+        then renamed, so it is never seen half written.'''
+        tmp = shlex.quote(f'{path}.part')
+        with open(local_path, 'rb') as f:
+            self.run(f'cat > {tmp} && mv {tmp} {shlex.quote(path)}', stdin=f)
+
+    def append(self, local_path, path, offset):
+        '''Appends the bytes of a local file from offset onwards to a
+        file.'''
+        with open(local_path, 'rb') as f:
+            f.seek(offset)
+            self.run(f'cat >> {shlex.quote(path)}', stdin=f)
+
+    def get(self, path, local_path, offset=0, length=None):
+        '''Appends the bytes of a file from offset onwards (up to length
+        bytes) to a local file.'''
+        command = f'tail -c +{offset + 1} {shlex.quote(path)}'
+        if length is not None:
+            command += f' | head -c {length}'
+        with open(local_path, 'ab') as f:
+            self.run(command, stdout=f)
+
+    def hash(self, path, start=0, end=None):
+        '''Returns the sha256 hash of the bytes of a file from start up to
+        end (the end of the file if None).'''
+        command = f'tail -c +{start + 1} {shlex.quote(path)}'
+        if end is not None:
+            command += f' | head -c {end - start}'
+        return self.run(command + ' | sha256sum').split()[0].decode()
+
+    def link(self, target, path):
+        '''Makes path a symbolic link to target.'''
+        self.run(f'ln -sfn {shlex.quote(target)} {shlex.quote(path)}')
+
+    def close(self):
+        '''Closes any connection held by the transport.'''
+        pass
+
+class SSHTransport(Transport):
+    '''Runs commands on a host over ssh.
+
+    The first command opens a master connection which later commands (and
+    any other ssh command given the same options, e.g. those of the
+    schedulers) are multiplexed over, so only one connection is made to
+    each host. The master connection closes itself once it has been idle for
+    persist seconds.
+
+    Attributes
+    ----------
+    host : str
+        Host name (or user@host) to connect to.
+
+    control_dir : str, default='~/.amberpy/ssh'
+        Local directory holding the control sockets.
+
+    persist : int, default=600
+        Seconds the master connection stays open while idle.
+    '''
+
+    def __init__(self, host, control_dir='~/.amberpy/ssh', persist=600):
+        self.host = host
+        self.control_dir = os.path.expanduser(control_dir)
+        self.persist = persist
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+
+    @property
+    def options(self):
+        '''list : ssh options which share the master connection.'''
+        return ['-o', 'ControlMaster=auto',
+                '-o', f"ControlPath={os.path.join(self.control_dir, '%r@%h:%p')}",
+                '-o', f'ControlPersist={self.persist}',
+                '-o', 'BatchMode=yes']
+
+    def command(self, command):
+        return ['ssh'] + self.options + [self.host, command]
+
+    def close(self):
+        subprocess.run(['ssh'] + self.options + ['-O', 'exit', self.host],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+class LocalTransport(Transport):
+    '''Runs commands on the local machine. With a Stager whose remote_root
+    is a local directory, this stands in for a remote host.'''
+
+    def command(self, command):
+        return ['bash', '-c', command]
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+def get_transport(host):
+    '''Returns the transport shared by everything that runs commands on a
+    host (a LocalTransport if host is None).'''
+    with _transports_lock:
+        if host not in _transports:
+            _transports[host] = LocalTransport() if host is None else SSHTransport(host)
+        return _transports[host]
+
+class Stager:
+    '''Stages files between the local machine and a host.
+
+    Files staged into a working directory are uploaded to the store, named
+    by the sha256 hash of their contents, and the working directory gets a
+    link to the stored file. A file that is already in the store (e.g. the
+    topology of another replica) is not uploaded again.
+
+    Attributes
+    ----------
+    transport : Transport
+        Transport to the host.
+
+    store : str
+        Directory on the host holding the uploaded files.
+
+    local_root, remote_root : str, optional
+        Local paths under local_root are staged to the same relative path
+        under remote_root. By default files are staged to the same path on
+        the host.
+
+    uploaded, downloaded : int
+        Bytes transferred so far.
+    '''
+
+    def __init__(self, transport, store, local_root=None, remote_root=None):
+        self.transport = transport
+        self.store = store
+        self.local_root = os.path.abspath(local_root) if local_root is not None else None
+        self.remote_root = remote_root
+        self.uploaded = 0
+        self.downloaded = 0
+
+        self._lock = threading.Lock()
+        self._hashes = {}
+        self._stored = set()
+        self._linked = {}
+        self._directories = set()
+
+    def remote_path(self, local_path):
+        '''Returns the path on the host that a local path is staged to.'''
+        local_path = os.path.abspath(local_path)
+        if self.local_root is None:
+            return local_path
+        return os.path.normpath(os.path.join(self.remote_root, os.path.relpath(local_path, self.local_root)))
+
+    def stage(self, local_paths):
+        '''Uploads files (if they are not already in the store) and links
+        them into their remote directories.
+
+        Parameters
+        ----------
+        local_paths : list
+            Paths of the local files.
+
+        Returns
+        -------
+        list
+            Remote paths of the files.
+        '''
+        remote_paths = []
+        for local_path in local_paths:
+            digest = self._hash(local_path)
+            stored = os.path.join(self.store, digest)
+            remote_path = self.remote_path(local_path)
+
+            # The file is already where it is needed
+            if isinstance(self.transport, LocalTransport) and remote_path == os.path.abspath(local_path):
+                remote_paths.append(remote_path)
+                continue
+
+            if digest not in self._stored:
+                if not self.transport.exists(stored):
+                    self._makedirs(self.store)
+                    self.transport.put(local_path, stored)
+                    logger.debug(f'Uploaded {local_path} to {stored}')
+                    with self._lock:
+                        self.uploaded += os.path.getsize(local_path)
+                with self._lock:
+                    self._stored.add(digest)
+
+            if self._linked.get(remote_path) != digest:
+                self._makedirs(os.path.dirname(remote_path))
+                self.transport.link(stored, remote_path)
+                with self._lock:
+                    self._linked[remote_path] = digest
+
+            remote_paths.append(remote_path)
+        return remote_paths
+
+    def push(self, local_path, remote_path=None):
+        '''Uploads a file which grows over time, sending only the bytes added
+        since the last upload.
+
+        Returns
+        -------
+        int
+            Number of bytes sent.
+        '''
+        if remote_path is None:
+            remote_path = self.remote_path(local_path)
+        local_size = os.path.getsize(local_path)
+        remote_size = self.transport.size(remote_path)
+
+        if remote_size is not None and remote_size <= local_size and \
+           self._same_tail(local_path, remote_path, remote_size):
+            if remote_size < local_size:
+                self.transport.append(local_path, remote_path, remote_size)
+            sent = local_size - remote_size
+        else:
+            self._makedirs(os.path.dirname(remote_path))
+            self.transport.put(local_path, remote_path)
+            sent = local_size
+
+        with self._lock:
+            self.uploaded += sent
+        return sent
+
+    def pull(self, remote_path, local_path=None, length=None):
+        '''Downloads a file which grows over time, fetching only the bytes
+        added since the last download.
+
+        Parameters
+        ----------
+        remote_path : str
+            Path of the file on the host.
+
+        local_path : str, optional
+            Path of the local copy. By default the local path that is staged
+            to remote_path.
+
+        length : int, optional
+            Only download the local copy up to this many bytes (e.g. the
+            complete frames of a trajectory that is being written).
+
+        Returns
+        -------
+        int
+            Number of bytes received.
+        '''
+        if local_path is None:
+            if self.local_root is None:
+                local_path = remote_path
+            else:
+                local_path = os.path.join(self.local_root, os.path.relpath(remote_path, self.remote_root))
+
+        remote_size = self.transport.size(remote_path)
+        if remote_size is None:
+            raise Exception(f'{remote_path} does not exist')
+        length = remote_size if length is None else min(length, remote_size)
+
+        local_size = os.path.getsize(local_path) if os.path.isfile(local_path) else 0
+        if local_size > length or not self._same_tail(local_path, remote_path, local_size):
+            os.remove(local_path)
+            local_size = 0
+
+        received = 0
+        if local_size < length:
+            self.transport.get(remote_path, local_path, local_size, length - local_size)
+            received = length - local_size
+        with self._lock:
+            self.downloaded += received
+        return received
+
+    def _same_tail(self, local_path, remote_path, size):
+        '''Returns True if the last bytes of the first size bytes of the
+        local and remote files are the same.'''
+        if size == 0:
+            return True
+        start = max(0, size - CHECK_WINDOW)
+        sha256 = hashlib.sha256()
+        with open(local_path, 'rb') as f:
+            f.seek(start)
+            sha256.update(f.read(size - start))
+        return sha256.hexdigest() == self.transport.hash(remote_path, start, size)
+
+    def _hash(self, local_path):
+        '''Returns the hash of a local file, reusing it while the file's size
+        and modification time are unchanged.'''
+        stat = os.stat(local_path)
+        key = (os.path.abspath(local_path), stat.st_size, stat.st_mtime_ns)
+        if key not in self._hashes:
+            digest = file_hash(local_path)
+            with self._lock:
+                self._hashes[key] = digest
+        return self._hashes[key]
+
+    def _makedirs(self, path):
+        if path not in self._directories:
+            self.transport.makedirs(path)
+            with self._lock:
+                self._directories.add(path)
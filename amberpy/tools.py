@@ -177,3 +177,43 @@ def count_atoms(pdb):
 
 
 
+
+def write_pdb(fname, topology, coordinates, atoms=None, box=None):
+    '''
+    Writes coordinates to a PDB file, using the atom and residue names of an
+    Amber topology (a parm7 path or amberpy.topology.Topology). Several
+    frames, (frames, atoms, 3), are written as models. atoms are the indices
+    of the atoms the coordinates are for (defaults to every atom).
+    '''
+    from amberpy.topology import Topology
+    if isinstance(topology, str):
+        topology = Topology(topology)
+    coordinates = np.asarray(coordinates)
+    if coordinates.ndim == 2:
+        coordinates = coordinates[None]
+    if atoms is None:
+        atoms = np.arange(topology.n_atoms)
+    if coordinates.shape[1] != len(atoms):
+        raise Exception(f'{coordinates.shape[1]} coordinates given for {len(atoms)} atoms')
+
+    atom_names = topology.atom_names
+    residue_names = topology.residue_names
+    atom_residues = topology.atom_residues
+
+    with open(fname, 'w') as f:
+        if box is not None:
+            f.write('CRYST1{:9.3f}{:9.3f}{:9.3f}{:7.2f}{:7.2f}{:7.2f} P 1           1\n'.format(*box))
+        for model, frame in enumerate(coordinates, start=1):
+            if len(coordinates) > 1:
+                f.write(f'MODEL     {model:4d}\n')
+            for serial, (atom, xyz) in enumerate(zip(atoms, frame), start=1):
+                name = atom_names[atom]
+                name = name if len(name) == 4 else ' ' + name
+                residue = atom_residues[atom]
+                f.write('ATOM  {:5d} {:<4s} {:>3s}  {:4d}    {:8.3f}{:8.3f}{:8.3f}{:6.2f}{:6.2f}\n'.format(
+                    serial % 100000, name, residue_names[residue][:3], (residue + 1) % 10000,
+                    xyz[0], xyz[1], xyz[2], 1.0, 0.0))
+            f.write('TER\n')
+            if len(coordinates) > 1:
+                f.write('ENDMDL\n')
+        f.write('END\n')
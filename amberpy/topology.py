@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains a reader for Amber parm7 (prmtop) topology files.
+
+Topology
+    The sections of a parm7 file, with properties for the most commonly used
+    ones (atoms, residues, molecules and the periodic box).
+"""
+import re
+import numpy as np
+
+_FORMAT = re.compile(r'\((\d+)([aAiIeEfF])(\d+)')
+
+class Topology:
+    '''Amber parm7 topology.
+
+    Every section of the file is available from the sections dictionary,
+    keyed by its flag (e.g. sections['ATOM_NAME']).
+
+    Attributes
+    ----------
+    fname : str
+        Path of the parm7 file.
+
+    sections : dict
+        Values in each section of the file. Integer and float sections are
+        NumPy arrays, string sections are lists.
+    '''
+
+    def __init__(self, fname):
+        '''
+        Parameters
+        ----------
+        fname : str
+            Path of the parm7 file.
+        '''
+        self.fname = fname
+        self.sections = _read_sections(fname)
+
+    @property
+    def pointers(self):
+        '''np.ndarray : The POINTERS section (counts of atoms, residues
+        etc.).'''
+        return self.sections['POINTERS']
+
+    @property
+    def n_atoms(self):
+        '''int : Number of atoms.'''
+        return int(self.pointers[0])
+
+    @property
+    def n_residues(self):
+        '''int : Number of residues.'''
+        return int(self.pointers[11])
+
+    @property
+    def atom_names(self):
+        '''list : Name of each atom.'''
+        return self.sections['ATOM_NAME']
+
+    @property
+    def masses(self):
+        '''np.ndarray : Mass of each atom.'''
+        return self.sections['MASS']
+
+    @property
+    def charges(self):
+        '''np.ndarray : Charge of each atom in electron charges (Amber
+        stores them multiplied by 18.2223).'''
+        return self.sections['CHARGE'] / 18.2223
+
+    @property
+    def residue_names(self):
+        '''list : Name of each residue.'''
+        return self.sections['RESIDUE_LABEL']
+
+    @property
+    def residue_starts(self):
+        '''np.ndarray : Index (from 0) of the first atom of each residue.'''
+        return self.sections['RESIDUE_POINTER'] - 1
+
+    @property
+    def atom_residues(self):
+        '''np.ndarray : Index (from 0) of the residue each atom is in.'''
+        residues = np.zeros(self.n_atoms, dtype=int)
+        residues[self.residue_starts[1:]] = 1
+        return np.cumsum(residues)
+
+    @property
+    def atom_molecules(self):
+        '''np.ndarray : Index (from 0) of the molecule each atom is in, from
+        ATOMS_PER_MOLECULE or else from the bonds.
+        '''
+        if 'ATOMS_PER_MOLECULE' in self.sections:
+            return np.repeat(np.arange(len(self.sections['ATOMS_PER_MOLECULE'])),
+                             self.sections['ATOMS_PER_MOLECULE'])
+
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        bonds = self.bonds
+        graph = coo_matrix((np.ones(len(bonds)), (bonds[:, 0], bonds[:, 1])),
+                           shape=(self.n_atoms, self.n_atoms))
+        _, labels = connected_components(graph, directed=False)
+
+        # Number the molecules in order of their first atom
+        _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+        return np.argsort(np.argsort(first))[inverse]
+
+    @property
+    def heavy_atoms(self):
+        '''np.ndarray : Indices (from 0) of the atoms that are not
+        hydrogens (masses can't be used with hydrogen mass
+        repartitioning).'''
+        if 'ATOMIC_NUMBER' in self.sections:
+            return np.nonzero(self.sections['ATOMIC_NUMBER'] != 1)[0]
+        return np.array([i for i, name in enumerate(self.atom_names)
+                         if not name.startswith('H')], dtype=int)
+
+    @property
+    def bonds(self):
+        '''np.ndarray : (n_bonds, 2) array of the indices (from 0) of the
+        bonded atoms.'''
+        bonds = [self.sections[flag].reshape(-1, 3)[:, :2] // 3
+                 for flag in ('BONDS_INC_HYDROGEN', 'BONDS_WITHOUT_HYDROGEN')
+                 if flag in self.sections]
+        if not bonds:
+            return np.empty((0, 2), dtype=int)
+        return np.concatenate(bonds)
+
+    @property
+    def box(self):
+        '''np.ndarray or None : Box lengths and angles [a, b, c, alpha,
+        beta, gamma] from the topology, or None if it isn't periodic.'''
+        if 'BOX_DIMENSIONS' not in self.sections:
+            return None
+        beta, a, b, c = self.sections['BOX_DIMENSIONS']
+        return np.array([a, b, c, beta, beta, beta])
+
+    def select_residues(self, names):
+        '''Returns the indices of the atoms in residues with the given
+        names.'''
+        names = set(names)
+        mask = np.array([name in names for name in self.residue_names])
+        return np.nonzero(mask[self.atom_residues])[0]
+
+def _read_sections(fname):
+    '''Returns a dictionary of the sections in a parm7 file.'''
+    sections = {}
+    flag = None
+    fmt = None
+    lines = []
+
+    def finish():
+        if flag is not None:
+            sections[flag] = _parse_section(lines, fmt)
+
+    with open(fname, 'r') as f:
+        for line in f:
+            if line.startswith('%FLAG'):
+                finish()
+                flag = line.split()[1]
+                fmt = None
+                lines = []
+            elif line.startswith('%FORMAT'):
+                fmt = line
+            elif line.startswith('%'):
+                continue
+            elif flag is not None:
+                lines.append(line.rstrip('\n'))
+    finish()
+    return sections
+
+def _parse_section(lines, fmt):
+    '''Parses the lines of a section using its fixed width %FORMAT.'''
+    match = _FORMAT.search(fmt or '')
+    if match is None:
+        return lines
+    kind = match.group(2).lower()
+    width = int(match.group(3))
+
+    values = [line[i:i+width] for line in lines for i in range(0, len(line), width)]
+    if kind == 'a':
+        return [value.strip() for value in values]
+    values = [value for value in values if value.strip()]
+    if kind == 'i':
+        return np.array(values, dtype=int)
+    return np.array(values, dtype=float)
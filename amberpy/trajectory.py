@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the trajectory readers used by amberpy's analyses.
+Every reader returns frames in the same form, whatever the format of the
+file.
+
+Frames
+    Coordinates, boxes and times of a range of frames.
+
+Trajectory
+    Base class of the readers.
+
+NetCDFTrajectory
+    Reads an Amber NetCDF trajectory (see amberpy.netcdf).
+
+ArchiveTrajectory
+    Reads an amberpy archive file (see amberpy.archive).
+
+open_trajectory(fname)
+    Returns the reader for a file, chosen from the start of the file.
+
+read_restart(fname)
+    Returns the coordinates and box of an ASCII or NetCDF restart file.
+
+restart_time(fname)
+    Returns the simulation time of an ASCII or NetCDF restart file.
+
+box_vectors(boxes)
+    Converts box lengths and angles into box vectors.
+
+A typical use would be:
+
+    from amberpy.trajectory import open_trajectory
+
+    trajectory = open_trajectory('step-3.0-production.ncz')
+    for frames in trajectory.chunks(100):
+        print(frames.coordinates.mean(axis=1))
+"""
+import numpy as np
+
+from amberpy.netcdf import NetCDFFile
+from amberpy.archive import ArchiveFile, MAGIC
+
+class Frames:
+    '''A range of frames of a trajectory.
+
+    Attributes
+    ----------
+    coordinates : np.ndarray
+        (frames, atoms, 3) coordinates in Angstroms.
+
+    boxes : np.ndarray
+        (frames, 6) box lengths and angles (NaN if the trajectory has no
+        box).
+
+    times : np.ndarray
+        Time of each frame in ps (NaN if unknown).
+
+    indices : np.ndarray
+        Index of each frame in the trajectory.
+    '''
+
+    def __init__(self, coordinates, boxes, times, indices):
+        self.coordinates = coordinates
+        self.boxes = boxes
+        self.times = times
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.coordinates)
+
+class Trajectory:
+    '''Base class for trajectory readers.
+
+    Subclasses implement n_frames, n_atoms and _read.
+
+    Attributes
+    ----------
+    fname : str
+        Path of the trajectory.
+
+    transforms : list
+        Functions applied, in order, to every Frames object read (e.g. an
+        amberpy.imaging.AutoImager), each returning the transformed Frames.
+    '''
+
+    def __init__(self, fname, transforms=None):
+        self.fname = fname
+        self.transforms = list(transforms or [])
+
+    @property
+    def n_frames(self):
+        '''int : Number of frames.'''
+        raise NotImplementedError
+
+    @property
+    def n_atoms(self):
+        '''int : Number of atoms in each frame.'''
+        raise NotImplementedError
+
+    def read(self, start=0, stop=None, step=1):
+        '''Returns a range of frames as a Frames object.'''
+        frames = range(*slice(start, stop, step).indices(self.n_frames))
+        coordinates, boxes, times = self._read(frames)
+        frames = Frames(coordinates, boxes, times, np.array(frames))
+        for transform in self.transforms:
+            frames = transform(frames)
+        return frames
+
+    def chunks(self, chunk_size=100, start=0, stop=None, step=1):
+        '''Yields Frames objects of up to chunk_size frames.'''
+        frames = range(*slice(start, stop, step).indices(self.n_frames))
+        for i in range(0, len(frames), chunk_size):
+            chunk = frames[i:i+chunk_size]
+            yield self.read(chunk.start, chunk.stop, chunk.step)
+
+    def _read(self, frames):
+        raise NotImplementedError
+
+class NetCDFTrajectory(Trajectory):
+    '''Amber NetCDF trajectory. Only complete frames are read, so the file
+    can be read while it is being written.'''
+
+    def __init__(self, fname, transforms=None):
+        super().__init__(fname, transforms)
+        self.file = NetCDFFile(fname)
+
+    @property
+    def n_frames(self):
+        return self.file.n_frames
+
+    @property
+    def n_atoms(self):
+        return self.file.n_atoms
+
+    def _read(self, frames):
+        args = (frames.start, frames.stop, frames.step) if len(frames) else (0, 0)
+        coordinates = self.file.read('coordinates', *args).astype(np.float32, copy=False)
+        if 'cell_lengths' in self.file.variables:
+            boxes = np.hstack([self.file.read('cell_lengths', *args),
+                               self.file.read('cell_angles', *args)])
+        else:
+            boxes = np.full((len(frames), 6), np.nan)
+        if 'time' in self.file.variables:
+            times = self.file.read('time', *args).astype(np.float64)
+        else:
+            times = np.full(len(frames), np.nan)
+        return coordinates, boxes, times
+
+class ArchiveTrajectory(Trajectory):
+    '''amberpy archive file.'''
+
+    def __init__(self, fname, transforms=None):
+        super().__init__(fname, transforms)
+        self.file = ArchiveFile(fname)
+
+    @property
+    def n_frames(self):
+        return self.file.n_frames
+
+    @property
+    def n_atoms(self):
+        return self.file.n_atoms
+
+    def _read(self, frames):
+        if not len(frames):
+            return (np.empty((0, self.n_atoms, 3), dtype=np.float32),
+                    np.empty((0, 6)), np.empty(0))
+        return self.file.read(frames.start, frames.stop, frames.step)
+
+def box_vectors(boxes):
+    '''Converts box lengths and angles into box vectors.
+
+    Parameters
+    ----------
+    boxes : np.ndarray
+        (frames, 6) or (6,) box lengths and angles (in degrees) [a, b, c,
+        alpha, beta, gamma].
+
+    Returns
+    -------
+    np.ndarray
+        (frames, 3, 3) or (3, 3) box vectors as rows, with the first along x
+        and the second in the xy plane (as in Amber and cpptraj).
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64)
+    a, b, c = boxes[..., 0], boxes[..., 1], boxes[..., 2]
+    alpha, beta, gamma = np.radians(boxes[..., 3:6]).T if boxes.ndim > 1 else np.radians(boxes[3:6])
+    vectors = np.zeros(boxes.shape[:-1] + (3, 3))
+    vectors[..., 0, 0] = a
+    vectors[..., 1, 0] = b * np.cos(gamma)
+    vectors[..., 1, 1] = b * np.sin(gamma)
+    vectors[..., 2, 0] = c * np.cos(beta)
+    vectors[..., 2, 1] = c * (np.cos(alpha) - np.cos(beta) * np.cos(gamma)) / np.sin(gamma)
+    vectors[..., 2, 2] = np.sqrt(np.maximum(c ** 2 - vectors[..., 2, 0] ** 2 - vectors[..., 2, 1] ** 2, 0))
+    return vectors
+
+def open_trajectory(fname, transforms=None):
+    '''Returns a reader for a trajectory (NetCDF or archive), which applies
+    some transforms to the frames it reads.'''
+    with open(fname, 'rb') as f:
+        start = f.read(len(MAGIC))
+    if start == MAGIC:
+        return ArchiveTrajectory(fname, transforms)
+    elif start[:3] == b'CDF':
+        return NetCDFTrajectory(fname, transforms)
+    raise Exception(f'{fname} is not a NetCDF trajectory or an amberpy archive')
+
+def read_restart(fname):
+    '''Reads the coordinates and box of a restart (rst7 or inpcrd) file,
+    ASCII or NetCDF.
+
+    Returns
+    -------
+    tuple
+        (atoms, 3) coordinates and the box lengths and angles (None if the
+        file has no box).
+    '''
+    with open(fname, 'rb') as f:
+        start = f.read(3)
+    if start == b'CDF':
+        nc = NetCDFFile(fname)
+        box = None
+        if 'cell_lengths' in nc.variables:
+            box = np.concatenate([nc.read('cell_lengths'), nc.read('cell_angles')])
+        return nc.read('coordinates').astype(np.float64), box
+
+    with open(fname, 'r') as f:
+        f.readline()
+        n_atoms = int(f.readline().split()[0])
+        values = [float(line[i:i+12]) for line in f
+                  for i in range(0, len(line.rstrip('\n')), 12) if line[i:i+12].strip()]
+    coordinates = np.array(values[:n_atoms * 3]).reshape(n_atoms, 3)
+    box = np.array(values[-6:]) if len(values) % (n_atoms * 3) == 6 else None
+    return coordinates, box
+
+def restart_time(fname):
+    '''Returns the time (ps) of a restart (rst7 or inpcrd) file, ASCII or
+    NetCDF, or None if the file has no time (e.g. files made by tleap).'''
+    with open(fname, 'rb') as f:
+        start = f.read(3)
+    if start == b'CDF':
+        nc = NetCDFFile(fname)
+        if 'time' not in nc.variables:
+            return None
+        return float(np.ravel(nc.read('time'))[0])
+
+    with open(fname, 'r') as f:
+        f.readline()
+        fields = f.readline().split()
+    return float(fields[1]) if len(fields) > 1 else None
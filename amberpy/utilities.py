@@ -18,8 +18,13 @@ get_name_from_input_list(input_list)
     by '.'. If any of the inputs are None, these are not included in the 
     returned name string.
 
+file_hash(file)
+    This function returns the sha256 hash of a file, or None if the file does
+    not exist.
+
 """
 import os
+import hashlib
 
 def get_name_from_file(file):
     '''
@@ -39,4 +44,18 @@ def get_name_from_input_list(input_list):
     by '.'. If any of the inputs are None, these are not included in the 
     returned name string.
     '''
-    return '.'.join(filter(None.__ne__,[get_name_from_file(file) if get_name_from_file(file) != '' else file for file in input_list]))
\ No newline at end of file
+    return '.'.join(filter(None.__ne__,[get_name_from_file(file) if get_name_from_file(file) != '' else file for file in input_list]))
+
+def file_hash(file):
+    '''
+    This function returns the sha256 hash of a file, or None if the file does
+    not exist.
+    '''
+    sha256 = hashlib.sha256()
+    try:
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(block)
+    except OSError:
+        return None
+    return sha256.hexdigest()
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pytest
+
+from amberpy.analysis import AnalysisExecutor
+from amberpy.archive import ArchiveWriter
+from amberpy.trajectory import Frames
+
+
+class Shift:
+    '''Transform which moves every atom by the first atom's position, so
+    its result depends on atoms that are not selected.'''
+
+    def __call__(self, frames):
+        coordinates = frames.coordinates - frames.coordinates[:, :1]
+        return Frames(coordinates, frames.boxes, frames.times, frames.indices)
+
+
+def worker_pid(frames):
+    return [os.getpid()] * len(frames)
+
+
+def first_atoms(frames):
+    return np.array(frames.coordinates)
+
+
+@pytest.fixture
+def trajectories(tmp_path):
+    rng = np.random.default_rng(1)
+    fnames = []
+    for i in range(2):
+        fname = str(tmp_path / f'md{i}.ncz')
+        with ArchiveWriter(fname, 5) as writer:
+            writer.write(rng.uniform(0, 30, (25, 5, 3)), np.tile([30, 30, 30, 90, 90, 90], (25, 1)))
+        fnames.append(fname)
+    return fnames
+
+
+@pytest.mark.parametrize('processes', [1, 3])
+def test_transforms_applied_before_atom_selection(trajectories, processes):
+    executor = AnalysisExecutor(processes=processes, chunk_size=10, transforms=[Shift()])
+    result = executor.run(trajectories, first_atoms, np.vstack, atoms=[0, 2])
+    plain = AnalysisExecutor(processes=1, chunk_size=10).run(trajectories, first_atoms, np.vstack)
+    expected = (plain - plain[:, :1])[:, [0, 2]]
+    assert result.shape == (50, 2, 3)
+    assert np.allclose(result, expected, atol=1e-3)
+    assert np.allclose(executor.read_frames(trajectories, [3, 30], atoms=[0, 2]).coordinates,
+                       expected[[3, 30]], atol=1e-3)
+
+
+def test_transforms_run_in_workers(trajectories):
+    pids = []
+
+    class Record(Shift):
+        def __call__(self, frames):
+            pids.append(os.getpid())
+            return super().__call__(frames)
+
+    executor = AnalysisExecutor(processes=2, chunk_size=10, transforms=[Record()])
+    workers = executor.run(trajectories, worker_pid, lambda partials: set(np.concatenate(partials)))
+    assert os.getpid() not in workers
+    assert pids == []
@@ -0,0 +1,46 @@
+import numpy as np
+
+from amberpy.grids import Grid, OccupancyAnalysis
+from amberpy.trajectory import Frames
+
+
+class InProcessExecutor:
+    '''Runs an analysis on a single chunk of frames.'''
+
+    def __init__(self, frames):
+        self.frames = frames
+
+    def run(self, sources, map_function, reduce_function, initial, atoms=None, stripped=False):
+        return reduce_function(initial, map_function(self.frames))
+
+
+def make_analysis():
+    analysis = OccupancyAnalysis.__new__(OccupancyAnalysis)
+    analysis.types = ['ETH']
+    analysis.protein_atoms = np.arange(3)
+    analysis.atoms = np.arange(4)
+    analysis.reference = np.array([[0, 0, 0], [1.5, 0, 0], [0, 1.5, 0], [3, 3, 3]], dtype=np.float64)
+    analysis._fit = np.arange(3)
+    analysis._atom_type = np.array([0])
+    analysis.grid = Grid.around(analysis.reference[:3], spacing=1.0, padding=4.0)
+    return analysis
+
+
+def test_bulk_density_uses_mean_volume_of_periodic_frames():
+    analysis = make_analysis()
+    coordinates = np.tile(analysis.reference, (4, 1, 1)).astype(np.float32)
+    boxes = np.full((4, 6), np.nan)
+    boxes[:2] = [10, 10, 10, 90, 90, 90]
+    frames = Frames(coordinates, boxes, np.zeros(4), np.arange(4))
+
+    result = analysis.run([], InProcessExecutor(frames))
+    assert result['n_frames'] == 4
+    assert np.isclose(result['bulk']['ETH'], 1 / 1000)
+    assert np.isclose(result['grids']['ETH'].data.sum() * analysis.grid.volume, 1.0)
+
+
+def test_bulk_density_without_box_is_nan():
+    analysis = make_analysis()
+    coordinates = np.tile(analysis.reference, (2, 1, 1)).astype(np.float32)
+    frames = Frames(coordinates, np.full((2, 6), np.nan), np.zeros(2), np.arange(2))
+    assert np.isnan(analysis.run([], InProcessExecutor(frames))['bulk']['ETH'])
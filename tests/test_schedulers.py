@@ -0,0 +1,236 @@
+import pytest
+
+from amberpy.schedulers import (SGEScheduler, SlurmScheduler, LocalScheduler, FakeScheduler,
+                                Job, Task, PENDING, RUNNING, COMPLETED, FAILED, CANCELLED,
+                                TIMEOUT, UNKNOWN, walltime_to_seconds, seconds_to_walltime)
+
+
+class CannedSGE(SGEScheduler):
+    '''SGE scheduler which answers qsub, qstat and qacct with canned output.'''
+
+    def __init__(self, qstat='', qacct=None, **kwargs):
+        super().__init__(**kwargs)
+        self.qstat = qstat
+        self.qacct = qacct or {}
+        self.commands = []
+        self.clock = 0.0
+        self._ids = iter(range(1, 1000))
+
+    def now(self):
+        return self.clock
+
+    def _run(self, args, input=None, check=True):
+        self.commands.append(args)
+        if args[0] == 'qsub':
+            return f'{next(self._ids)}\n'
+        if args[0] == 'qstat':
+            return self.qstat
+        if args[0] == 'qacct':
+            return self.qacct.get(args[2], '')
+        return ''
+
+
+class CannedSlurm(SlurmScheduler):
+
+    def __init__(self, sacct, **kwargs):
+        super().__init__(**kwargs)
+        self.sacct = sacct
+
+    def _run(self, args, input=None, check=True):
+        return self.sacct
+
+
+QSTAT = '''\
+job-ID  prior   name       user         state submit/start at     queue                          slots ja-task-ID
+-----------------------------------------------------------------------------------------------------------------
+     12 0.50500 sim.pro.1  user         r     01/01/2021 10:00:00 gpu.q@node001                      1
+     13 0.50500 sim.pro.2  user         hqw   01/01/2021 10:00:00                                    1
+     14 0.50500 rep.pro.1  user         r     01/01/2021 10:00:00 gpu.q@node002                      1 1
+     14 0.50500 rep.pro.1  user         qw    01/01/2021 10:00:00                                    1 2-6:2
+     15 0.50500 sim.pro.3  user         Eqw   01/01/2021 10:00:00                                    1
+'''
+
+QACCT_COMPLETED = '''\
+==============================================================
+qname        gpu.q
+hostname     node003
+jobnumber    20
+taskid       undefined
+failed       0
+exit_status  0
+ru_wallclock 3600s
+'''
+
+QACCT_TIMEOUT = '''\
+==============================================================
+hostname     node004
+jobnumber    21
+taskid       undefined
+failed       37  : qmaster enforced h_rt, h_cpu, or h_vmem limit
+exit_status  137
+ru_wallclock 7200s
+'''
+
+QACCT_ARRAY = '''\
+==============================================================
+hostname     node001
+taskid       1
+failed       0
+exit_status  0
+ru_wallclock 100s
+==============================================================
+hostname     node002
+taskid       2
+failed       0
+exit_status  1
+ru_wallclock 50s
+'''
+
+
+def test_walltime_conversion():
+    assert walltime_to_seconds('12:30') == 45000
+    assert walltime_to_seconds('100:00:01') == 360001
+    assert seconds_to_walltime(360001) == '100:00:01'
+
+
+def test_sge_qstat_states():
+    sge = CannedSGE(QSTAT)
+    assert sge.info('12') == {'state': RUNNING}
+    assert sge.info('13') == {'state': PENDING}
+    assert sge.info('15') == {'state': FAILED}
+
+
+def test_sge_qstat_pending_array_tasks():
+    info = CannedSGE(QSTAT).info('14')
+    assert info['state'] == RUNNING
+    assert info['tasks'] == {'1': RUNNING, '2': PENDING, '4': PENDING, '6': PENDING}
+
+
+def test_sge_qacct_states():
+    sge = CannedSGE(qacct={'20': QACCT_COMPLETED, '21': QACCT_TIMEOUT, '22': QACCT_ARRAY})
+    assert sge.info('20') == {'state': COMPLETED, 'node': 'node003', 'nodes': 1,
+                              'elapsed': 3600, 'exit_code': 0}
+    assert sge.info('21')['state'] == TIMEOUT
+    info = sge.info('22')
+    assert info['state'] == FAILED
+    assert info['tasks'] == {'1': COMPLETED, '2': FAILED}
+
+
+def test_sge_missing_accounting_is_pending_until_timeout():
+    sge = CannedSGE(accounting_timeout=300)
+    assert sge.status('30') == PENDING
+    sge.clock = 299
+    assert sge.status('30') == PENDING
+    sge.clock = 301
+    assert sge.status('30') == UNKNOWN
+
+
+def test_sge_directives():
+    sge = CannedSGE()
+    job = Job('sim', ['pmemd'], workdir='/data/sim', gpus=1, walltime='01:30:00',
+              dependencies=['7'], exclude=['node001', 'node002'])
+    script = sge.render(job)
+    assert '#$ -wd /data/sim' in script
+    assert '#$ -l h_rt=01:30:00' in script
+    assert '#$ -hold_jid 7' in script
+    assert '#$ -l h=!(node001|node002)' in script
+    assert script.count('-l h=') == 1
+
+
+def test_sge_requires_exit_100():
+    sge = CannedSGE()
+    job = Job('sim', ['pmemd'], workdir='/data/sim', requires=['test -s a.rst7'],
+              tasks=[Task('/data/r1', ['pmemd'], requires=['test -s b.rst7'])])
+    script = sge.render(job)
+    assert "test -s a.rst7 || { echo 'Requirement not met: test -s a.rst7'; exit 100; }" in script
+    assert "        test -s b.rst7 || { echo 'Requirement not met: test -s b.rst7'; exit 100; }" in script
+
+
+def test_sge_failure_cancels_dependents():
+    sge = CannedSGE(qacct={'1': QACCT_TIMEOUT})
+    first = sge.submit(Job('a', ['pmemd']))
+    second = sge.submit(Job('b', ['pmemd'], dependencies=[first]))
+    third = sge.submit(Job('c', ['pmemd'], dependencies=[second]))
+    sge.commands = []
+    sge._job_failed(first, {first: TIMEOUT, second: PENDING, third: PENDING})
+    deleted = [args[1] for args in sge.commands if args[0] == 'qdel']
+    assert deleted == [third, second, first]
+    assert sge.status(second) == CANCELLED
+
+
+def test_sge_failed_tasks_cancel_dependent_tasks():
+    sge = CannedSGE(qacct={'1': QACCT_ARRAY})
+    tasks = [Task('/r1', ['pmemd']), Task('/r2', ['pmemd'])]
+    first = sge.submit(Job('a', tasks=tasks))
+    second = sge.submit(Job('b', tasks=tasks, task_dependencies=[first]))
+    sge.commands = []
+    sge._job_failed(first, {first: FAILED, second: RUNNING})
+    assert ['qdel', second, '-t', '2'] in sge.commands
+    assert ['qdel', second] not in sge.commands
+
+
+def test_slurm_sacct_states():
+    sacct = ('100|COMPLETED|node001|3600|0:0|1\n'
+             '100.batch|COMPLETED|node001|3600|0:0|1\n')
+    assert CannedSlurm(sacct).info('100') == {'state': COMPLETED, 'node': 'node001',
+                                              'elapsed': 3600, 'exit_code': 0, 'nodes': 1}
+    sacct = '101|TIMEOUT|node[001-002]|7200|0:15|2\n'
+    info = CannedSlurm(sacct).info('101')
+    assert info['state'] == TIMEOUT
+    assert info['nodes'] == 2
+
+
+def test_slurm_sacct_array():
+    sacct = ('102_1|COMPLETED|node001|60|0:0|1\n'
+             '102_2|FAILED|node002|30|1:0|1\n'
+             '102_[3-4]|PENDING||0|0:0|1\n')
+    info = CannedSlurm(sacct).info('102')
+    assert info['state'] == PENDING
+    assert info['tasks'] == {'1': COMPLETED, '2': FAILED}
+
+
+def test_slurm_directives():
+    slurm = SlurmScheduler(partition='gpu')
+    job = Job('sim', ['pmemd'], workdir='/data/sim', dependencies=['7'],
+              task_dependencies=['8'], exclude=['node001'])
+    script = slurm.render(job)
+    assert '#SBATCH --chdir=/data/sim' in script
+    assert '#SBATCH --dependency=afterok:7,aftercorr:8' in script
+    assert '#SBATCH --exclude=node001' in script
+
+
+def test_fake_scheduler_dependencies():
+    fake = FakeScheduler(run_time=10, fail=lambda job, task, node: 'boom' if job.name == 'b' else None)
+    a = fake.submit(Job('a', ['x']))
+    b = fake.submit(Job('b', ['x'], dependencies=[a]))
+    c = fake.submit(Job('c', ['x'], dependencies=[b]))
+    states = fake.wait([a, b, c], polling_frequency=5)
+    assert states == {a: COMPLETED, b: FAILED, c: CANCELLED}
+    assert fake.job_output(b) == 'boom'
+    assert fake._dependents(a) == [(b, None), (c, None)]
+
+
+def test_fake_scheduler_array_task_dependencies():
+    fake = FakeScheduler(run_time=10, fail=lambda job, task, node: 'boom' if task == 2 else None)
+    tasks = [Task('/r1', ['x']), Task('/r2', ['x'])]
+    a = fake.submit(Job('a', tasks=tasks))
+    b = fake.submit(Job('b', tasks=tasks, task_dependencies=[a]))
+    fake.wait([a, b], polling_frequency=5)
+    assert fake.info(b)['tasks'] == {1: COMPLETED, 2: CANCELLED}
+
+
+def test_fake_scheduler_walltime():
+    fake = FakeScheduler(run_time=7200, default_walltime='01:00:00')
+    job_id = fake.submit(Job('a', ['x']))
+    assert fake.wait([job_id], polling_frequency=60) == {job_id: TIMEOUT}
+    assert fake.now() == pytest.approx(3600)
+
+
+def test_local_scheduler(tmp_path):
+    local = LocalScheduler(max_jobs=2, polling_frequency=0.05)
+    a = local.submit(Job('a', ['echo hello'], workdir=str(tmp_path)))
+    b = local.submit(Job('b', ['exit 3'], workdir=str(tmp_path), dependencies=[a]))
+    c = local.submit(Job('c', ['echo never'], workdir=str(tmp_path), dependencies=[b]))
+    states = local.wait([a, b, c])
+    assert states == {a: COMPLETED, b: FAILED, c: CANCELLED}
+    assert local.job_output(a).strip() == 'hello'
@@ -0,0 +1,172 @@
+import os
+import re
+
+import pytest
+
+from amberpy.simulation import Simulation
+from amberpy.replicas import Replicas
+from amberpy.reduction import TrajectoryReduction
+from amberpy.retry import RetryPolicy, CUDA, WALLTIME
+from amberpy.schedulers import FakeScheduler, COMPLETED, FAILED, CANCELLED, TIMEOUT
+from amberpy.trajectory import restart_time
+
+PMEMD = re.compile(r'-c (\S+) -o (\S+) -r (\S+) .*-x (\S+)')
+
+
+def write_rst7(fname, time):
+    with open(fname, 'w') as f:
+        f.write(f'title\n    1  {time:.7e}\n')
+
+
+class FakePmemd:
+    '''on_finish callback for FakeScheduler which writes the outputs pmemd
+    would have written. Jobs which time out get through partial_steps MD
+    steps.'''
+
+    def __init__(self, dt=0.004, partial_steps=100000):
+        self.dt = dt
+        self.partial_steps = partial_steps
+
+    def __call__(self, job, task, state):
+        if state not in (COMPLETED, TIMEOUT):
+            return
+        workdir = job.tasks[task-1].workdir if task else job.workdir
+        for command in job.commands if not task else job.tasks[task-1].commands:
+            match = PMEMD.search(command)
+            if match is None:
+                continue
+            rst7, mdout, out_rst7, nc = (os.path.join(workdir, f) for f in match.groups())
+            start = restart_time(rst7) or 0.0
+            open(nc, 'w').close()
+            if state == COMPLETED:
+                write_rst7(out_rst7, start + 1000)
+                with open(mdout, 'w') as f:
+                    f.write('   Total wall time:         100    seconds\n')
+            else:
+                write_rst7(out_rst7, start + self.partial_steps * self.dt)
+                open(mdout, 'w').close()
+                return
+
+
+def make_simulation(directory, name='sim'):
+    os.makedirs(directory, exist_ok=True)
+    for fname in ('sys.parm7', 'sys.rst7'):
+        write_rst7(os.path.join(directory, fname), 0.0)
+    return Simulation(name, os.path.join(directory, 'sys.parm7'),
+                      os.path.join(directory, 'sys.rst7'),
+                      simulation_directory=str(directory))
+
+
+@pytest.fixture
+def simulation(tmp_path):
+    return make_simulation(str(tmp_path))
+
+
+def read_mdin(simulation, prefix):
+    with open(os.path.join(simulation.simulation_directory, prefix + '.mdin')) as f:
+        return f.read()
+
+
+def test_first_step_segmented_without_speed_runs_unsegmented(simulation):
+    simulation.add_production_step(simulation_time=1, segment_walltime='12:00:00', quiet=True)
+    simulation.run(scheduler=FakeScheduler())
+    assert simulation.completed_steps == [1]
+    assert simulation.md_steps[0].nstlim == 250000
+    assert os.path.isfile(os.path.join(simulation.simulation_directory, 'step-1.0-production.mdin'))
+
+
+def test_chain_runs_steps_in_one_job(simulation):
+    simulation.add_equilibration_step(simulation_time=0.1, restraints=None)
+    simulation.add_production_step(simulation_time=1)
+    scheduler = FakeScheduler(on_finish=FakePmemd())
+    simulation.run(scheduler=scheduler, chain=True)
+    assert simulation.completed_steps == [1, 1]
+    assert scheduler.submitted == 1
+    assert simulation.job_ids[1] == simulation.job_ids[2]
+
+
+def test_submit_requires_previous_step(simulation):
+    simulation.add_equilibration_step(simulation_time=0.1, restraints=None)
+    simulation.add_production_step(simulation_time=1)
+    scheduler = FakeScheduler()
+    first, second = simulation.submit(scheduler)
+    job = scheduler.jobs[second]
+    assert job.dependencies == [first]
+    assert job.requires == simulation._step_requirements(1)
+
+
+def test_failed_step_cancels_later_steps(simulation):
+    for _ in range(3):
+        simulation.add_production_step(simulation_time=1)
+    fail = lambda job, task, node: 'Segmentation fault' if job.name.endswith('.1.0') else None
+    scheduler = FakeScheduler(fail=fail)
+    job_ids = simulation.submit(scheduler)
+    states = scheduler.wait(job_ids)
+    assert [states[job_id] for job_id in job_ids] == [FAILED, CANCELLED, CANCELLED]
+
+    with pytest.raises(Exception, match='Step 1'):
+        simulation.run(scheduler=FakeScheduler(fail=fail))
+
+
+def test_cuda_failure_retried_on_another_node(simulation):
+    simulation.add_production_step(simulation_time=1)
+    failed = []
+
+    def fail(job, task, node):
+        if not failed:
+            failed.append(node)
+            return 'cudaGetDeviceCount failed'
+
+    retry_policy = RetryPolicy()
+    scheduler = FakeScheduler(fail=fail, on_finish=FakePmemd())
+    simulation.run(scheduler=scheduler, retry_policy=retry_policy)
+    assert simulation.completed_steps == [1]
+    assert simulation.excluded_nodes == failed
+    assert scheduler.jobs[simulation.job_ids[1]].exclude == failed
+    assert retry_policy.metrics['retries'] == {CUDA: 1}
+
+
+def test_walltime_failure_continues_with_remaining_steps(simulation):
+    simulation.add_production_step(simulation_time=1)
+    run_time = lambda job, task: 7200 if job.name.endswith('.0') else 60
+    retry_policy = RetryPolicy()
+    scheduler = FakeScheduler(run_time=run_time, default_walltime='01:00:00',
+                              on_finish=FakePmemd())
+    simulation.run(scheduler=scheduler, retry_policy=retry_policy)
+
+    assert simulation.completed_steps == [1]
+    assert retry_policy.metrics['retries'] == {WALLTIME: 1}
+    assert simulation.attempt_numbers == {1: 1}
+    assert simulation.restarts == {1: 'step-1.0-production.rst7'}
+    assert 'nstlim=150000' in read_mdin(simulation, 'step-1.1-production').replace(' ', '')
+    assert [os.path.basename(f) for f in simulation.trajectories] == [
+        'step-1.0-production.nc', 'step-1.1-production.nc']
+
+
+def test_completed_step_only_lists_local_trajectories(simulation):
+    simulation.add_production_step(simulation_time=1)
+    simulation.reduction = TrajectoryReduction()
+    reduced = simulation.reduction.output(simulation, 1)
+    open(reduced, 'w').close()
+    simulation._complete_step(1)
+    assert simulation.trajectories == []
+    assert simulation.stripped_trajectories == [reduced]
+
+
+def test_replicas_failed_task_only_cancels_its_replica(tmp_path):
+    sims = [make_simulation(str(tmp_path / f'rep{i}'), f'rep-{i}') for i in (1, 2)]
+    for sim in sims:
+        sim.add_equilibration_step(simulation_time=0.1, restraints=None)
+        sim.add_production_step(simulation_time=1)
+
+    fail = lambda job, task, node: 'Segmentation fault' if '.equ.' in job.name and task == 2 else None
+    scheduler = FakeScheduler(fail=fail, on_finish=FakePmemd())
+    with pytest.raises(Exception, match="step 1 of 'rep-2'"):
+        Replicas(sims).run(scheduler)
+
+    assert sims[0].completed_steps == [1, 1]
+    assert sims[1].completed_steps == [0, 0]
+    job = scheduler.jobs[sims[0].job_ids[2]]
+    assert job.task_dependencies == [sims[0].job_ids[1]]
+    assert [task.requires for task in job.tasks] == [sim._step_requirements(1) for sim in sims]
+    assert scheduler.info(job_id=sims[0].job_ids[2])['tasks'] == {1: COMPLETED, 2: CANCELLED}
@@ -0,0 +1,123 @@
+import os
+import hashlib
+
+import pytest
+
+from amberpy.staging import Stager, LocalTransport
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    local, remote, store = (tmp_path / name for name in ('local', 'remote', 'store'))
+    local.mkdir()
+    return str(local), str(remote), str(store)
+
+
+@pytest.fixture
+def stager(dirs):
+    local, remote, store = dirs
+    return Stager(LocalTransport(), store, local_root=local, remote_root=remote)
+
+
+def write(path, data, mode='wb'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, mode) as f:
+        f.write(data)
+
+
+def test_remote_path(stager, dirs):
+    local, remote, _ = dirs
+    assert stager.remote_path(os.path.join(local, 'rep1', 'sys.parm7')) == os.path.join(remote, 'rep1', 'sys.parm7')
+
+
+def test_stage_uploads_each_file_once(stager, dirs):
+    local, remote, store = dirs
+    data = b'topology' * 100
+    paths = [os.path.join(local, f'rep{i}', 'sys.parm7') for i in (1, 2)]
+    for path in paths:
+        write(path, data)
+
+    remote_paths = stager.stage(paths)
+    digest = hashlib.sha256(data).hexdigest()
+    assert os.listdir(store) == [digest]
+    assert stager.uploaded == len(data)
+    for path in remote_paths:
+        assert os.path.islink(path)
+        assert os.readlink(path) == os.path.join(store, digest)
+        with open(path, 'rb') as f:
+            assert f.read() == data
+
+    # Staging again, even with a new stager, uploads nothing
+    stager.stage(paths)
+    assert stager.uploaded == len(data)
+    other = Stager(LocalTransport(), store, local_root=local, remote_root=remote)
+    other.stage(paths)
+    assert other.uploaded == 0
+
+
+def test_stage_relinks_changed_file(stager, dirs):
+    local, _, store = dirs
+    path = os.path.join(local, 'step.mdin')
+    write(path, b'nstlim=100')
+    stager.stage([path])
+    write(path, b'nstlim=50')
+    os.utime(path, ns=(0, 0))
+    remote_path, = stager.stage([path])
+    with open(remote_path, 'rb') as f:
+        assert f.read() == b'nstlim=50'
+    assert len(os.listdir(store)) == 2
+
+
+def test_push_sends_only_new_bytes(stager, dirs):
+    local, remote, _ = dirs
+    path = os.path.join(local, 'md.nc')
+    write(path, b'a' * 1000)
+    assert stager.push(path) == 1000
+    write(path, b'b' * 500, mode='ab')
+    assert stager.push(path) == 500
+    assert stager.push(path) == 0
+    with open(os.path.join(remote, 'md.nc'), 'rb') as f:
+        assert f.read() == b'a' * 1000 + b'b' * 500
+
+
+def test_push_replaces_rewritten_remote_file(stager, dirs):
+    local, remote, _ = dirs
+    path = os.path.join(local, 'md.nc')
+    write(path, b'a' * 1000)
+    write(os.path.join(remote, 'md.nc'), b'c' * 100)
+    assert stager.push(path) == 1000
+    with open(os.path.join(remote, 'md.nc'), 'rb') as f:
+        assert f.read() == b'a' * 1000
+
+
+def test_pull_fetches_only_new_bytes(stager, dirs):
+    local, remote, _ = dirs
+    remote_path = os.path.join(remote, 'md.nc')
+    write(remote_path, b'a' * 1000)
+    assert stager.pull(remote_path, length=600) == 600
+    write(remote_path, b'b' * 500, mode='ab')
+    assert stager.pull(remote_path) == 900
+    assert stager.pull(remote_path) == 0
+    assert stager.downloaded == 1500
+    with open(os.path.join(local, 'md.nc'), 'rb') as f:
+        assert f.read() == b'a' * 1000 + b'b' * 500
+
+
+def test_pull_detects_rewritten_remote_file(stager, dirs):
+    local, remote, _ = dirs
+    remote_path = os.path.join(remote, 'md.rst7')
+    write(remote_path, b'first attempt')
+    stager.pull(remote_path)
+
+    # A later attempt rewrites the file, so the local copy is replaced
+    # rather than appended to
+    write(remote_path, b'second attempt, longer')
+    assert stager.pull(remote_path) == len(b'second attempt, longer')
+    with open(os.path.join(local, 'md.rst7'), 'rb') as f:
+        assert f.read() == b'second attempt, longer'
+
+
+def test_pull_missing_file(stager, dirs):
+    _, remote, _ = dirs
+    with pytest.raises(Exception, match='does not exist'):
+        stager.pull(os.path.join(remote, 'missing.nc'))